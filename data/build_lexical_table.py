@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Builds a lexical translation table from a word-aligned parallel corpus, for
+target vocabulary shortlists in decoding (see `--shortlist` in translate.py).
+
+The alignment file has one line per sentence pair, with links in the format
+produced by fast_align (source index - target index):
+
+    0-0 1-2 2-1
+
+Each line of the output has the form
+
+    source_word target_word p(target_word|source_word)
+
+and translations of the same source word are sorted by probability.
+"""
+
+import sys
+import argparse
+
+from collections import defaultdict
+
+
+def build_table(source, target, alignment, min_count):
+    link_counts = defaultdict(lambda: defaultdict(int))
+    source_counts = defaultdict(int)
+
+    for n, (source_line, target_line, alignment_line) in enumerate(zip(source, target, alignment)):
+        source_words = source_line.split()
+        target_words = target_line.split()
+        for link in alignment_line.split():
+            i, j = link.split('-')
+            try:
+                source_word = source_words[int(i)]
+                target_word = target_words[int(j)]
+            except IndexError:
+                sys.stderr.write('Warning: alignment link {0} out of range in line {1}\n'.format(link, n+1))
+                continue
+            link_counts[source_word][target_word] += 1
+            source_counts[source_word] += 1
+
+    for source_word in sorted(link_counts):
+        translations = link_counts[source_word]
+        total = float(source_counts[source_word])
+        for target_word in sorted(translations, key=translations.get, reverse=True):
+            count = translations[target_word]
+            if count < min_count:
+                break
+            yield source_word, target_word, count / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', '-s', type=argparse.FileType('r'), required=True, metavar='PATH',
+                        help="Source side of the training corpus")
+    parser.add_argument('--target', '-t', type=argparse.FileType('r'), required=True, metavar='PATH',
+                        help="Target side of the training corpus")
+    parser.add_argument('--alignment', '-a', type=argparse.FileType('r'), required=True, metavar='PATH',
+                        help="Word alignment of the training corpus")
+    parser.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, metavar='PATH',
+                        help="Output file (default: standard output)")
+    parser.add_argument('--min-count', type=int, default=1,
+                        help="Minimum number of alignment links for a translation to be kept (default: %(default)s)")
+    args = parser.parse_args()
+
+    for source_word, target_word, prob in build_table(args.source, args.target, args.alignment, args.min_count):
+        args.output.write('{0} {1} {2}\n'.format(source_word, target_word, prob))
+
+
+if __name__ == '__main__':
+    main()
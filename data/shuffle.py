@@ -2,10 +2,98 @@ import os
 import sys
 import random
 
+import numpy
+
 import tempfile
 from subprocess import call
 
 
+def permutation(n, seed=None, epoch=0):
+    """
+    Returns a random permutation of range(n). With a seed, the permutation
+    only depends on the seed and the epoch, so that the order of an epoch
+    can be reproduced when training is resumed.
+    """
+    if seed is None:
+        return numpy.random.permutation(n)
+    return numpy.random.RandomState([seed, epoch]).permutation(n)
+
+
+def line_offsets(filename):
+    """
+    Returns the byte offset of each line in a file.
+    """
+    offsets = []
+    position = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            offsets.append(position)
+            position += len(line)
+    return numpy.array(offsets, dtype='int64')
+
+
+class PermutedFile(object):
+    """
+    Read-only file object that returns the lines of a file in a given order.
+    """
+    def __init__(self, filename, offsets, order):
+        self._file = open(filename, 'rb')
+        self._offsets = offsets
+        self._order = order
+        self._position = 0
+
+    def readline(self):
+        if self._position >= len(self._order):
+            return ''
+        self._file.seek(self._offsets[self._order[self._position]])
+        self._position += 1
+        return self._file.readline()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+    def seek(self, position):
+        assert position == 0, 'PermutedFile only supports rewinding'
+        self._position = 0
+
+    def close(self):
+        self._file.close()
+
+
+class Shuffler(object):
+    """
+    Shuffles parallel files by permuting their lines, without writing
+    shuffled copies: the byte offsets of all lines are indexed once, and
+    each epoch reads the lines in a (seeded) random order.
+    """
+    def __init__(self, files, seed=None):
+        self.files = files
+        self.seed = seed
+        self.offsets = [line_offsets(ff) for ff in files]
+        self.n_lines = min(len(offsets) for offsets in self.offsets)
+        self._open_files = []
+
+    def open(self, epoch=0):
+        """
+        Returns file objects that read the files in the order of an epoch.
+        The file objects of the previous epoch are closed.
+        """
+        self.close()
+        order = permutation(self.n_lines, self.seed, epoch)
+        self._open_files = [PermutedFile(ff, offsets, order) for ff, offsets in zip(self.files, self.offsets)]
+        return list(self._open_files)
+
+    def close(self):
+        for f in self._open_files:
+            f.close()
+        self._open_files = []
+
 
 def main(files, temporary=False):
 
@@ -0,0 +1,115 @@
+'''
+Building padded minibatches (word ids and masks) from lists of sentences
+'''
+
+import itertools
+
+import numpy
+
+
+class BatchBuffers(object):
+    """
+    Preallocated arrays that are reused for consecutive minibatches. The
+    arrays returned for one minibatch are overwritten by the next one, so
+    only use this if a minibatch is no longer needed when the next one is
+    prepared.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def zeros(self, name, shape, dtype):
+        """
+        Returns a zero-filled, C-contiguous view of shape `shape` of the
+        buffer `name`; the buffer grows if it is too small.
+        """
+        size = int(numpy.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.size < size or buf.dtype != numpy.dtype(dtype):
+            buf = numpy.empty(size, dtype=dtype)
+            self._buffers[name] = buf
+        array = buf[:size].reshape(shape)
+        array.fill(0)
+        return array
+
+
+def _zeros(shape, dtype, buffers, name):
+    if buffers is None:
+        return numpy.zeros(shape, dtype=dtype)
+    return buffers.zeros(name, shape, dtype)
+
+
+def flatten(seqs, lengths, n_factors=None):
+    """
+    Concatenates a list of sentences into a flat array of word ids
+    (total_length,) or, if words are lists of factors, (total_length, n_factors).
+    """
+    total = int(lengths.sum())
+    words = itertools.chain.from_iterable(seqs)
+    if n_factors is None:
+        return numpy.fromiter(words, dtype='int64', count=total)
+    ids = numpy.fromiter(itertools.chain.from_iterable(words), dtype='int64', count=total*n_factors)
+    return ids.reshape((total, n_factors))
+
+
+def pad(ids, lengths, mask_dtype, n_factors=None, buffers=None, name='x'):
+    """
+    Scatters a flat array of word ids (see flatten) into a zero-padded
+    array of shape (n_factors, max_length+1, n_samples), or
+    (max_length+1, n_samples) without factors, and builds the mask (which
+    includes the end-of-sentence position).
+    """
+    n_samples = len(lengths)
+    maxlen = int(lengths.max()) + 1
+    # position of each token in the padded array
+    starts = numpy.cumsum(lengths) - lengths
+    rows = numpy.arange(len(ids)) - numpy.repeat(starts, lengths)
+    cols = numpy.repeat(numpy.arange(n_samples), lengths)
+
+    if n_factors is None:
+        x = _zeros((maxlen, n_samples), 'int64', buffers, name)
+        x[rows, cols] = ids
+    else:
+        x = _zeros((n_factors, maxlen, n_samples), 'int64', buffers, name)
+        x[:, rows, cols] = ids.T
+    x_mask = _zeros((maxlen, n_samples), mask_dtype, buffers, name + '_mask')
+    x_mask[numpy.arange(maxlen)[:, None] <= lengths[None, :]] = 1.
+    return x, x_mask
+
+
+def prepare_batch(sources, target, weights=None, maxlen=None, n_factors=1,
+                  mask_dtype='float32', buffers=None):
+    """
+    Pads a minibatch of sentence pairs with one or more source sides
+    (a list of lists of sentences, whose words are lists of factors).
+
+    Sentence pairs with a side of maxlen or more tokens are removed, as are
+    their weights. Returns None if no sentence pair is left, otherwise
+    a list of (x, x_mask) for each source side, (y, y_mask), the weights
+    and the list of source lengths.
+    """
+    source_lengths = [numpy.fromiter(itertools.imap(len, seqs), dtype='int64', count=len(seqs))
+                      for seqs in sources]
+    target_lengths = numpy.fromiter(itertools.imap(len, target), dtype='int64', count=len(target))
+
+    if maxlen is not None:
+        keep = target_lengths < maxlen
+        for lengths in source_lengths:
+            keep &= lengths < maxlen
+        if not keep.any():
+            return None
+        if not keep.all():
+            indices = numpy.flatnonzero(keep)
+            sources = [[seqs[i] for i in indices] for seqs in sources]
+            target = [target[i] for i in indices]
+            if weights is not None:
+                weights = [weights[i] for i in indices]
+            source_lengths = [lengths[keep] for lengths in source_lengths]
+            target_lengths = target_lengths[keep]
+
+    xs = []
+    for i, (seqs, lengths) in enumerate(zip(sources, source_lengths)):
+        ids = flatten(seqs, lengths, n_factors)
+        xs.append(pad(ids, lengths, mask_dtype, n_factors, buffers, name='x{0}'.format(i)))
+    y = pad(flatten(target, target_lengths), target_lengths, mask_dtype, buffers=buffers, name='y')
+
+    return xs, y, weights, source_lengths
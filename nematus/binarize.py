@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Converts a parallel training corpus into a binarized format that can be
+memory-mapped by BinaryTextIterator (see data_iterator.py), so that text is
+only split and mapped to word ids once, instead of in every epoch.
+
+Each side of the corpus is stored in three numpy files:
+    <prefix>.ids.npy: int32 word ids, one row per token, one column per factor
+    <prefix>.offsets.npy: int64 position of the first token of each sentence
+    <prefix>.lengths.npy: int32 number of tokens in each sentence
+
+Word ids are not clipped to the vocabulary size; this is done by the
+iterator (n_words_source, n_words_target).
+'''
+
+import sys
+import argparse
+import logging
+
+import numpy
+
+from data_iterator import fopen
+from util import load_dict
+
+
+def count_tokens(filename):
+    n_lines = 0
+    n_tokens = 0
+    with fopen(filename, 'r') as f:
+        for line in f:
+            n_lines += 1
+            n_tokens += len(line.split())
+    return n_lines, n_tokens
+
+
+def binarize(filename, dictionaries, prefix):
+    """
+    Binarizes one side of a corpus; with more than one dictionary, words
+    are split into factors (w|f1|f2).
+    """
+    dictionaries = [load_dict(dictionary) for dictionary in dictionaries]
+    factors = len(dictionaries)
+
+    n_lines, n_tokens = count_tokens(filename)
+    logging.info('{0}: {1} sentences, {2} tokens'.format(filename, n_lines, n_tokens))
+
+    ids = numpy.lib.format.open_memmap(prefix + '.ids.npy', mode='w+', dtype='int32', shape=(n_tokens, factors))
+    offsets = numpy.zeros(n_lines, dtype='int64')
+    lengths = numpy.zeros(n_lines, dtype='int32')
+
+    position = 0
+    with fopen(filename, 'r') as f:
+        for idx, line in enumerate(f):
+            words = line.split()
+            if factors > 1:
+                words = [w.split('|') for w in words]
+                for w in words:
+                    if len(w) != factors:
+                        logging.error('{0}, line {1}: expected {2} factors, but word has {3}'.format(filename, idx+1, factors, len(w)))
+                        sys.exit(1)
+            else:
+                words = [[w] for w in words]
+            offsets[idx] = position
+            lengths[idx] = len(words)
+            if words:
+                ids[position:position+len(words)] = [[dictionaries[i].get(f, 1) for (i, f) in enumerate(w)] for w in words]
+            position += len(words)
+
+    ids.flush()
+    del ids
+    numpy.save(prefix + '.offsets.npy', offsets)
+    numpy.save(prefix + '.lengths.npy', lengths)
+
+
+def main(datasets, dictionaries, factors, output):
+    if output is None:
+        output = [dataset + '.bin' for dataset in datasets]
+    source_dictionaries = dictionaries[:-1]
+    if factors == 1:
+        source_dictionaries = source_dictionaries[:1]
+    binarize(datasets[0], source_dictionaries, output[0])
+    binarize(datasets[1], dictionaries[-1:], output[1])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datasets', type=str, required=True, metavar='PATH', nargs=2,
+                        help="parallel training corpus (source and target)")
+    parser.add_argument('--dictionaries', type=str, required=True, metavar='PATH', nargs="+",
+                        help="network vocabularies (one per source factor, plus target vocabulary)")
+    parser.add_argument('--factors', type=int, default=1, metavar='INT',
+                        help="number of input factors (default: %(default)s)")
+    parser.add_argument('--output', type=str, default=None, metavar='PREFIX', nargs=2,
+                        help="output prefixes for source and target (default: <dataset>.bin)")
+    args = parser.parse_args()
+    main(args.datasets, args.dictionaries, args.factors, args.output)
@@ -0,0 +1,127 @@
+'''
+Writes training checkpoints in a background thread.
+
+Training only takes a snapshot of the parameters (see `unzip_from_theano`)
+and continues while the snapshot is converted and written to disk. Files
+are written atomically (see `util.write_atomic`).
+'''
+
+import os
+import copy
+import time
+import Queue
+import logging
+import threading
+
+import numpy
+
+from util import write_atomic
+from theano_util import npz_filename, to_file_float_type
+
+
+class CheckpointWriter(object):
+    """
+    Background writer for the checkpoints of `theano_util.save`. Checkpoints
+    are written in the order in which they are submitted; if `max_pending`
+    checkpoints are waiting to be written, `save` blocks until the oldest is
+    done (so that snapshots do not pile up in memory).
+    """
+    def __init__(self, file_float_type='float32', max_pending=2):
+        self._file_float_type = file_float_type
+        self._jobs = Queue.Queue(maxsize=max_pending)
+        self._error = None
+        self.blocked_time = 0.
+        self.write_time = 0.
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, model_params, optimizer_params, training_progress, base_filenames,
+             write_params=True):
+        """
+        Writes the same checkpoint to each of @param base_filenames (the
+        parameters are written once, and linked or copied to the other
+        files). If @param write_params is False, the parameters are assumed
+        to be unchanged since the checkpoint was last written to these
+        files, and only the training progress is updated.
+        """
+        self._check_error()
+        start_time = time.time()
+        progress = copy.deepcopy(training_progress)
+        self._jobs.put((list(base_filenames), model_params, optimizer_params, progress, write_params))
+        self.blocked_time += time.time() - start_time
+
+    def wait(self):
+        """
+        Blocks until all checkpoints have been written.
+        """
+        start_time = time.time()
+        self._jobs.join()
+        self.blocked_time += time.time() - start_time
+        self._check_error()
+
+    def close(self):
+        self.wait()
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+            try:
+                start_time = time.time()
+                self._write(*job)
+                self.write_time += time.time() - start_time
+                logging.info('Wrote checkpoint {0} in {1:.1f}s'.format(
+                    ', '.join(job[0]), time.time() - start_time))
+            except Exception as e:
+                logging.error('Could not write checkpoint {0}: {1}'.format(', '.join(job[0]), e))
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _write(self, base_filenames, model_params, optimizer_params, progress, write_params):
+        if write_params:
+            for suffix, params in (('', model_params), ('.gradinfo', optimizer_params)):
+                params = to_file_float_type(params, self._file_float_type)
+                filenames = [npz_filename(base_filename + suffix) for base_filename in base_filenames]
+                write_atomic(filenames[0], lambda f: numpy.savez(f, **params))
+                for filename in filenames[1:]:
+                    _link_atomic(filenames[0], filename)
+        for base_filename in base_filenames:
+            progress.save_to_json(base_filename + '.progress.json')
+
+
+def _link_atomic(source, target):
+    """
+    Makes @param target a hard link of @param source (or a copy, if hard
+    links are not supported), replacing an existing target atomically.
+    Files are never modified in place after they are written, so linked
+    files stay independent.
+    """
+    tmp_target = target + '.link.tmp'
+    if os.path.exists(tmp_target):
+        os.remove(tmp_target)
+    try:
+        os.link(source, tmp_target)
+    except (OSError, AttributeError):
+        with open(source, 'rb') as f:
+            write_atomic(target, lambda out: _copy_file(f, out))
+        return
+    os.rename(tmp_target, target)
+
+
+def _copy_file(source, target, chunk_size=1 << 20):
+    while True:
+        data = source.read(chunk_size)
+        if not data:
+            break
+        target.write(data)
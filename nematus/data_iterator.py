@@ -1,6 +1,10 @@
 import numpy
 
 import gzip
+import time
+import traceback
+
+from multiprocessing import Process, Queue
 
 import shuffle
 from util import load_dict
@@ -11,7 +15,18 @@ def fopen(filename, mode='r'):
     return open(filename, mode)
 
 class TextIterator:
-    """Simple Bitext iterator."""
+    """Simple Bitext iterator.
+
+    With token_batch_size, minibatches are filled until the number of source
+    or target tokens (including padding) would exceed token_batch_size, and
+    batch_size only determines the number of sentences that are sorted by
+    length (batch_size * maxibatch_size). With maxibatch_size 0, the whole
+    corpus is read and sorted at once.
+
+    With return_indices, each minibatch is returned with the line numbers of
+    its sentence pairs (in reading order), so that the original order can be
+    restored after sorting by length.
+    """
     def __init__(self, source, target,
                  source_dicts, target_dict,
                  batch_size=128,
@@ -23,11 +38,15 @@ class TextIterator:
                  sort_by_length=True,
                  use_factor=False,
                  maxibatch_size=20,
-                 multi_src=False):
+                 multi_src=False,
+                 shuffle_seed=None,
+                 epoch=0,
+                 token_batch_size=0,
+                 return_indices=False):
+        self.epoch = epoch
         if shuffle_each_epoch:
-            self.source_orig = source
-            self.target_orig = target
-            self.source, self.target = shuffle.main([self.source_orig, self.target_orig], temporary=True)
+            self.shuffler = shuffle.Shuffler([source, target], seed=shuffle_seed)
+            self.source, self.target = self.shuffler.open(self.epoch)
         else:
             self.source = fopen(source, 'r')
             self.target = fopen(target, 'r')
@@ -37,6 +56,7 @@ class TextIterator:
         self.target_dict = load_dict(target_dict)
 
         self.batch_size = batch_size
+        self.token_batch_size = token_batch_size
         self.maxlen = maxlen
         self.skip_empty = skip_empty
         self.use_factor = use_factor
@@ -57,9 +77,12 @@ class TextIterator:
 
         self.shuffle = shuffle_each_epoch
         self.sort_by_length = sort_by_length
+        self.return_indices = return_indices
 
         self.source_buffer = []
         self.target_buffer = []
+        self.index_buffer = []
+        self.line = 0
         self.k = batch_size * maxibatch_size
         
 
@@ -69,11 +92,18 @@ class TextIterator:
         return self
 
     def __len__(self):
-        return sum([1 for _ in self])
+        # counting does not count as an epoch
+        epoch = self.epoch
+        length = sum([1 for _ in self])
+        self.epoch = epoch - 1
+        self.reset()
+        return length
     
     def reset(self):
+        self.epoch += 1
+        self.line = 0
         if self.shuffle:
-            self.source, self.target = shuffle.main([self.source_orig, self.target_orig], temporary=True)
+            self.source, self.target = self.shuffler.open(self.epoch)
         else:
             self.source.seek(0)
             self.target.seek(0)
@@ -86,6 +116,9 @@ class TextIterator:
 
         source = []
         target = []
+        indices = []
+        longest_source = 0
+        longest_target = 0
 
         # fill buffer, if it's empty
         assert len(self.source_buffer) == len(self.target_buffer), 'Buffer size mismatch!'
@@ -94,6 +127,7 @@ class TextIterator:
             for ss in self.source:
                 ss = ss.split()
                 tt = self.target.readline().split()
+                self.line += 1
                 
                 if self.skip_empty and (len(ss) == 0 or len(tt) == 0):
                     continue
@@ -102,6 +136,7 @@ class TextIterator:
 
                 self.source_buffer.append(ss)
                 self.target_buffer.append(tt)
+                self.index_buffer.append(self.line - 1)
                 if len(self.source_buffer) == self.k:
                     break
 
@@ -117,13 +152,16 @@ class TextIterator:
 
                 _sbuf = [self.source_buffer[i] for i in tidx]
                 _tbuf = [self.target_buffer[i] for i in tidx]
+                _ibuf = [self.index_buffer[i] for i in tidx]
 
                 self.source_buffer = _sbuf
                 self.target_buffer = _tbuf
+                self.index_buffer = _ibuf
 
             else:
                 self.source_buffer.reverse()
                 self.target_buffer.reverse()
+                self.index_buffer.reverse()
 
 
         try:
@@ -132,11 +170,11 @@ class TextIterator:
 
                 # read from source file and map to word index
                 try:
-                    ss = self.source_buffer.pop()
+                    ss_raw = self.source_buffer.pop()
                 except IndexError:
                     break
                 tmp = []
-                for w in ss:
+                for w in ss_raw:
                     if self.use_factor:
                         w = [self.source_dicts[i][f] if f in self.source_dicts[i] else 1 for (i,f) in enumerate(w.split('|'))]
                     else:
@@ -145,21 +183,167 @@ class TextIterator:
                 ss = tmp
 
                 # read from source file and map to word index
-                tt = self.target_buffer.pop()
+                tt_raw = self.target_buffer.pop()
+                idx = self.index_buffer.pop()
                 tt = [self.target_dict[w] if w in self.target_dict else 1
-                      for w in tt]
+                      for w in tt_raw]
                 if self.n_words_target > 0:
                     tt = [w if w < self.n_words_target else 1 for w in tt]
 
                 source.append(ss)
                 target.append(tt)
-
-                if len(source) >= self.batch_size or \
+                indices.append(idx)
+                longest_source = max(longest_source, len(ss))
+                longest_target = max(longest_target, len(tt))
+
+                if self.token_batch_size:
+                    if len(source) > 1 and \
+                            (len(source)*longest_source > self.token_batch_size or \
+                             len(target)*longest_target > self.token_batch_size):
+                        # return the sentence pair that made the batch too long to the buffer
+                        source.pop()
+                        target.pop()
+                        indices.pop()
+                        self.source_buffer.append(ss_raw)
+                        self.target_buffer.append(tt_raw)
+                        self.index_buffer.append(idx)
+                        break
+                elif len(source) >= self.batch_size or \
                         len(target) >= self.batch_size:
                     break
         except IOError:
             self.end_of_data = True
 
+        if self.return_indices:
+            return source, target, indices
+        return source, target
+
+class BinarizedCorpus:
+    """One side of a corpus binarized with binarize.py (memory-mapped)."""
+    def __init__(self, prefix):
+        self.ids = numpy.load(prefix + '.ids.npy', mmap_mode='r')
+        self.offsets = numpy.load(prefix + '.offsets.npy')
+        self.lengths = numpy.load(prefix + '.lengths.npy')
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def get(self, indices, n_words=-1):
+        """
+        Returns the sentences with the given indices, as arrays of word ids
+        (one row per token, one column per factor). Ids that are not in the
+        vocabulary (n_words) are mapped to UNK.
+        """
+        lengths = self.lengths[indices]
+        ends = numpy.cumsum(lengths)
+        # positions of all tokens of the sentences in the ids array
+        positions = numpy.arange(ends[-1] if len(ends) else 0) + \
+                    numpy.repeat(self.offsets[indices] - (ends - lengths), lengths)
+        ids = self.ids[positions]
+        if n_words > 0:
+            ids = numpy.where(ids >= n_words, 1, ids)
+        return numpy.split(ids, ends[:-1])
+
+
+class BinaryTextIterator:
+    """Bitext iterator over binarized corpora (see binarize.py).
+
+    Behaves like TextIterator (including token_batch_size), but reads word
+    ids from memory-mapped arrays; length filtering and vocabulary clipping
+    are vectorized.
+    """
+    def __init__(self, source, target,
+                 batch_size=128,
+                 maxlen=100,
+                 n_words_source=-1,
+                 n_words_target=-1,
+                 skip_empty=False,
+                 shuffle_each_epoch=False,
+                 sort_by_length=True,
+                 maxibatch_size=20,
+                 shuffle_seed=None,
+                 epoch=0,
+                 token_batch_size=0):
+        self.source = BinarizedCorpus(source)
+        self.target = BinarizedCorpus(target)
+        assert len(self.source) == len(self.target), 'Corpus size mismatch!'
+
+        self.batch_size = batch_size
+        self.token_batch_size = token_batch_size
+        self.maxlen = maxlen
+        self.skip_empty = skip_empty
+
+        self.n_words_source = n_words_source
+        self.n_words_target = n_words_target
+
+        self.shuffle = shuffle_each_epoch
+        self.shuffle_seed = shuffle_seed
+        self.sort_by_length = sort_by_length
+
+        # sentence pairs that pass the length filters
+        keep = (self.source.lengths <= maxlen) & (self.target.lengths <= maxlen)
+        if skip_empty:
+            keep &= (self.source.lengths > 0) & (self.target.lengths > 0)
+        self.indices = numpy.flatnonzero(keep)
+
+        self.k = batch_size * maxibatch_size
+
+        self.epoch = epoch - 1
+        self.reset()
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        # counting does not count as an epoch
+        epoch = self.epoch
+        length = sum([1 for _ in self])
+        self.epoch = epoch - 1
+        self.reset()
+        return length
+
+    def reset(self):
+        self.epoch += 1
+        if self.shuffle:
+            self.order = self.indices[shuffle.permutation(len(self.indices), self.shuffle_seed, self.epoch)]
+        else:
+            self.order = self.indices
+        self.position = 0
+        # indices of the current maxibatch, in reverse order
+        self.buffer = self.order[:0]
+
+    def next(self):
+        # fill buffer, if it's empty
+        if len(self.buffer) == 0:
+            if self.position >= len(self.order):
+                self.reset()
+                raise StopIteration
+
+            buf = self.order[self.position:self.position+self.k]
+            self.position += len(buf)
+
+            # sort by target length
+            if self.sort_by_length:
+                self.buffer = buf[self.target.lengths[buf].argsort()]
+            else:
+                self.buffer = buf[::-1]
+
+        if self.token_batch_size:
+            # padded size of the batch for each possible number of sentences
+            candidates = self.buffer[::-1]
+            n = numpy.arange(1, len(candidates)+1)
+            size = numpy.maximum(n * numpy.maximum.accumulate(self.source.lengths[candidates]),
+                                 n * numpy.maximum.accumulate(self.target.lengths[candidates]))
+            batch_size = max(1, numpy.count_nonzero(size <= self.token_batch_size))
+        else:
+            batch_size = self.batch_size
+
+        batch = self.buffer[-batch_size:][::-1]
+        self.buffer = self.buffer[:-batch_size]
+
+        source = [ss.tolist() for ss in self.source.get(batch, self.n_words_source)]
+        target = [tt[:, 0].tolist() for tt in self.target.get(batch, self.n_words_target)]
+
         return source, target
 
 class MultiSrcTextIterator:
@@ -176,18 +360,18 @@ class MultiSrcTextIterator:
                  use_factor=False,
                  maxibatch_size=20,
                  align1_file=None,
-                 align2_file=None):
+                 align2_file=None,
+                 shuffle_seed=None,
+                 epoch=0):
         self.source_files = source.split(",")
+        self.epoch = epoch
         if shuffle_each_epoch:
-            self.source_orig1 = self.source_files[0]
-            self.source_orig2 = self.source_files[1]
-            self.target_orig = target
             if align1_file:
-                self.align_orig1 = align1_file
-                self.align_orig2 = align2_file
-                self.source1, self.source2, self.target, self.align1, self.align2 = shuffle.main([self.source_orig1, self.source_orig2, self.target_orig, self.align_orig1, self.align_orig2], temporary=True)
+                self.shuffler = shuffle.Shuffler([self.source_files[0], self.source_files[1], target, align1_file, align2_file], seed=shuffle_seed)
+                self.source1, self.source2, self.target, self.align1, self.align2 = self.shuffler.open(self.epoch)
             else:
-                self.source1, self.source2, self.target = shuffle.main([self.source_orig1, self.source_orig2, self.target_orig], temporary=True)
+                self.shuffler = shuffle.Shuffler([self.source_files[0], self.source_files[1], target], seed=shuffle_seed)
+                self.source1, self.source2, self.target = self.shuffler.open(self.epoch)
                 self.align1 = None
         else:
             self.source1 = fopen(self.source_files[0], 'r') 
@@ -262,14 +446,20 @@ class MultiSrcTextIterator:
         return self
 
     def __len__(self):
-        return sum([1 for _ in self])
+        # counting does not count as an epoch
+        epoch = self.epoch
+        length = sum([1 for _ in self])
+        self.epoch = epoch - 1
+        self.reset()
+        return length
     
     def reset(self):
+        self.epoch += 1
         if self.shuffle:
             if self.align1:
-                self.source1, self.source2, self.target, self.align1, self.align2 = shuffle.main([self.source_orig1, self.source_orig2, self.target_orig, self.align_orig1, self.align_orig2], temporary=True)
+                self.source1, self.source2, self.target, self.align1, self.align2 = self.shuffler.open(self.epoch)
             else:
-                self.source1, self.source2, self.target = shuffle.main([self.source_orig1, self.source_orig2, self.target_orig], temporary=True)
+                self.source1, self.source2, self.target = self.shuffler.open(self.epoch)
         else:
             self.source1.seek(0)
             self.source2.seek(0)
@@ -406,3 +596,64 @@ class MultiSrcTextIterator:
             return [source1, source2], target, align1, align2
         else:
             return [source1, source2], target, None, None
+
+
+def _prefetch(iterator, prepare, queue):
+    """
+    Worker process of PrefetchIterator: prepares batches for all epochs,
+    until it is terminated.
+    """
+    try:
+        while True:
+            for batch in iterator:
+                queue.put(('batch', prepare(*batch)))
+            queue.put(('end', None))
+    except Exception:
+        queue.put(('error', traceback.format_exc()))
+
+
+class PrefetchIterator:
+    """Wraps a data iterator, and prepares its batches in a background process.
+
+    Each batch of the wrapped iterator is passed to prepare (e.g. to pad it
+    and build masks), and up to depth prepared batches are kept in a queue.
+    End of epoch and errors in the background process are passed on to the
+    consumer. wait_time is the total time that the consumer waited for data.
+    """
+    def __init__(self, iterator, prepare, depth=10):
+        self.iterator = iterator
+        self.prepare = prepare
+        self.depth = depth
+        self.wait_time = 0.
+        self.process = None
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        assert self.process is None, 'length of PrefetchIterator is only known before the first batch'
+        return len(self.iterator)
+
+    def start(self):
+        self.queue = Queue(maxsize=self.depth)
+        self.process = Process(target=_prefetch, args=(self.iterator, self.prepare, self.queue))
+        self.process.daemon = True
+        self.process.start()
+
+    def next(self):
+        if self.process is None:
+            self.start()
+        start = time.time()
+        kind, item = self.queue.get()
+        self.wait_time += time.time() - start
+        if kind == 'end':
+            raise StopIteration
+        if kind == 'error':
+            raise RuntimeError('Error in data prefetching process:\n' + item)
+        return item
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
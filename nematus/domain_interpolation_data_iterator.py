@@ -14,7 +14,7 @@ def fopen(filename, mode='r'):
 
 
 class DomainInterpolatorTextIterator:
-    """Bitext iterator with domain interpolation."""
+    """Bitext iterator with domain interpolation (see TextIterator for token_batch_size)."""
     def __init__(self, source, target,
                  source_dicts, target_dict,
                  batch_size=128,
@@ -27,14 +27,19 @@ class DomainInterpolatorTextIterator:
                  indomain_source='', indomain_target='',
                  interpolation_rate=0.1,
                  use_factor=False,
-                 maxibatch_size=20):
+                 maxibatch_size=20,
+                 shuffle_seed=None,
+                 epoch=0,
+                 token_batch_size=0):
+        self.epoch = epoch
+        self.indomain_epoch = 0
         if shuffle_each_epoch:
-            self.source_orig = source
-            self.target_orig = target
-            self.source, self.target = shuffle.main([self.source_orig, self.target_orig], temporary=True)
-            self.indomain_source_orig = indomain_source
-            self.indomain_target_orig = indomain_target
-            self.indomain_source, self.indomain_target = shuffle.main([self.indomain_source_orig, self.indomain_target_orig], temporary=True)
+            self.shuffler = shuffle.Shuffler([source, target], seed=shuffle_seed)
+            self.source, self.target = self.shuffler.open(self.epoch)
+            # the in-domain corpus is shuffled independently of the out-of-domain corpus
+            indomain_seed = None if shuffle_seed is None else shuffle_seed + 1
+            self.indomain_shuffler = shuffle.Shuffler([indomain_source, indomain_target], seed=indomain_seed)
+            self.indomain_source, self.indomain_target = self.indomain_shuffler.open(self.indomain_epoch)
         else:
             self.source = fopen(source, 'r')
             self.target = fopen(target, 'r')
@@ -46,6 +51,7 @@ class DomainInterpolatorTextIterator:
         self.target_dict = load_dict(target_dict)
 
         self.batch_size = batch_size
+        self.token_batch_size = token_batch_size
         self.maxlen = maxlen
         self.skip_empty = skip_empty
         self.use_factor = use_factor
@@ -82,15 +88,17 @@ class DomainInterpolatorTextIterator:
         return self
 
     def reset(self):
+        self.epoch += 1
         if self.shuffle:
-            self.source, self.target = shuffle.main([self.source_orig, self.target_orig], temporary=True)
+            self.source, self.target = self.shuffler.open(self.epoch)
         else:
             self.source.seek(0)
             self.target.seek(0)
 
     def indomain_reset(self):
+        self.indomain_epoch += 1
         if self.shuffle:
-            self.indomain_source, self.indomain_target = shuffle.main([self.indomain_source_orig, self.indomain_target_orig], temporary=True)
+            self.indomain_source, self.indomain_target = self.indomain_shuffler.open(self.indomain_epoch)
         else:
             self.indomain_source.seek(0)
             self.indomain_target.seek(0)
@@ -112,6 +120,8 @@ class DomainInterpolatorTextIterator:
 
         source = []
         target = []
+        longest_source = 0
+        longest_target = 0
 
         # fill buffer, if it's empty
         assert len(self.source_buffer) == len(self.target_buffer), 'Buffer size mismatch!'
@@ -166,11 +176,11 @@ class DomainInterpolatorTextIterator:
 
                 # read from source file and map to word index
                 try:
-                    ss = self.source_buffer.pop()
+                    ss_raw = self.source_buffer.pop()
                 except IndexError:
                     break
                 tmp = []
-                for w in ss:
+                for w in ss_raw:
                     if self.use_factor:
                         w = [self.source_dicts[i][f] if f in self.source_dicts[i] else 1 for (i,f) in enumerate(w.split('|'))]
                     else:
@@ -179,9 +189,9 @@ class DomainInterpolatorTextIterator:
                 ss = tmp
 
                 # read from source file and map to word index
-                tt = self.target_buffer.pop()
+                tt_raw = self.target_buffer.pop()
                 tt = [self.target_dict[w] if w in self.target_dict else 1
-                      for w in tt]
+                      for w in tt_raw]
                 if self.n_words_target > 0:
                     tt = [w if w < self.n_words_target else 1 for w in tt]
 
@@ -192,8 +202,20 @@ class DomainInterpolatorTextIterator:
 
                 source.append(ss)
                 target.append(tt)
-
-                if len(source) >= self.batch_size or \
+                longest_source = max(longest_source, len(ss))
+                longest_target = max(longest_target, len(tt))
+
+                if self.token_batch_size:
+                    if len(source) > 1 and \
+                            (len(source)*longest_source > self.token_batch_size or \
+                             len(target)*longest_target > self.token_batch_size):
+                        # return the sentence pair that made the batch too long to the buffer
+                        source.pop()
+                        target.pop()
+                        self.source_buffer.append(ss_raw)
+                        self.target_buffer.append(tt_raw)
+                        break
+                elif len(source) >= self.batch_size or \
                         len(target) >= self.batch_size:
                     break
         except IOError:
@@ -0,0 +1,149 @@
+'''
+Persistent cache of compiled Theano functions.
+
+Building and optimizing the graphs of a model takes much longer than
+loading its parameters. Compiled functions are pickled to a cache
+directory, and later processes with the same model configuration load
+them instead of building them again (Theano does not re-optimize
+unpickled functions, see `reoptimize_unpickled_function`).
+
+Model parameters are not stored in the cache: their values are replaced
+by empty arrays while pickling, and the shared variables of the loaded
+functions are bound to the parameters of the current model.
+
+Entries are keyed by the function name and arguments, the model options,
+floatX and other Theano flags that affect compilation, the Theano version
+and the source code of nematus, so any change to these leads to a new
+entry. Entries that cannot be loaded are rebuilt.
+'''
+
+import os
+import sys
+import glob
+import json
+import hashlib
+import logging
+import tempfile
+import cPickle as pkl
+
+import numpy
+import theano
+
+_code_version = None
+
+
+def code_version():
+    """
+    Hash of the source files of nematus.
+    """
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha1()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(directory, '*.py'))):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+
+def cache_key(name, options, **kwargs):
+    config = theano.config
+    key = {'name': name,
+           'options': options,
+           'args': kwargs,
+           'floatX': config.floatX,
+           'device': config.device,
+           'mode': str(config.mode),
+           'linker': config.linker,
+           'optimizer': config.optimizer,
+           'optimizer_including': config.optimizer_including,
+           'optimizer_excluding': config.optimizer_excluding,
+           'theano': theano.__version__,
+           'code': code_version()}
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+def _param_variables(functions, tparams):
+    # shared variables of the functions that hold model parameters
+    variables = {}
+    for f in functions:
+        for variable in f.get_shared():
+            if variable.name in tparams:
+                variables[variable.name] = variable
+    return variables
+
+
+def save(path, functions, tparams):
+    """
+    Pickles compiled functions without the values of the model parameters.
+    """
+    variables = _param_variables(functions, tparams)
+    values = {}
+    for name, variable in variables.iteritems():
+        values[name] = variable.get_value(borrow=True)
+        variable.set_value(numpy.zeros((0,) * values[name].ndim, dtype=values[name].dtype))
+    try:
+        # write to a temporary file first, so that concurrent processes
+        # never read an incomplete entry
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                pkl.dump(functions, f, protocol=pkl.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+    finally:
+        for name, variable in variables.iteritems():
+            variable.set_value(values[name], borrow=True)
+
+
+def load(path, tparams):
+    """
+    Loads pickled functions, and binds them to the model parameters. The
+    shared variables in tparams are replaced by those of the functions.
+    """
+    with open(path, 'rb') as f:
+        functions = pkl.load(f)
+    variables = _param_variables(functions, tparams)
+    for name, variable in variables.iteritems():
+        variable.set_value(tparams[name].get_value(borrow=True), borrow=True)
+        tparams[name] = variable
+    return functions
+
+
+def cached_functions(cache_dir, name, options, tparams, build, **kwargs):
+    """
+    Returns the functions built by `build` (a tuple), and caches them in
+    cache_dir. `kwargs` are the arguments of `build` that change the
+    functions (besides the model options).
+    """
+    if not cache_dir:
+        return build()
+
+    # pickling deep graphs needs a lot of recursion
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+
+    path = os.path.join(cache_dir, '{0}.{1}.pkl'.format(name, cache_key(name, options, **kwargs)))
+    if os.path.exists(path):
+        try:
+            functions = load(path, tparams)
+            logging.debug('Loaded compiled functions from {0}'.format(path))
+            return functions
+        except Exception as e:
+            logging.warning('Could not load compiled functions from {0} ({1}); rebuilding them'.format(path, e))
+
+    functions = build()
+    try:
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # the directory exists, or was created by another process
+            if not os.path.isdir(cache_dir):
+                raise
+        save(path, functions, tparams)
+        logging.debug('Saved compiled functions to {0}'.format(path))
+    except Exception as e:
+        logging.warning('Could not save compiled functions to {0} ({1})'.format(path, e))
+    return functions
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Uncompressed model format that can be memory-mapped.
+
+A model is stored as a single file of raw arrays (each aligned to
+ALIGNMENT bytes), plus a JSON index (<model>.index.json) with the dtype,
+shape and offset of each array. Model and optimizer parameters are indexed
+separately, so that loading a model for translation or scoring never reads
+the optimizer state. Opening a model only maps the file; parameters are
+read from disk when they are first accessed, and the page cache is shared
+by all processes that use the same model.
+
+Convert an existing model (and its optimizer parameters in
+<model>.gradinfo.npz, if present) with:
+
+    python mmap_model.py model.npz model.mmap
+'''
+
+import os
+import json
+import shutil
+import logging
+import argparse
+
+import numpy
+
+ALIGNMENT = 64
+INDEX_SUFFIX = '.index.json'
+
+
+def is_mmap_model(path):
+    return os.path.exists(path + INDEX_SUFFIX)
+
+
+class MmapModel(object):
+    """
+    Read-only, dict-like access to a model in the memory-mapped format,
+    with the same interface as the NpzFile returned by `numpy.load`.
+    `files` lists the model parameters only, `optimizer_files` the
+    optimizer parameters; iterating yields both.
+    """
+    def __init__(self, path):
+        with open(path + INDEX_SUFFIX, 'rb') as f:
+            index = json.load(f)
+        self._path = path
+        self._params = index['params']
+        self._optimizer_params = index['optimizer_params']
+        self.files = [str(key) for key in self._params]
+        self.optimizer_files = [str(key) for key in self._optimizer_params]
+
+    def _get_entry(self, key):
+        if key in self._params:
+            return self._params[key]
+        return self._optimizer_params[key]
+
+    def __contains__(self, key):
+        return key in self._params or key in self._optimizer_params
+
+    def __iter__(self):
+        return iter(self.files + self.optimizer_files)
+
+    def __getitem__(self, key):
+        entry = self._get_entry(key)
+        shape = tuple(entry['shape'])
+        if numpy.prod(shape) == 0:
+            return numpy.zeros(shape, dtype=entry['dtype'])
+        # numpy.memmap does not support zero-dimensional arrays
+        return numpy.memmap(self._path, dtype=entry['dtype'], mode='r',
+                            offset=entry['offset'], shape=shape or (1,)).reshape(shape)
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def close(self):
+        pass
+
+
+def load(path):
+    """
+    Opens a model in the memory-mapped format or as a numpy archive
+    (with or without the .npz extension).
+    """
+    if is_mmap_model(path):
+        return MmapModel(path)
+    try:
+        return numpy.load(path)
+    except IOError:
+        return numpy.load(path + '.npz')
+
+
+def save(path, model_params, optimizer_params={}):
+    """
+    Writes model and optimizer parameters (dicts of arrays) in the
+    memory-mapped format.
+    """
+    index = {'params': {}, 'optimizer_params': {}}
+    offset = 0
+    with open(path, 'wb') as f:
+        for section, params in (('params', model_params),
+                                ('optimizer_params', optimizer_params)):
+            for key in sorted(params):
+                value = numpy.asarray(params[key])
+                offset += -offset % ALIGNMENT
+                f.seek(offset)
+                f.write(value.tostring())
+                index[section][key] = {'dtype': value.dtype.str,
+                                       'shape': value.shape,
+                                       'offset': offset}
+                offset += value.nbytes
+        f.truncate(offset)
+    with open(path + INDEX_SUFFIX, 'wb') as f:
+        json.dump(index, f, indent=2)
+
+
+def convert(source, target):
+    """
+    Converts a model saved by nmt.py (with optimizer parameters and
+    config files next to it) to the memory-mapped format.
+    """
+    model_archive = load(source)
+    model_params = dict((key, model_archive[key]) for key in model_archive.files
+                        if key != 'zipped_params')
+    optimizer_params = {}
+    for gradinfo in (source + '.gradinfo', source + '.gradinfo.npz'):
+        if os.path.exists(gradinfo):
+            optimizer_archive = load(gradinfo)
+            optimizer_params = dict((key, optimizer_archive[key]) for key in optimizer_archive.files)
+            break
+    # older models store optimizer parameters in the model archive
+    for key in model_params.keys():
+        if key.startswith('adam_'):
+            optimizer_params[key] = model_params.pop(key)
+
+    logging.info('Writing {0} model and {1} optimizer parameters to {2}'.format(
+        len(model_params), len(optimizer_params), target))
+    save(target, model_params, optimizer_params)
+
+    for suffix in ('.json', '.progress.json'):
+        if os.path.exists(source + suffix):
+            shutil.copyfile(source + suffix, target + suffix)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', metavar='MODEL', help="model to convert (.npz)")
+    parser.add_argument('target', metavar='OUTPUT', help="path of the converted model")
+    args = parser.parse_args()
+    convert(args.source, args.target)
@@ -18,18 +18,23 @@ import time
 import logging
 
 import itertools
+import Queue
 
 from subprocess import Popen
 
 from collections import OrderedDict
+from multiprocessing import Process, Queue as ProcessQueue
 
 import util
 from settings import TranslationSettings
 import subprocess
 profile = False
 
-from data_iterator import TextIterator, MultiSrcTextIterator
+from data_iterator import TextIterator, MultiSrcTextIterator, BinaryTextIterator, PrefetchIterator
+from batch_util import BatchBuffers, prepare_batch, flatten, pad
 from training_progress import TrainingProgress
+from checkpoint_writer import CheckpointWriter
+from parallel_training import DataParallelTrainer
 from util import *
 from theano_util import *
 from alignment_util import *
@@ -44,114 +49,40 @@ from domain_interpolation_data_iterator import DomainInterpolatorTextIterator
 
 # batch preparation
 def prepare_data_multi_src(seqs_x1, seqs_x2, seqs_y, weights=None, maxlen=None, n_words_src=30000,
-                 n_words=30000, n_factors=1):
+                 n_words=30000, n_factors=1, buffers=None):
     # x: a list of sentences
-    lengths_x1 = [len(s) for s in seqs_x1]
-    lengths_x2 = [len(s) for s in seqs_x2]
-    lengths_y = [len(s) for s in seqs_y]
-
-    if maxlen is not None:
-        new_seqs_x1 = []
-        new_seqs_x2 = []
-        new_seqs_y = []
-        new_lengths_x1 = []
-        new_lengths_x2 = []
-        new_lengths_y = []
-        new_weights = []
-        if weights is None:
-            weights = [None] * len(seqs_y) # to make the zip easier
-        for l_x1, s_x1, l_x2, s_x2, l_y, s_y, w in zip(lengths_x, seqs_x, lengths_x2, seqs_x2, lengths_y, seqs_y, weights):
-            if l_x < maxlen and l_y < maxlen:
-                new_seqs_x1.append(s_x1)
-                new_seqs_x2.append(s_x2)
-                new_lengths_x1.append(l_x1)
-                new_lengths_x2.append(l_x2)
-                new_seqs_y.append(s_y)
-                new_lengths_y.append(l_y)
-                new_weights.append(w)
-        lengths_x1 = new_lengths_x1
-        seqs_x1 = new_seqs_x1
-        lengths_x2 = new_lengths_x2
-        seqs_x2 = new_seqs_x2
-        lengths_y = new_lengths_y
-        seqs_y = new_seqs_y
-        weights = new_weights
-
-        if len(lengths_x1) < 1 or len(lengths_x2) < 1 or len(lengths_y) < 1:
-            if weights is not None:
-                return None, None, None, None, None
-            else:
-                return None, None, None, None
-
-    n_samples = len(seqs_x)
-    maxlen_x1 = numpy.max(lengths_x1) + 1
-    maxlen_x2 = numpy.max(lengths_x2) + 1
-    maxlen_y = numpy.max(lengths_y) + 1
-
-    x1 = numpy.zeros((n_factors, maxlen_x1, n_samples)).astype('int64')
-    x2 = numpy.zeros((n_factors, maxlen_x2, n_samples)).astype('int64')
-    y = numpy.zeros((maxlen_y, n_samples)).astype('int64')
-    x1_mask = numpy.zeros((maxlen_x1, n_samples)).astype(floatX)
-    x2_mask = numpy.zeros((maxlen_x2, n_samples)).astype(floatX)
-    y_mask = numpy.zeros((maxlen_y, n_samples)).astype(floatX)
-    for idx, [s_x1, s_x2, s_y] in enumerate(zip(seqs_x1, seqs_x2, seqs_y)):
-        x1[:, :lengths_x1[idx], idx] = zip(*s_x1)
-        x1_mask[:lengths_x1[idx]+1, idx] = 1.
-        x2[:, :lengths_x2[idx], idx] = zip(*s_x1)
-        x2_mask[:lengths_x2[idx]+1, idx] = 1.
-        y[:lengths_y[idx], idx] = s_y
-        y_mask[:lengths_y[idx]+1, idx] = 1.
+    if maxlen is not None and weights is None:
+        weights = [None] * len(seqs_y) # to keep the number of return values
+    batch = prepare_batch([seqs_x1, seqs_x2], seqs_y, weights=weights, maxlen=maxlen,
+                          n_factors=n_factors, mask_dtype=floatX, buffers=buffers)
+    if batch is None:
+        if weights is not None:
+            return None, None, None, None, None
+        else:
+            return None, None, None, None
+
+    [(x1, x1_mask), (x2, x2_mask)], (y, y_mask), weights, _ = batch
     if weights is not None:
         return x1, x1_mask, x2, x2_mask, y, y_mask, weights
     else:
         return x1, x1_mask, x2, x2_mask, y, y_mask
 
 def prepare_data(seqs_x, seqs_y, weights=None, maxlen=None, n_words_src=30000,
-                 n_words=30000, n_factors=1):
+                 n_words=30000, n_factors=1, buffers=None):
     # x: a list of sentences
-    lengths_x = [len(s) for s in seqs_x]
-    lengths_y = [len(s) for s in seqs_y]
-
-    if maxlen is not None:
-        new_seqs_x = []
-        new_seqs_y = []
-        new_lengths_x = []
-        new_lengths_y = []
-        new_weights = []
-        if weights is None:
-            weights = [None] * len(seqs_y) # to make the zip easier
-        for l_x, s_x, l_y, s_y, w in zip(lengths_x, seqs_x, lengths_y, seqs_y, weights):
-            if l_x < maxlen and l_y < maxlen:
-                new_seqs_x.append(s_x)
-                new_lengths_x.append(l_x)
-                new_seqs_y.append(s_y)
-                new_lengths_y.append(l_y)
-                new_weights.append(w)
-        lengths_x = new_lengths_x
-        seqs_x = new_seqs_x
-        lengths_y = new_lengths_y
-        seqs_y = new_seqs_y
-        weights = new_weights
-
-        if len(lengths_x) < 1 or len(lengths_y) < 1:
-            if weights is not None:
-                return None, None, None, None, None
-            else:
-                return None, None, None, None
-
-    n_samples = len(seqs_x)
-    maxlen_x = numpy.max(lengths_x) + 1
-    maxlen_y = numpy.max(lengths_y) + 1
-
-    x = numpy.zeros((n_factors, maxlen_x, n_samples)).astype('int64')
-    y = numpy.zeros((maxlen_y, n_samples)).astype('int64')
-    x_mask = numpy.zeros((maxlen_x, n_samples)).astype(floatX)
-    y_mask = numpy.zeros((maxlen_y, n_samples)).astype(floatX)
-    for idx, [s_x, s_y] in enumerate(zip(seqs_x, seqs_y)):
-        x[:, :lengths_x[idx], idx] = zip(*s_x)
-        x_mask[:lengths_x[idx]+1, idx] = 1.
-        y[:lengths_y[idx], idx] = s_y
-        y_mask[:lengths_y[idx]+1, idx] = 1.
+    # with buffers (batch_util.BatchBuffers), the returned arrays are
+    # overwritten by the next call
+    if maxlen is not None and weights is None:
+        weights = [None] * len(seqs_y) # to keep the number of return values
+    batch = prepare_batch([seqs_x], seqs_y, weights=weights, maxlen=maxlen,
+                          n_factors=n_factors, mask_dtype=floatX, buffers=buffers)
+    if batch is None:
+        if weights is not None:
+            return None, None, None, None, None
+        else:
+            return None, None, None, None
+
+    [(x, x_mask)], (y, y_mask), weights, _ = batch
     if weights is not None:
         return x, x_mask, y, y_mask, weights
     else:
@@ -391,7 +322,8 @@ def build_encoder(tparams, options, dropout, x_mask=None, sampling=False):
 
 
 # RNN decoder (including embedding and feedforward layer before output)
-def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_mask=None, sampling=False, pctx_=None, shared_vars=None, lm_init_state=None):
+# with a shortlist (vector of target word ids), logits are only computed for these words
+def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_mask=None, sampling=False, pctx_=None, shared_vars=None, lm_init_state=None, shortlist=None):
     opt_ret = dict()
 
     # tell RNN whether to advance just one step at a time (for sampling),
@@ -578,9 +510,17 @@ def build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_
 
     # last layer
     logit_W = tparams['Wemb' + decoder_embedding_suffix].T if options['tie_decoder_embeddings'] else None
+    logit_b = None
+    if shortlist is not None:
+        # only gather the output embeddings of the shortlisted words
+        if logit_W is None:
+            logit_W = tparams[pp('ff_logit', 'W')][:, shortlist]
+        else:
+            logit_W = tparams['Wemb' + decoder_embedding_suffix][shortlist].T
+        logit_b = tparams[pp('ff_logit', 'b')][shortlist]
     logit = get_layer_constr('ff')(tparams, logit, options, dropout,
                             dropout_probability=options['dropout_hidden'],
-                            prefix='ff_logit', activ='linear', W=logit_W, followed_by_softmax=True)
+                            prefix='ff_logit', activ='linear', W=logit_W, b=logit_b, followed_by_softmax=True)
 
     return logit, opt_ret, ret_state, lm_ret_state
 
@@ -638,15 +578,29 @@ def build_model(tparams, options):
 
 
 # build a sampler
-def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
+# with batched=True, f_init and f_next take an additional source mask, so that
+# several (padded) source sentences can be decoded at once (see gen_sample_batch)
+# with shortlist=True, f_next takes a (sorted) vector of target word ids as last
+# input, and only computes the output distribution over these words; next_probs
+# is indexed by position in the shortlist, next_sample is a word id
+def build_sampler(tparams, options, use_noise, trng, return_alignment=False, batched=False, shortlist=False):
 
     dropout = dropout_constr(options, use_noise, trng, sampling=True)
 
-    x, ctx = build_encoder(tparams, options, dropout, x_mask=None, sampling=True)
+    if batched:
+        x_mask = tensor.matrix('x_mask', dtype=floatX)
+        x_mask.tag.test_value = numpy.ones(shape=(5, 10)).astype(floatX)
+    else:
+        x_mask = None
+
+    x, ctx = build_encoder(tparams, options, dropout, x_mask=x_mask, sampling=True)
     n_samples = x.shape[2]
 
     # get the input for decoder rnn initializer mlp
-    ctx_mean = ctx.mean(0)
+    if batched:
+        ctx_mean = (ctx * x_mask[:, :, None]).sum(0) / x_mask.sum(0)[:, None]
+    else:
+        ctx_mean = ctx.mean(0)
     # ctx_mean = concatenate([proj[0][-1],projr[0][-1]], axis=proj[0].ndim-2)
 
     init_state = get_layer_constr('ff')(tparams, ctx_mean, options, dropout,
@@ -660,7 +614,11 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
 
     logging.info('Building f_init...')
     outs = [init_state, ctx]
-    f_init = theano.function([x], outs, name='f_init', profile=profile)
+    if batched:
+        inps = [x, x_mask]
+    else:
+        inps = [x]
+    f_init = theano.function(inps, outs, name='f_init', profile=profile)
     logging.info('Done')
 
     # x: 1 x 1
@@ -675,13 +633,28 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
     if options['deep_fusion_lm']:
         lm_init_state = tensor.matrix('lm_init_state', dtype=floatX)
 
-    logit, opt_ret, ret_state, lm_ret_state = build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=None, y_mask=None, sampling=True, lm_init_state=lm_init_state)
+    # in batched mode, the source mask has one column per hypothesis, like ctx
+    if batched:
+        x_mask_sampler = tensor.matrix('x_mask_sampler', dtype=floatX)
+        x_mask_sampler.tag.test_value = numpy.ones(shape=(5, 10)).astype(floatX)
+    else:
+        x_mask_sampler = None
+
+    if shortlist:
+        shortlist_ids = tensor.vector('shortlist', dtype='int64')
+        shortlist_ids.tag.test_value = numpy.arange(10).astype('int64')
+    else:
+        shortlist_ids = None
+
+    logit, opt_ret, ret_state, lm_ret_state = build_decoder(tparams, options, y, ctx, init_state, dropout, x_mask=x_mask_sampler, y_mask=None, sampling=True, lm_init_state=lm_init_state, shortlist=shortlist_ids)
 
     # compute the softmax probability
     next_probs = tensor.nnet.softmax(logit)
 
     # sample from softmax distribution to get the sample
     next_sample = trng.multinomial(pvals=next_probs).argmax(1)
+    if shortlist:
+        next_sample = shortlist_ids[next_sample]
 
     # compile a function to do the whole thing above, next word probability,
     # sampled word for the next target, next hidden state to be used
@@ -693,6 +666,12 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
         inps = [y, ctx, init_state]
         outs = [next_probs, next_sample, ret_state]
 
+    if batched:
+        inps.append(x_mask_sampler)
+
+    if shortlist:
+        inps.append(shortlist_ids)
+
     if return_alignment:
         outs.append(opt_ret['dec_alphas'])
 
@@ -840,30 +819,28 @@ def gen_sample(f_init, f_next, x, model_options=[None], trng=None, k=1, maxlen=3
         assert not stochastic, \
             'Beam search does not support stochastic sampling with argmax'
 
+    # beam search is handled by the batched implementation, with a batch of one sentence
+    if not stochastic:
+        return gen_sample_batch(f_init, f_next, x, None, model_options,
+                                k=k, maxlen=maxlen,
+                                return_alignment=return_alignment,
+                                suppress_unk=suppress_unk,
+                                return_hyp_graph=return_hyp_graph)[0]
+
     sample = []
     sample_score = []
     sample_word_probs = []
     alignment = []
     hyp_graph = None
-    if stochastic:
-        if argmax:
-            sample_score = 0
-        live_k=k
-    else:
-        live_k = 1
-
-    if return_hyp_graph:
-        from hypgraph import HypGraph
-        hyp_graph = HypGraph()
-
-    dead_k = 0
+    if argmax:
+        sample_score = 0
+    live_k=k
 
     hyp_samples=[ [] for i in xrange(live_k) ]
     word_probs=[ [] for i in xrange(live_k) ]
     hyp_scores = numpy.zeros(live_k).astype(floatX)
-    hyp_states = []
-    if return_alignment:
-        hyp_alignment = [[] for _ in xrange(live_k)]
+
+    deep_fusion = 'deep_fusion_lm' in model_options and model_options['deep_fusion_lm']
 
     # for ensemble decoding, we keep track of states and probability distribution
     # for each model in the ensemble
@@ -872,20 +849,16 @@ def gen_sample(f_init, f_next, x, model_options=[None], trng=None, k=1, maxlen=3
     lm_next_state = [None]*num_models
     ctx0 = [None]*num_models
     next_p = [None]*num_models
-    dec_alphas = [None]*num_models
     # get initial state of decoder rnn and encoder context
+    # states stay in (layers, batch_size, dim) layout and are reordered along axis 1
     for i in xrange(num_models):
         ret = f_init[i](x)
+        next_state[i] = numpy.tile(ret[0], (1, live_k, 1))
 
-        # to more easily manipulate batch size, go from (layers, batch_size, dim) to (batch_size, layers, dim)
-        ret[0] = numpy.transpose(ret[0], (1,0,2))
-
-        next_state[i] = numpy.tile( ret[0] , (live_k, 1, 1))
-
-        if 'deep_fusion_lm' in model_options and model_options['deep_fusion_lm']:
+        if deep_fusion:
             lm_dim = model_options['lm_dim']
-            lm_next_state[i] = numpy.tile( numpy.zeros((1, lm_dim)).astype(floatX) , (live_k, 1))
-            
+            lm_next_state[i] = numpy.zeros((live_k, lm_dim)).astype(floatX)
+
         ctx0[i] = ret[1]
 
     next_w = -1 * numpy.ones((live_k,)).astype('int64')  # bos indicator
@@ -895,172 +868,55 @@ def gen_sample(f_init, f_next, x, model_options=[None], trng=None, k=1, maxlen=3
         for i in xrange(num_models):
             ctx = numpy.tile(ctx0[i], [live_k, 1])
 
-            # for theano function, go from (batch_size, layers, dim) to (layers, batch_size, dim)
-            next_state[i] = numpy.transpose(next_state[i], (1,0,2))
-
-            if 'deep_fusion_lm' in model_options and model_options['deep_fusion_lm']:
+            if deep_fusion:
                 inps = [next_w, ctx, next_state[i], lm_next_state[i]]
                 ret = f_next[i](*inps)
-                # dimension of dec_alpha (k-beam-size, number-of-input-hidden-units)
                 next_p[i], next_w_tmp, next_state[i], lm_next_state[i] = ret[0], ret[1], ret[2], ret[3]
             else:
                 inps = [next_w, ctx, next_state[i]]
                 ret = f_next[i](*inps)
-                # dimension of dec_alpha (k-beam-size, number-of-input-hidden-units)
                 next_p[i], next_w_tmp, next_state[i] = ret[0], ret[1], ret[2]
-                # dummy LM states
-                lm_next_state[i] = [None]*live_k
-
-            if return_alignment:
-                dec_alphas[i] = ret[3]
-
-            # to more easily manipulate batch size, go from (layers, batch_size, dim) to (batch_size, layers, dim)
-            next_state[i] = numpy.transpose(next_state[i], (1,0,2))
 
             if suppress_unk:
                 next_p[i][:,1] = -numpy.inf
-        if stochastic:
-            #batches are not supported with argmax: output data structure is different
-            if argmax:
-                nw = sum(next_p)[0].argmax()
-                sample.append(nw)
-                sample_score += numpy.log(next_p[0][0, nw])
-                if nw == 0:
-                    break
-            else:
-                #FIXME: sampling is currently performed according to the last model only
-                nws = next_w_tmp
-                cand_scores = numpy.array(hyp_scores)[:, None] - numpy.log(next_p[-1])
-                probs = next_p[-1]
-
-                for idx,nw in enumerate(nws):
-                    hyp_samples[idx].append(nw)
-
-
-                hyp_states=[]
-                hyp_lm_states=[]
-                for ti in xrange(live_k):
-                    hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)])
-                    hyp_lm_states.append([copy.copy(lm_next_state[i][ti]) for i in xrange(num_models)])
-                    hyp_scores[ti]=cand_scores[ti][nws[ti]]
-                    word_probs[ti].append(probs[ti][nws[ti]])
-
-                new_hyp_states=[]
-                new_hyp_lm_states=[]
-                new_hyp_samples=[]
-                new_hyp_scores=[]
-                new_word_probs=[]
-                for hyp_sample, hyp_state, hyp_lm_state, hyp_score, hyp_word_prob in zip(hyp_samples, hyp_states, hyp_lm_states ,hyp_scores, word_probs):
-                    if hyp_sample[-1]  > 0:
-                        new_hyp_samples.append(copy.copy(hyp_sample))
-                        new_hyp_states.append(copy.copy(hyp_state))
-                        new_hyp_lm_states.append(copy.copy(hyp_lm_state))
-                        new_hyp_scores.append(hyp_score)
-                        new_word_probs.append(hyp_word_prob)
-                    else:
-                        sample.append(copy.copy(hyp_sample))
-                        sample_score.append(hyp_score)
-                        sample_word_probs.append(hyp_word_prob)
-
-                hyp_samples=new_hyp_samples
-                hyp_states=new_hyp_states
-                hyp_lm_states=new_hyp_lm_states
-                hyp_scores=new_hyp_scores
-                word_probs=new_word_probs
-
-                live_k=len(hyp_samples)
-                if live_k < 1:
-                    break
 
-                next_w = numpy.array([w[-1] for w in hyp_samples])
-                next_state = [numpy.array(state) for state in zip(*hyp_states)]
-                lm_next_state = [numpy.array(state) for state in zip(*hyp_lm_states)]
+        #batches are not supported with argmax: output data structure is different
+        if argmax:
+            nw = sum(next_p)[0].argmax()
+            sample.append(nw)
+            sample_score += numpy.log(next_p[0][0, nw])
+            if nw == 0:
+                break
         else:
-            cand_scores = hyp_scores[:, None] - sum(numpy.log(next_p))
-            probs = sum(next_p)/num_models
-            cand_flat = cand_scores.flatten()
-            probs_flat = probs.flatten()
-            ranks_flat = cand_flat.argpartition(k-dead_k-1)[:(k-dead_k)]
-
-            #averaging the attention weights accross models
-            if return_alignment:
-                mean_alignment = sum(dec_alphas)/num_models
-
-            voc_size = next_p[0].shape[1]
-            # index of each k-best hypothesis
-            trans_indices = ranks_flat / voc_size
-            word_indices = ranks_flat % voc_size
-            costs = cand_flat[ranks_flat]
-
-            new_hyp_samples = []
-            new_hyp_scores = numpy.zeros(k-dead_k).astype(floatX)
-            new_word_probs = []
-            new_hyp_states = []
-            new_hyp_lm_states = []
-            if return_alignment:
-                # holds the history of attention weights for each time step for each of the surviving hypothesis
-                # dimensions (live_k * target_words * source_hidden_units]
-                # at each time step we append the attention weights corresponding to the current target word
-                new_hyp_alignment = [[] for _ in xrange(k-dead_k)]
-
-            # ti -> index of k-best hypothesis
-            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-                new_hyp_samples.append(hyp_samples[ti]+[wi])
-                new_word_probs.append(word_probs[ti] + [probs_flat[ranks_flat[idx]].tolist()])
-                new_hyp_scores[idx] = copy.copy(costs[idx])
-                new_hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)])
-                new_hyp_lm_states.append([copy.copy(lm_next_state[i][ti]) for i in xrange(num_models)])
-                if return_alignment:
-                    # get history of attention weights for the current hypothesis
-                    new_hyp_alignment[idx] = copy.copy(hyp_alignment[ti])
-                    # extend the history with current attention weights
-                    new_hyp_alignment[idx].append(mean_alignment[ti])
-
-            # check the finished samples
-            new_live_k = 0
-            hyp_samples = []
-            hyp_scores = []
-            hyp_states = []
-            hyp_lm_states = []
-            word_probs = []
-            if return_alignment:
-                hyp_alignment = []
-
-            # sample and sample_score hold the k-best translations and their scores
-            for idx in xrange(len(new_hyp_samples)):
-                if return_hyp_graph:
-                    word, history = new_hyp_samples[idx][-1], new_hyp_samples[idx][:-1]
-                    score = new_hyp_scores[idx]
-                    word_prob = new_word_probs[idx][-1]
-                    hyp_graph.add(word, history, word_prob=word_prob, cost=score)
-                if new_hyp_samples[idx][-1] == 0:
-                    sample.append(copy.copy(new_hyp_samples[idx]))
-                    sample_score.append(new_hyp_scores[idx])
-                    sample_word_probs.append(new_word_probs[idx])
-                    if return_alignment:
-                        alignment.append(new_hyp_alignment[idx])
-                    dead_k += 1
+            #FIXME: sampling is currently performed according to the last model only
+            nws = next_w_tmp
+            probs = next_p[-1][numpy.arange(live_k), nws]
+            hyp_scores = hyp_scores - numpy.log(probs)
+
+            live = []
+            for ti, nw in enumerate(nws):
+                hyp_samples[ti].append(nw)
+                word_probs[ti].append(probs[ti])
+                if nw > 0:
+                    live.append(ti)
                 else:
-                    new_live_k += 1
-                    hyp_samples.append(copy.copy(new_hyp_samples[idx]))
-                    hyp_scores.append(new_hyp_scores[idx])
-                    hyp_states.append(copy.copy(new_hyp_states[idx]))
-                    hyp_lm_states.append(copy.copy(new_hyp_lm_states[idx]))
-                    word_probs.append(new_word_probs[idx])
-                    if return_alignment:
-                        hyp_alignment.append(new_hyp_alignment[idx])
-            hyp_scores = numpy.array(hyp_scores)
-
-            live_k = new_live_k
-
-            if new_live_k < 1:
-                break
-            if dead_k >= k:
+                    sample.append(hyp_samples[ti])
+                    sample_score.append(hyp_scores[ti])
+                    sample_word_probs.append(word_probs[ti])
+
+            live_k = len(live)
+            if live_k < 1:
                 break
 
-            next_w = numpy.array([w[-1] for w in hyp_samples])
-            next_state = [numpy.array(state) for state in zip(*hyp_states)]
-            lm_next_state = [numpy.array(state) for state in zip(*hyp_lm_states)]
+            # keep the hypotheses that have not produced EOS
+            hyp_samples = [hyp_samples[ti] for ti in live]
+            word_probs = [word_probs[ti] for ti in live]
+            hyp_scores = hyp_scores[live]
+            next_w = nws[live]
+            for i in xrange(num_models):
+                next_state[i] = next_state[i][:, live]
+                if deep_fusion:
+                    lm_next_state[i] = lm_next_state[i][live]
 
     # dump every remaining one
     if not argmax and live_k > 0:
@@ -1068,8 +924,6 @@ def gen_sample(f_init, f_next, x, model_options=[None], trng=None, k=1, maxlen=3
             sample.append(hyp_samples[idx])
             sample_score.append(hyp_scores[idx])
             sample_word_probs.append(word_probs[idx])
-            if return_alignment:
-                alignment.append(hyp_alignment[idx])
 
     if not return_alignment:
         alignment = [None for i in range(len(sample))]
@@ -1077,31 +931,305 @@ def gen_sample(f_init, f_next, x, model_options=[None], trng=None, k=1, maxlen=3
     return sample, sample_score, sample_word_probs, alignment, hyp_graph
 
 
-# calculate the log probablities on a given corpus using translation model
-def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True, normalization_alpha=0.0, alignweights=False):
-    probs = []
-    n_done = 0
+# batched beam search: translate several source sentences at once, so that each
+# call of f_next scores the live hypotheses of all sentences in the batch.
+# x (factors x length x sentences) is padded with zeros, x_mask marks the valid
+# positions (including EOS). f_init and f_next must be built with
+# build_sampler(..., batched=True); with x_mask=None, samplers built without
+# a mask can be used for a single sentence. maxlen is either a single value or
+# one value per sentence. If the samplers were built with shortlist=True,
+# shortlist is the sorted array of target word ids (including 0 and 1) that
+# the batch is decoded with. Returns one (sample, sample_score,
+# sample_word_probs, alignment, hyp_graph) tuple per sentence, in the format
+# of gen_sample.
+def gen_sample_batch(f_init, f_next, x, x_mask, model_options=[None], k=1, maxlen=30,
+                     return_alignment=False, suppress_unk=False, return_hyp_graph=False,
+                     shortlist=None):
+
+    n_sentences = x.shape[2]
+    maxlen = numpy.zeros(n_sentences, dtype='int64') + maxlen
+    if x_mask is None:
+        source_lengths = numpy.zeros(n_sentences, dtype='int64') + x.shape[1]
+    else:
+        source_lengths = x_mask.sum(0).astype('int64')
+    deep_fusion = 'deep_fusion_lm' in model_options and model_options['deep_fusion_lm']
+
+    sample = [[] for _ in xrange(n_sentences)]
+    sample_score = [[] for _ in xrange(n_sentences)]
+    sample_word_probs = [[] for _ in xrange(n_sentences)]
+    alignment = [[] for _ in xrange(n_sentences)]
+    hyp_graph = [None] * n_sentences
+    if return_hyp_graph:
+        from hypgraph import HypGraph
+        hyp_graph = [HypGraph() for _ in xrange(n_sentences)]
+
+    dead_k = numpy.zeros(n_sentences, dtype='int64')
+
+    # search history: for each step and each expanded hypothesis, we store the
+    # new word, its probability, the attention weights and the position of the
+    # previous hypothesis in the history of the previous step (back-pointer).
+    # word sequences are only reconstructed once a hypothesis is finished.
+    max_steps = maxlen.max()
+    history_words = numpy.zeros((max_steps, n_sentences * k), dtype='int64')
+    history_parents = numpy.zeros((max_steps, n_sentences * k), dtype='int64')
+    history_probs = numpy.zeros((max_steps, n_sentences * k), dtype=floatX)
+    if return_alignment:
+        history_alignment = numpy.zeros((max_steps, n_sentences * k, x.shape[1]), dtype=floatX)
+
+    # live hypotheses of all sentences are stacked, one row per hypothesis;
+    # rows of the same sentence are contiguous, hyp_sentence maps rows to sentences
+    # and hyp_positions to their position in the history of the last step
+    hyp_sentence = numpy.arange(n_sentences)
+    hyp_positions = numpy.zeros(n_sentences, dtype='int64')
+    hyp_scores = numpy.zeros(n_sentences).astype(floatX)
+
+    # for ensemble decoding, we keep track of states and probability distribution
+    # for each model in the ensemble
+    num_models = len(f_init)
+    next_state = [None]*num_models
+    lm_next_state = [None]*num_models
+    ctx0 = [None]*num_models
+    next_p = [None]*num_models
+    dec_alphas = [None]*num_models
+    # get initial state of decoder rnn and encoder context
+    # states stay in (layers, batch_size, dim) layout and are reordered along axis 1
+    for i in xrange(num_models):
+        if x_mask is None:
+            next_state[i], ctx0[i] = f_init[i](x)
+        else:
+            next_state[i], ctx0[i] = f_init[i](x, x_mask)
+        if deep_fusion:
+            lm_next_state[i] = numpy.zeros((n_sentences, model_options['lm_dim'])).astype(floatX)
+
+    next_w = -1 * numpy.ones((n_sentences,)).astype('int64')  # bos indicator
+
+    # follow the back-pointers from a position in the history of a given step
+    def _backtrack(step, position):
+        steps = numpy.arange(step + 1)
+        positions = numpy.zeros(step + 1, dtype='int64')
+        for tt in xrange(step, -1, -1):
+            positions[tt] = position
+            position = history_parents[tt, position]
+        return steps, positions
+
+    # reconstruct a finished hypothesis and add it to the samples of its sentence
+    def _finish(step, position, s, score):
+        steps, positions = _backtrack(step, position)
+        sample[s].append(history_words[steps, positions].tolist())
+        sample_score[s].append(score)
+        sample_word_probs[s].append(history_probs[steps, positions].tolist())
+        if return_alignment:
+            alignment[s].append(list(history_alignment[steps, positions, :source_lengths[s]]))
+
+    for ii in xrange(max_steps):
+
+        # stop decoding sentences that have reached their maximum length
+        expired = maxlen[hyp_sentence] <= ii
+        if expired.any():
+            for ti in numpy.flatnonzero(expired):
+                _finish(ii - 1, hyp_positions[ti], hyp_sentence[ti], hyp_scores[ti])
+            keep = numpy.flatnonzero(~expired)
+            hyp_sentence = hyp_sentence[keep]
+            hyp_positions = hyp_positions[keep]
+            hyp_scores = hyp_scores[keep]
+            next_w = next_w[keep]
+            for i in xrange(num_models):
+                next_state[i] = next_state[i][:, keep]
+                if deep_fusion:
+                    lm_next_state[i] = lm_next_state[i][keep]
+            if len(keep) == 0:
+                break
+
+        for i in xrange(num_models):
+            ctx = ctx0[i][:, hyp_sentence]
 
-    alignments_json = []
+            if deep_fusion:
+                inps = [next_w, ctx, next_state[i], lm_next_state[i]]
+            else:
+                inps = [next_w, ctx, next_state[i]]
+            if x_mask is not None:
+                inps.append(x_mask[:, hyp_sentence])
+            if shortlist is not None:
+                inps.append(shortlist)
+            ret = f_next[i](*inps)
+
+            if deep_fusion:
+                next_p[i], next_state[i], lm_next_state[i] = ret[0], ret[2], ret[3]
+            else:
+                next_p[i], next_state[i] = ret[0], ret[2]
+
+            if return_alignment:
+                # dimension of dec_alpha (live hypotheses, source length)
+                dec_alphas[i] = ret[-1]
+
+            # UNK (word id 1) is always at position 1 of a shortlist
+            if suppress_unk:
+                next_p[i][:,1] = -numpy.inf
+
+        cand_scores = hyp_scores[:, None] - sum(numpy.log(next_p))
+        probs = sum(next_p)/num_models
+        voc_size = next_p[0].shape[1]
+
+        # each sentence keeps the k-best expansions of its own hypotheses
+        trans_indices = []
+        word_indices = []
+        costs = []
+        word_probs = []
+        starts = numpy.flatnonzero(numpy.r_[True, hyp_sentence[1:] != hyp_sentence[:-1]])
+        ends = numpy.r_[starts[1:], len(hyp_sentence)]
+        for start, end in zip(starts, ends):
+            s = hyp_sentence[start]
+            cand_flat = cand_scores[start:end].flatten()
+            probs_flat = probs[start:end].flatten()
+            ranks_flat = cand_flat.argpartition(k-dead_k[s]-1)[:(k-dead_k[s])]
+
+            # index of each k-best hypothesis
+            trans_indices.append(start + ranks_flat / voc_size)
+            if shortlist is None:
+                word_indices.append(ranks_flat % voc_size)
+            else:
+                word_indices.append(shortlist[ranks_flat % voc_size])
+            costs.append(cand_flat[ranks_flat])
+            word_probs.append(probs_flat[ranks_flat])
+
+            if return_hyp_graph:
+                for ti, wi, score, word_prob in zip(trans_indices[-1], word_indices[-1], costs[-1], word_probs[-1]):
+                    steps, positions = _backtrack(ii - 1, hyp_positions[ti])
+                    history = history_words[steps, positions].tolist()
+                    hyp_graph[s].add(wi, history, word_prob=word_prob.tolist(), cost=score)
+
+        trans_indices = numpy.concatenate(trans_indices)
+        word_indices = numpy.concatenate(word_indices)
+        costs = numpy.concatenate(costs)
+        new_hyp_sentence = hyp_sentence[trans_indices]
+
+        # store the expansions in the history
+        n_new = len(trans_indices)
+        history_words[ii, :n_new] = word_indices
+        history_parents[ii, :n_new] = hyp_positions[trans_indices]
+        history_probs[ii, :n_new] = numpy.concatenate(word_probs)
+        if return_alignment:
+            # averaging the attention weights accross models
+            history_alignment[ii, :n_new] = (sum(dec_alphas)/num_models)[trans_indices]
+
+        # check the finished samples
+        finished = word_indices == 0
+        for position in numpy.flatnonzero(finished):
+            s = new_hyp_sentence[position]
+            _finish(ii, position, s, costs[position])
+            dead_k[s] += 1
+
+        live = numpy.flatnonzero(~finished)
+        if len(live) < 1:
+            hyp_sentence = live
+            break
+
+        hyp_sentence = new_hyp_sentence[live]
+        hyp_positions = live
+        hyp_scores = costs[live]
+        next_w = word_indices[live]
+        for i in xrange(num_models):
+            next_state[i] = next_state[i][:, trans_indices[live]]
+            if deep_fusion:
+                lm_next_state[i] = lm_next_state[i][trans_indices[live]]
+    else:
+        # dump every remaining one
+        for ti in xrange(len(hyp_sentence)):
+            _finish(max_steps - 1, hyp_positions[ti], hyp_sentence[ti], hyp_scores[ti])
+
+    if not return_alignment:
+        alignment = [[None] * len(s) for s in sample]
+
+    return zip(sample, sample_score, sample_word_probs, alignment, hyp_graph)
+
+# calculate the log probablities on a given corpus using translation model
+def prepare_batches(prepare_data, options, iterator, buffers=None):
+    """
+    Prepares the minibatches of an iterator for scoring; yields
+    (x, x_mask, y, y_mask, indices), where indices are the line numbers of
+    the sentence pairs if the iterator returns them, and None otherwise.
+    """
+    for batch in iterator:
+        x, y = batch[:2]
+        # iterators with return_indices also return the line numbers of the batch
+        indices = batch[2] if len(batch) > 2 else None
 
-    for x, y in iterator:
         #ensure consistency in number of factors
         if len(x[0][0]) != options['factors']:
             logging.error('Mismatch between number of factors in settings ({0}), and number in validation corpus ({1})\n'.format(options['factors'], len(x[0][0])))
             sys.exit(1)
 
-        n_done += len(x)
-
         x, x_mask, y, y_mask = prepare_data(x, y,
                                             n_words_src=options['n_words_src'],
                                             n_words=options['n_words'],
-                                            n_factors=options['factors'])
+                                            n_factors=options['factors'],
+                                            buffers=buffers)
+        yield x, x_mask, y, y_mask, indices
+
+class CachedBatches(object):
+    """
+    Prepared minibatches of a corpus that does not change (such as the
+    validation set), so that it can be scored repeatedly (see pred_probs)
+    without reading and padding it again. Sentence pairs are numbered in
+    the order of the corpus (or in reading order if the iterator does not
+    return line numbers); pairs skipped by the iterator are not counted.
+    The source dictionaries of the iterator are kept (for validation BLEU).
+    """
+    def __init__(self, prepare_data, options, iterator):
+        self.source_dicts = iterator.source_dicts
+        self.batches = []
+        self.n_samples = 0
+        for x, x_mask, y, y_mask, indices in prepare_batches(prepare_data, options, iterator):
+            if indices is None:
+                indices = range(self.n_samples, self.n_samples + x.shape[-1])
+            self.batches.append((x, x_mask, y, y_mask, numpy.array(indices, dtype='int64')))
+            self.n_samples += x.shape[-1]
+        # map line numbers to positions among the cached sentence pairs
+        lines = numpy.sort(numpy.concatenate([batch[-1] for batch in self.batches])) \
+                if self.batches else numpy.zeros(0, dtype='int64')
+        self.batches = [batch[:-1] + (numpy.searchsorted(lines, batch[-1]),) for batch in self.batches]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def padding(self):
+        """
+        Fraction of padding positions in the source and target arrays.
+        """
+        positions = sum(x_mask.size + y_mask.size for _, x_mask, _, y_mask, _ in self.batches)
+        tokens = sum(x_mask.sum() + y_mask.sum() for _, x_mask, _, y_mask, _ in self.batches)
+        return 1. - tokens / float(max(positions, 1))
+
+def score_batches(f_log_probs, batches, normalization_alpha=0.0, alignweights=False, n_samples=None):
+    """
+    Scores prepared minibatches (see prepare_batches); scores and
+    alignments are returned in the original order of the corpus. If the
+    number of sentence pairs n_samples is known (and all minibatches have
+    line numbers), scores are written into a preallocated array.
+    """
+    probs = [] if n_samples is None else numpy.empty(n_samples, dtype=floatX)
+    n_done = 0
+
+    alignments_json = [None] * n_samples if n_samples is not None and alignweights else []
+    indices = []
+
+    for x, x_mask, y, y_mask, batch_indices in batches:
+        if batch_indices is not None and n_samples is None:
+            indices.extend(batch_indices)
+
+        n_done += x.shape[-1]
 
         ### in optional save weights mode.
         if alignweights:
             pprobs, attention = f_log_probs(x, x_mask, y, y_mask)
-            for jdata in get_alignments(attention, x_mask, y_mask):
-                alignments_json.append(jdata)
+            for i, jdata in enumerate(get_alignments(attention, x_mask, y_mask)):
+                if n_samples is None:
+                    alignments_json.append(jdata)
+                else:
+                    alignments_json[batch_indices[i]] = jdata
         else:
             pprobs = f_log_probs(x, x_mask, y, y_mask)
 
@@ -1110,44 +1238,147 @@ def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True, norma
             adjusted_lengths = numpy.array([numpy.count_nonzero(s) ** normalization_alpha for s in y_mask.T])
             pprobs /= adjusted_lengths
 
-        for pp in pprobs:
-            probs.append(pp)
+        if n_samples is None:
+            probs.extend(pprobs)
+        else:
+            probs[batch_indices] = pprobs
 
         logging.debug('%d samples computed' % (n_done))
 
-    return numpy.array(probs), alignments_json
+    if n_samples is not None:
+        return probs, alignments_json
 
-def get_translation(f_init, f_next, options, datasets, dictionaries, trng):
-    translations = []
-    n_done = 0
-    #assert options['valid_batch_size'] == 1
-    source = datasets[0]
-    input1 = open(source, 'r')
-    for l1 in input1:
-        x1 = []
-        for w in l1.split():
-            w = [dictionaries[0][f] if f in dictionaries[0] else 1 for (i,f) in enumerate(w.split('|'))]
-            x1.append(w)
-        x1 += [[0]*options['factors']]
-
-        x1 = numpy.array(x1).T.reshape([len(x1[0]), len(x1), 1])
-
-        sample, score, sample_word_probs, alignment, hyp_graph = gen_sample([f_init], [f_next],
-                    x1,
-                    options,
-                    trng=trng, k=12,
-                    maxlen=50,
-                    stochastic=False,
-                    argmax=False,
-                    suppress_unk=False,
-                    return_hyp_graph=False)
-        #score = score / numpy.array([len(s) for s in sample])
-        idx = numpy.argmin(score)
-        ss = sample[idx]
-        translations.append(ss)
-    input1.close()
+    probs = numpy.array(probs)
+    # restore the order of the corpus if the iterator sorted it by length
+    if indices:
+        order = numpy.argsort(indices)
+        probs = probs[order]
+        if alignweights:
+            alignments_json = [alignments_json[i] for i in order]
+
+    return probs, alignments_json
+
+def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True, normalization_alpha=0.0, alignweights=False):
+    if isinstance(iterator, CachedBatches):
+        return score_batches(f_log_probs, iterator, normalization_alpha=normalization_alpha,
+                             alignweights=alignweights, n_samples=iterator.n_samples)
+    batches = prepare_batches(prepare_data, options, iterator, buffers=BatchBuffers())
+    return score_batches(f_log_probs, batches, normalization_alpha=normalization_alpha, alignweights=alignweights)
+
+# translate the source side of a validation set with batched beam search
+# (f_init and f_next must be built with batched=True); sentences are sorted
+# by length to reduce padding, and translations are returned in the
+# original order
+def get_translation(f_init, f_next, options, datasets, dictionaries, k=12, maxlen=50, batch_size=80):
+    sources = []
+    with open(datasets[0], 'r') as input1:
+        for l1 in input1:
+            x1 = []
+            for w in l1.split():
+                # as in the training data (TextIterator), each factor is
+                # mapped with its own dictionary, and ids beyond the source
+                # vocabulary are UNK
+                w = [dictionaries[i][f] if f in dictionaries[i] else 1 for (i,f) in enumerate(w.split('|'))]
+                if options['n_words_src']:
+                    w = [f if f < options['n_words_src'] else 1 for f in w]
+                x1.append(w)
+            sources.append(x1)
+
+    translations = [None] * len(sources)
+    order = sorted(range(len(sources)), key=lambda i: len(sources[i]))
+    for start in xrange(0, len(order), batch_size):
+        indices = order[start:start+batch_size]
+        seqs = [sources[i] for i in indices]
+        lengths = numpy.array([len(seq) for seq in seqs], dtype='int64')
+        x, x_mask = pad(flatten(seqs, lengths, options['factors']), lengths, floatX, options['factors'])
+        samples = gen_sample_batch([f_init], [f_next], x, x_mask, options,
+                                   k=k, maxlen=maxlen, suppress_unk=False)
+        for i, (sample, score, _, _, _) in zip(indices, samples):
+            translations[i] = sample[numpy.argmin(score)]
     return translations
 
+# translate the validation set, and log the BLEU score of the translations
+# (written to output_file)
+def validate_bleu(f_init, f_next, options, datasets, dictionaries, worddict_r, output_file,
+                  valid_ref, postprocess=None, k=12, maxlen=50, batch_size=80, uidx=None):
+    start_time = time.time()
+    translations = get_translation(f_init, f_next, options, datasets, dictionaries,
+                                   k=k, maxlen=maxlen, batch_size=batch_size)
+    translations = [seqs2words(t, worddict_r) for t in translations]
+
+    with open(output_file, 'w') as valid_output:
+        for t in translations:
+            if postprocess == 'bpe':
+                t = t.replace('@@ ', '')
+            print >> valid_output, t
+    valid_refs = util.get_ref_files(valid_ref)
+    bleu_score = 100 * util.bleu_file(output_file, valid_refs)
+    logging.info('Valid bleu {} (update {}, {:.1f}s)\n'.format(bleu_score, uidx, time.time() - start_time))
+    return bleu_score
+
+def _bleu_worker(tparams, tasks, results, bleu_args):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        params, uidx = task
+        zip_to_theano(params, tparams)
+        results.put(validate_bleu(*bleu_args, uidx=uidx))
+
+class BackgroundBleuValidator(object):
+    """
+    Computes validation BLEU (see `validate_bleu`) in a worker process, on a
+    snapshot of the parameters, while training continues. The worker is
+    forked once, before the training process starts any threads: a process
+    forked later could inherit a lock (e.g. of logging) that another thread
+    holds, and deadlock.
+    """
+    def __init__(self, tparams, bleu_args):
+        self._tparams = tparams
+        self._tasks = ProcessQueue()
+        self._results = ProcessQueue()
+        self._pending = False
+        self._process = Process(target=_bleu_worker, args=(tparams, self._tasks, self._results, bleu_args))
+        self._process.daemon = True
+        self._process.start()
+
+    def validate(self, uidx):
+        """
+        Starts validation of the current parameters (after waiting for the
+        previous validation to finish).
+        """
+        if self._pending:
+            logging.info("Waiting for previous BLEU validation to finish")
+            valid_wait_start = time.time()
+            self._wait()
+            logging.info("Waited for {0:.1f} seconds".format(time.time()-valid_wait_start))
+        if self._process is None:
+            return
+        self._tasks.put((unzip_from_theano(self._tparams, excluding_prefix='prior_'), uidx))
+        self._pending = True
+
+    def close(self):
+        if self._process is None:
+            return
+        self._tasks.put(None)
+        self._process.join()
+        if self._process.exitcode != 0:
+            logging.warning('BLEU validation process failed (exit code {0})'.format(self._process.exitcode))
+
+    def _wait(self):
+        while True:
+            try:
+                self._results.get(timeout=1)
+                break
+            except Queue.Empty:
+                if not self._process.is_alive():
+                    self._process.join()
+                    logging.warning('BLEU validation process failed (exit code {0}); validation BLEU is no longer computed'.format(
+                        self._process.exitcode))
+                    self._process = None
+                    break
+        self._pending = False
+
 def augment_raml_data(x, y, tgt_worddict, options):
     #augment data with copies, of which the targets will be perturbed
     aug_x = []
@@ -1250,6 +1481,14 @@ def train(dim_word=512,  # word vector dimensionality
           optimizer='adam',
           batch_size=16,
           valid_batch_size=16,
+          token_batch_size=0, # minibatch size in tokens (0: use batch_size)
+          update_every=1, # accumulate the gradients of this many minibatches per update
+          update_normalization='sentence', # average accumulated gradients per sentence or per target token
+          workers=1, # number of training processes (data parallelism on CPU)
+          worker_sync='gradients', # synchronize workers by summing gradients, or by averaging parameters
+          average_every=10, # with worker_sync='parameters', average the parameters every this many updates
+          valid_token_batch_size=0, # validation minibatch size in tokens (0: use valid_batch_size)
+          cache_valid_batches=False, # prepare the validation minibatches once (sorted by length over the whole validation set), and keep them in memory
           saveto='model.npz',
           deep_fusion_lm=None,
           concatenate_lm_decoder=False,
@@ -1259,6 +1498,7 @@ def train(dim_word=512,  # word vector dimensionality
           datasets=[ # path to training datasets (source and target)
               None,
               None],
+          binarized_datasets=False, # training datasets are binarized corpora (prefixes of files created with binarize.py)
           valid_datasets=[None, # path to validation datasets (source and target)
                           None],
           dictionaries=[ # path to dictionaries (json file created with ../data/build_dictionary.py). One dictionary per input factor; last dictionary is target-side dictionary.
@@ -1274,6 +1514,7 @@ def train(dim_word=512,  # word vector dimensionality
           overwrite=False,
           external_validation_script=None,
           shuffle_each_epoch=True,
+          shuffle_seed=None, # seed for shuffling the training data (default: random); stored in the training progress
           sort_by_length=True,
           use_domain_interpolation=False, # interpolate between an out-domain training corpus and an in-domain training corpus
           domain_interpolation_min=0.1, # minimum (initial) fraction of in-domain training data
@@ -1283,6 +1524,7 @@ def train(dim_word=512,  # word vector dimensionality
           anneal_restarts=0, # when patience run out, restart with annealed learning rate X times before early stopping
           anneal_decay=0.5, # decay learning rate by this amount on each restart
           maxibatch_size=20, #How many minibatches to load at one time
+          prefetch=0, # Number of minibatches to prepare in a background process (0: no prefetching)
           objective="CE", #CE: cross-entropy; MRT: minimum risk training (see https://www.aclweb.org/anthology/P/P16/P16-1159.pdf) \
                           #RAML: reward-augmented maximum likelihood (see https://papers.nips.cc/paper/6547-reward-augmented-maximum-likelihood-for-neural-structured-prediction.pdf)
           mrt_alpha=0.005,
@@ -1305,6 +1547,9 @@ def train(dim_word=512,  # word vector dimensionality
           multi_src=0,
 
           bleu=False,
+          bleu_beam_size=12, # beam size for validation BLEU
+          bleu_maxlen=50, # maximum length of validation translations
+          bleu_background=False, # compute validation BLEU in a separate process, while training continues
           postprocess=None,
           valid_ref=None
     ):
@@ -1385,17 +1630,23 @@ def train(dim_word=512,  # word vector dimensionality
         # model saving, validation, etc trigger after the same number of updates as before
         logging.info('Running in MRT mode, minibatch size set to 1 sentence')
         batch_size = 1
+        token_batch_size = 0
     elif model_options['objective'] == 'RAML':
         # in RAML mode, training examples are augmented with samples, causing the size of the
         # batch to increase. Thus, divide batch_size by the number of samples to have approx.
         # the same batch size for each update and thus prevent running out of memory.
         batch_size = batch_size // model_options['raml_samples']
         logging.info('Running in RAML mode, minibatch size divided by number of samples, set to %d' % batch_size)
+        if token_batch_size:
+            token_batch_size = token_batch_size // model_options['raml_samples']
+            logging.info('Running in RAML mode, minibatch size in tokens divided by number of samples, set to %d' % token_batch_size)
 
     # initialize training progress
     training_progress = TrainingProgress()
     best_p = None
     best_opt_p = None
+    # whether best_p has been written to saveto since it was last updated
+    best_p_saved = False
     training_progress.bad_counter = 0
     training_progress.anneal_restarts_done = 0
     training_progress.uidx = 0
@@ -1403,6 +1654,7 @@ def train(dim_word=512,  # word vector dimensionality
     training_progress.estop = False
     training_progress.history_errs = []
     training_progress.domain_interpolation_cur = domain_interpolation_min if use_domain_interpolation else None
+    training_progress.shuffle_seed = shuffle_seed if shuffle_seed is not None else int(numpy.random.randint(2**31))
     # reload training progress
     training_progress_file = saveto + '.progress.json'
     if reload_ and reload_training_progress and os.path.exists(training_progress_file):
@@ -1417,6 +1669,31 @@ def train(dim_word=512,  # word vector dimensionality
         lrate *= anneal_decay**training_progress.anneal_restarts_done
 
     logging.info('Loading data')
+    if binarized_datasets and (use_domain_interpolation or multi_src):
+        logging.error('Error: binarized training corpora are not supported with domain interpolation or multiple sources.\n')
+        sys.exit(1)
+    if (token_batch_size or valid_token_batch_size) and multi_src:
+        logging.error('Error: token-based minibatch sizes are not supported with multiple sources.\n')
+        sys.exit(1)
+    if cache_valid_batches and multi_src:
+        logging.error('Error: caching validation minibatches (cache_valid_batches) is not supported with multiple sources.\n')
+        sys.exit(1)
+    if update_every > 1 and objective == 'MRT':
+        logging.error('Error: gradient accumulation (update_every) is not supported with MRT.\n')
+        sys.exit(1)
+    if workers > 1 and objective == 'MRT':
+        logging.error('Error: multiple training processes (workers) are not supported with MRT.\n')
+        sys.exit(1)
+    if workers > 1 and worker_sync == 'parameters' and update_every > 1:
+        logging.error('Error: gradient accumulation (update_every) is not supported with parameter averaging.\n')
+        sys.exit(1)
+    if workers > 1 and not theano.config.device.startswith('cpu'):
+        # forked processes cannot use the GPU context of the parent
+        logging.warning('Multiple training processes are only supported on CPU; training in a single process')
+        workers = 1
+    # workers with gradient synchronization accumulate gradients, which
+    # are summed and applied by the main process
+    accumulate = update_every > 1 or (workers > 1 and worker_sync == 'gradients')
     if use_domain_interpolation:
         logging.info('Using domain interpolation with initial ratio %s, final ratio %s, increase rate %s' % (training_progress.domain_interpolation_cur, domain_interpolation_max, domain_interpolation_inc))
         train = DomainInterpolatorTextIterator(datasets[0], datasets[1],
@@ -1426,12 +1703,15 @@ def train(dim_word=512,  # word vector dimensionality
                          maxlen=maxlen,
                          skip_empty=True,
                          shuffle_each_epoch=shuffle_each_epoch,
+                         shuffle_seed=training_progress.shuffle_seed,
+                         epoch=training_progress.eidx,
                          sort_by_length=sort_by_length,
                          indomain_source=domain_interpolation_indomain_datasets[0],
                          indomain_target=domain_interpolation_indomain_datasets[1],
                          interpolation_rate=training_progress.domain_interpolation_cur,
                          use_factor=(factors > 1),
-                         maxibatch_size=maxibatch_size)
+                         maxibatch_size=maxibatch_size,
+                         token_batch_size=token_batch_size)
     else:
         if multi_src:
           train = MultiSrcTextIterator(datasets[0], datasets[1],
@@ -1441,9 +1721,23 @@ def train(dim_word=512,  # word vector dimensionality
                            maxlen=maxlen,
                            skip_empty=True,
                            shuffle_each_epoch=shuffle_each_epoch,
+                           shuffle_seed=training_progress.shuffle_seed,
+                           epoch=training_progress.eidx,
                            sort_by_length=sort_by_length,
                            use_factor=False,
                            maxibatch_size=maxibatch_size)
+        elif binarized_datasets:
+          train = BinaryTextIterator(datasets[0], datasets[1],
+                           n_words_source=n_words_src, n_words_target=n_words,
+                           batch_size=batch_size,
+                           maxlen=maxlen,
+                           skip_empty=True,
+                           shuffle_each_epoch=shuffle_each_epoch,
+                           shuffle_seed=training_progress.shuffle_seed,
+                           epoch=training_progress.eidx,
+                           sort_by_length=sort_by_length,
+                           maxibatch_size=maxibatch_size,
+                           token_batch_size=token_batch_size)
         else:
           train = TextIterator(datasets[0], datasets[1],
                            dictionaries[:-1], dictionaries[-1],
@@ -1452,9 +1746,55 @@ def train(dim_word=512,  # word vector dimensionality
                            maxlen=maxlen,
                            skip_empty=True,
                            shuffle_each_epoch=shuffle_each_epoch,
+                           shuffle_seed=training_progress.shuffle_seed,
+                           epoch=training_progress.eidx,
                            sort_by_length=sort_by_length,
                            use_factor=(factors > 1),
-                           maxibatch_size=maxibatch_size)
+                           maxibatch_size=maxibatch_size,
+                           token_batch_size=token_batch_size)
+
+    if prefetch and model_options['objective'] == 'MRT':
+        logging.warning('Prefetching is not supported with MRT; disabling it')
+        prefetch = 0
+    if prefetch and use_domain_interpolation:
+        logging.error('Error: prefetching is not supported with domain interpolation.\n')
+        sys.exit(1)
+
+    # prefetched minibatches are sent to the training process asynchronously,
+    # so they need their own arrays (minibatches sent to training workers are
+    # copied by DataParallelTrainer.submit)
+    buffers = None if prefetch else BatchBuffers()
+
+    def prepare_minibatch(x, y):
+        """
+        Turns a minibatch of the training corpus into the input of f_update
+        (for CE and RAML); returns the number of sentences and the prepared
+        arrays.
+        """
+        if model_options['objective'] == 'RAML':
+            x, y, sample_weights = augment_raml_data(x, y, options=model_options,
+                                                     tgt_worddict=worddicts[-1])
+        else:
+            sample_weights = [1.0] * len(y)
+
+        if multi_src:
+            return len(x[0]), prepare_data_multi_src(x[0], x[1], y, weights=sample_weights,
+                                                     maxlen=maxlen,
+                                                     n_factors=factors,
+                                                     n_words_src=n_words_src,
+                                                     n_words=n_words,
+                                                     buffers=buffers)
+        else:
+            return len(x), prepare_data(x, y, weights=sample_weights,
+                                        maxlen=maxlen,
+                                        n_factors=factors,
+                                        n_words_src=n_words_src,
+                                        n_words=n_words,
+                                        buffers=buffers)
+
+    if prefetch:
+        logging.info('Preparing up to {0} minibatches in a background process'.format(prefetch))
+        train = PrefetchIterator(train, prepare_minibatch, depth=prefetch)
 
     if valid_datasets and validFreq:
         if multi_src:
@@ -1469,8 +1809,15 @@ def train(dim_word=512,  # word vector dimensionality
                               dictionaries[:-1], dictionaries[-1],
                               n_words_source=n_words_src, n_words_target=n_words,
                               batch_size=valid_batch_size,
+                              token_batch_size=valid_token_batch_size,
                               use_factor=(factors>1),
-                              maxlen=maxlen)
+                              maxlen=maxlen,
+                              maxibatch_size=0 if cache_valid_batches else 20,
+                              return_indices=cache_valid_batches)
+        if cache_valid_batches:
+            valid = CachedBatches(prepare_data, model_options, valid)
+            logging.info('Cached {0} validation sentence pairs in {1} minibatches ({2:.1f}% padding)'.format(
+                valid.n_samples, len(valid), 100 * valid.padding()))
     else:
         valid = None
 
@@ -1522,6 +1869,13 @@ def train(dim_word=512,  # word vector dimensionality
     if validFreq or sampleFreq:
         logging.info('Building sampler')
         f_init, f_next = build_sampler(tparams, model_options, use_noise, trng)
+    if bleu:
+        logging.info('Building batched sampler for validation')
+        f_init_batch, f_next_batch = build_sampler(tparams, model_options, use_noise, trng, batched=True)
+        if bleu_background and not theano.config.device.startswith('cpu'):
+            # forked processes cannot use the GPU context of the parent
+            logging.warning('Validation BLEU in a separate process is only supported on CPU; computing it in the training process')
+            bleu_background = False
     if model_options['objective'] == 'MRT':
         logging.info('Building MRT sampler')
         f_sampler = build_full_sampler(tparams, model_options, use_noise, trng)
@@ -1546,6 +1900,9 @@ def train(dim_word=512,  # word vector dimensionality
         logging.error('Objective must be one of ["CE", "MRT", "RAML"]')
         sys.exit(1)
 
+    data_cost = cost
+    reg_cost = 0.
+
     # apply L2 regularization on weights
     if decay_c > 0.:
         decay_c = theano.shared(numpy_floatX(decay_c), name='decay_c')
@@ -1555,7 +1912,7 @@ def train(dim_word=512,  # word vector dimensionality
                 continue
             weight_decay += (vv ** 2).sum()
         weight_decay *= decay_c
-        cost += weight_decay
+        reg_cost += weight_decay
 
     # apply L2 regularisation to loaded model (map training)
     if map_decay_c > 0:
@@ -1567,7 +1924,9 @@ def train(dim_word=512,  # word vector dimensionality
             init_value = tparams['prior_' + kk]
             weight_map_decay += ((vv -init_value) ** 2).sum()
         weight_map_decay *= map_decay_c
-        cost += weight_map_decay
+        reg_cost += weight_map_decay
+
+    cost = data_cost + reg_cost
 
     updated_params = OrderedDict(tparams)
 
@@ -1579,7 +1938,26 @@ def train(dim_word=512,  # word vector dimensionality
         updated_params = OrderedDict([(key,value) for (key,value) in updated_params.iteritems() if not key.startswith('lm_')])
 
     logging.info('Computing gradient...')
-    grads = tensor.grad(cost, wrt=itemlist(updated_params))
+    if accumulate:
+        # the gradients of the training objective are accumulated over
+        # update_every minibatches, weighted by the number of sentences
+        # (the objective is a mean over the sentences of a minibatch), and
+        # divided by the total number of sentences or target tokens; the
+        # gradients of the regularizers are added once per update
+        n_sentences = tensor.cast(y_mask.shape[1], floatX)
+        norm = y_mask.sum() if update_normalization == 'token' else n_sentences
+        logging.info('Building gradient accumulation function...')
+        f_grad, f_reset_grads, grads, grad_buffers = accumulate_gradients(updated_params,
+                                                                          tensor.grad(data_cost, wrt=itemlist(updated_params)),
+                                                                          inps, cost, n_sentences, norm, profile=profile)
+        if isinstance(reg_cost, theano.Variable):
+            grads = [g + g_reg for g, g_reg in zip(grads, tensor.grad(reg_cost, wrt=itemlist(updated_params),
+                                                                      disconnected_inputs='ignore'))]
+        # the optimizer only applies the accumulated gradients
+        update_inps, update_cost = [], None
+    else:
+        grads = tensor.grad(cost, wrt=itemlist(updated_params))
+        update_inps, update_cost = inps, cost
     logging.info('Done')
 
     # apply gradient clipping here
@@ -1599,7 +1977,7 @@ def train(dim_word=512,  # word vector dimensionality
 
     logging.info('Building optimizers...')
     f_update, optimizer_tparams = eval(optimizer)(lr, updated_params,
-                                                                 grads, inps, cost,
+                                                                 grads, update_inps, update_cost,
                                                                  profile=profile,
                                                                  optimizer_params=optimizer_params)
     logging.info('Done')
@@ -1631,357 +2009,416 @@ def train(dim_word=512,  # word vector dimensionality
     last_words = 0
     ud_start = time.time()
     p_validation = None
-    for training_progress.eidx in xrange(training_progress.eidx, max_epochs):
-        n_samples = 0
+    # the worker processes (of training and of validation BLEU) are forked
+    # before any threads are started
+    if workers > 1:
+        trainer = DataParallelTrainer(workers, worker_sync, updated_params.values(), optimizer_tparams.values(),
+                                      f_grad=f_grad if accumulate else None,
+                                      f_reset_grads=f_reset_grads if accumulate else None,
+                                      grad_buffers=grad_buffers if accumulate else None,
+                                      f_update=f_update, update_every=update_every)
+    else:
+        trainer = None
+    bleu_validator = None
+    if bleu and valid is not None:
+        bleu_args = (f_init_batch, f_next_batch, model_options, valid_datasets,
+                     valid.source_dicts, worddicts_r[-1], saveto + '.trans', valid_ref,
+                     postprocess, bleu_beam_size, bleu_maxlen, valid_batch_size)
+        if bleu_background:
+            bleu_validator = BackgroundBleuValidator(tparams, bleu_args)
+    checkpoint_writer = CheckpointWriter()
+    # minibatches whose gradients have been accumulated since the last update
+    accumulated_batches = 0
+    try:
+        for training_progress.eidx in xrange(training_progress.eidx, max_epochs):
+            n_samples = 0
+
+            for batch in train:
+                training_progress.uidx += 1
+                use_noise.set_value(1.)
+
+                #ensure consistency in number of factors
+                #if len(x) and len(x[0]) and len(x[0][0]) != factors:
+                #    logging.error('Mismatch between number of factors in settings ({0}), and number in training corpus ({1})\n'.format(factors, len(x[0][0])))
+                #    sys.exit(1)
+
+                if model_options['objective'] in ['CE', 'RAML']:
+
+                    # with prefetching, minibatches are already prepared
+                    xlen, prepared = batch if prefetch else prepare_minibatch(*batch)
+                    n_samples += xlen
+                    if multi_src:
+                      x1, x1_mask, x2, x2_mask, y, y_mask, sample_weights = prepared
+                      x = x1
+                    else:
+                      x, x_mask, y, y_mask, sample_weights = prepared
 
-        for x, y in train:
-            training_progress.uidx += 1
-            use_noise.set_value(1.)
+                    if x is None:
+                        logging.warning('Minibatch with zero sample under length %d' % maxlen)
+                        training_progress.uidx -= 1
+                        continue
+                
+                    cost_batches += 1
+                    last_disp_samples += xlen
+                    if multi_src:
+                      words = (numpy.sum(x1_mask) + numpy.sum(x2_mask) + numpy.sum(y_mask))/2.0
+                    else:
+                      words = (numpy.sum(x_mask) + numpy.sum(y_mask))/2.0
+                    last_words += words
 
-            #ensure consistency in number of factors
-            #if len(x) and len(x[0]) and len(x[0][0]) != factors:
-            #    logging.error('Mismatch between number of factors in settings ({0}), and number in training corpus ({1})\n'.format(factors, len(x[0][0])))
-            #    sys.exit(1)
+                    # compute cost, grads and update parameters
+                    if model_options['objective'] == 'RAML':
+                        inputs = [x, x_mask, y, y_mask, sample_weights]
+                    else:
+                        if multi_src:
+                          inputs = [x1, x1_mask, y, y_mask]
+                          #inputs = [x1, x1_mask, x2, x2_mask, y, y_mask]
+                        else:
+                          inputs = [x, x_mask, y, y_mask]
+                    if trainer is not None:
+                        # the minibatch is processed by a worker; the costs of
+                        # all minibatches of an update are returned at its end
+                        trainer.submit(inputs, lrate, words)
+                        accumulated_batches += 1
+                        cost = 0.
+                        if accumulated_batches == trainer.batches_per_update:
+                            uidx = training_progress.uidx
+                            # with parameter averaging, the master needs current
+                            # parameters for sampling, validation and checkpoints
+                            average = any(freq and numpy.mod(uidx, freq) == 0
+                                          for freq in (average_every, sampleFreq, validFreq, saveFreq)) or \
+                                      uidx >= finish_after
+                            cost = numpy.sum(trainer.update(lrate, average=average))
+                            accumulated_batches = 0
+                    elif update_every > 1:
+                        cost = f_grad(*inputs)
+                        accumulated_batches += 1
+                        if accumulated_batches == update_every:
+                            f_update(lrate)
+                            f_reset_grads()
+                            accumulated_batches = 0
+                    else:
+                        cost = f_update(lrate, *inputs)
+                    cost_sum += cost
 
-            if model_options['objective'] in ['CE', 'RAML']:
+                elif model_options['objective'] == 'MRT':
+                    x, y = batch
+                    xlen = len(x)
+                    n_samples += xlen
 
-                if model_options['objective'] == 'RAML':
-                    x, y, sample_weights = augment_raml_data(x, y, options=model_options,
-                                                             tgt_worddict=worddicts[-1])
-                                                            
-                else:
-                    sample_weights = [1.0] * len(y)
-                
-                if multi_src:
-                  xlen = len(x[0])
-                  n_samples += xlen
-                  x1, x1_mask, x1, x2_mask, y, y_mask, sample_weights = prepare_data_multi_src(x[0], x[1], y, weights=sample_weights,
-                                                                      maxlen=maxlen,
-                                                                      n_factors=factors,
-                                                                      n_words_src=n_words_src,
-                                                                      n_words=n_words)
-                else:
-                  xlen = len(x)
-                  n_samples += xlen
-                  x, x_mask, y, y_mask, sample_weights = prepare_data(x, y, weights=sample_weights,
-                                                                      maxlen=maxlen,
-                                                                      n_factors=factors,
-                                                                      n_words_src=n_words_src,
-                                                                      n_words=n_words)
-
-                if x is None:
-                    logging.warning('Minibatch with zero sample under length %d' % maxlen)
-                    training_progress.uidx -= 1
-                    continue
-                
-                cost_batches += 1
-                last_disp_samples += xlen
-                if multi_src:
-                  last_words += (numpy.sum(x1_mask) + numpy.sum(x2_mask) + numpy.sum(y_mask))/2.0
-                else:
-                  last_words += (numpy.sum(x_mask) + numpy.sum(y_mask))/2.0
+                    assert maxlen is not None and maxlen > 0
 
-                # compute cost, grads and update parameters
-                if model_options['objective'] == 'RAML':
-                    cost = f_update(lrate, x, x_mask, y, y_mask, sample_weights)
-                else:
-                    if multi_src:
-                      cost = f_update(lrate, x1, x1_mask, y, y_mask)
-                      #cost = f_update(lrate, x1, x1_mask, x2, x2_mask, y, y_mask)
-                    else:
-                      cost = f_update(lrate, x, x_mask, y, y_mask)
-                cost_sum += cost
+                    xy_pairs = [(x_i, y_i) for (x_i, y_i) in zip(x, y) if len(x_i) < maxlen and len(y_i) < maxlen]
+                    if not xy_pairs:
+                        training_progress.uidx -= 1
+                        continue
 
-            elif model_options['objective'] == 'MRT':
-                xlen = len(x)
-                n_samples += xlen
+                    for x_s, y_s in xy_pairs:
 
-                assert maxlen is not None and maxlen > 0
+                        # add EOS and prepare factored data
+                        x, _, _, _ = prepare_data([x_s], [y_s], maxlen=None,
+                                                  n_factors=factors,
+                                                  n_words_src=n_words_src, n_words=n_words)
 
-                xy_pairs = [(x_i, y_i) for (x_i, y_i) in zip(x, y) if len(x_i) < maxlen and len(y_i) < maxlen]
-                if not xy_pairs:
-                    training_progress.uidx -= 1
-                    continue
+                        # draw independent samples to compute mean reward
+                        if model_options['mrt_samples_meanloss']:
+                            use_noise.set_value(0.)
+                            samples, _ = f_sampler(x, model_options['mrt_samples_meanloss'], maxlen)
+                            use_noise.set_value(1.)
+
+                            samples = [numpy.trim_zeros(item) for item in zip(*samples)]
+
+                            # map integers to words (for character-level metrics)
+                            samples = [seqs2words(sample, worddicts_r[-1]) for sample in samples]
+                            ref = seqs2words(y_s, worddicts_r[-1])
 
-                for x_s, y_s in xy_pairs:
+                            #scorers expect tokenized hypotheses/references
+                            ref = ref.split(" ")
+                            samples = [sample.split(" ") for sample in samples]
 
-                    # add EOS and prepare factored data
-                    x, _, _, _ = prepare_data([x_s], [y_s], maxlen=None,
-                                              n_factors=factors,
-                                              n_words_src=n_words_src, n_words=n_words)
+                            # get negative smoothed BLEU for samples
+                            scorer = ScorerProvider().get(model_options['mrt_loss'])
+                            scorer.set_reference(ref)
+                            mean_loss = numpy.array(scorer.score_matrix(samples), dtype=floatX).mean()
+                        else:
+                            mean_loss = 0.
 
-                    # draw independent samples to compute mean reward
-                    if model_options['mrt_samples_meanloss']:
+                        # create k samples
                         use_noise.set_value(0.)
-                        samples, _ = f_sampler(x, model_options['mrt_samples_meanloss'], maxlen)
+                        samples, _ = f_sampler(x, model_options['mrt_samples'], maxlen)
                         use_noise.set_value(1.)
 
                         samples = [numpy.trim_zeros(item) for item in zip(*samples)]
 
+                        # remove duplicate samples
+                        samples.sort()
+                        samples = [s for s, _ in itertools.groupby(samples)]
+
+                        # add gold translation [always in first position]
+                        if model_options['mrt_reference'] or model_options['mrt_ml_mix']:
+                            samples = [y_s] + [s for s in samples if s != y_s]
+
+                        # create mini-batch with masking
+                        x, x_mask, y, y_mask = prepare_data([x_s for _ in xrange(len(samples))], samples,
+                                                                        maxlen=None,
+                                                                        n_factors=factors,
+                                                                        n_words_src=n_words_src,
+                                                                        n_words=n_words)
+
+                        cost_batches += 1
+                        last_disp_samples += xlen
+                        last_words += (numpy.sum(x_mask) + numpy.sum(y_mask))/2.0
+
                         # map integers to words (for character-level metrics)
                         samples = [seqs2words(sample, worddicts_r[-1]) for sample in samples]
-                        ref = seqs2words(y_s, worddicts_r[-1])
+                        y_s = seqs2words(y_s, worddicts_r[-1])
 
                         #scorers expect tokenized hypotheses/references
-                        ref = ref.split(" ")
+                        y_s = y_s.split(" ")
                         samples = [sample.split(" ") for sample in samples]
 
                         # get negative smoothed BLEU for samples
                         scorer = ScorerProvider().get(model_options['mrt_loss'])
-                        scorer.set_reference(ref)
-                        mean_loss = numpy.array(scorer.score_matrix(samples), dtype=floatX).mean()
+                        scorer.set_reference(y_s)
+                        loss = mean_loss - numpy.array(scorer.score_matrix(samples), dtype=floatX)
+
+                        # compute cost, grads and update parameters
+                        cost = f_update(lrate, x, x_mask, y, y_mask, loss)
+                        cost_sum += cost
+
+                # check for bad numbers, usually we remove non-finite elements
+                # and continue training - but not done here
+                if numpy.isnan(cost) or numpy.isinf(cost):
+                    logging.warning('NaN detected')
+                    return 1., 1., 1.
+
+                # with gradient accumulation, only count complete updates:
+                # uidx was incremented for every minibatch, so it is reset
+                # until the update is applied. This comes after the NaN check,
+                # so that the cost of every minibatch is checked, but before
+                # display, checkpoints and validation, which need complete
+                # updates
+                if accumulated_batches:
+                    training_progress.uidx -= 1
+                    continue
+
+                # verbose
+                if numpy.mod(training_progress.uidx, dispFreq) == 0:
+                    ud = time.time() - ud_start
+                    sps = last_disp_samples / float(ud)
+                    wps = last_words / float(ud)
+                    cost_avg = cost_sum / float(cost_batches)
+                    message = 'Epoch {epoch} Update {update} Cost {cost} UD {ud} {sps} {wps}'.format(
+                            epoch=training_progress.eidx,
+                            update=training_progress.uidx,
+                            cost=cost_avg,
+                            ud=ud,
+                            sps="{0:.2f} sents/s".format(sps),
+                            wps="{0:.2f} words/s".format(wps)
+                        )
+                    if prefetch:
+                        message += ' data wait {0:.2f}s'.format(train.wait_time)
+                        train.wait_time = 0.
+                    if trainer is not None:
+                        # throughput of each worker while it is busy, and the
+                        # fraction of it that training achieves in total
+                        worker_wps = trainer.throughput()
+                        message += ' worker words/s {0} efficiency {1:.1%}'.format(
+                            ' '.join('{0:.0f}'.format(w) for w in worker_wps), wps / max(worker_wps.sum(), 1e-6))
+                    logging.info(message)
+                    ud_start = time.time()
+                    cost_batches = 0
+                    last_disp_samples = 0
+                    last_words = 0
+                    cost_sum = 0
+
+                # save the best model so far, in addition, save the latest model
+                # into a separate file with the iteration number for external eval;
+                # training only waits for a snapshot of the parameters, which is
+                # written in the background
+                if numpy.mod(training_progress.uidx, saveFreq) == 0:
+                    save_start = time.time()
+                    blocked_time = checkpoint_writer.blocked_time
+                    saveto_uidx = '{}.iter{}.npz'.format(
+                        os.path.splitext(saveto)[0], training_progress.uidx)
+                    if best_p is not None:
+                        logging.info('Saving the best model...')
+                        checkpoint_writer.save(best_p, best_opt_p, training_progress, [saveto],
+                                               write_params=not best_p_saved)
+                        best_p_saved = True
+                        if not overwrite:
+                            logging.info('Saving the model at iteration {}...'.format(training_progress.uidx))
+                            params = unzip_from_theano(tparams, excluding_prefix='prior_')
+                            optimizer_params = unzip_from_theano(optimizer_tparams, excluding_prefix='prior_')
+                            checkpoint_writer.save(params, optimizer_params, training_progress, [saveto_uidx])
                     else:
-                        mean_loss = 0.
+                        # the best model is the current model
+                        logging.info('Saving the model at iteration {}...'.format(training_progress.uidx))
+                        params = unzip_from_theano(tparams, excluding_prefix='prior_')
+                        optimizer_params = unzip_from_theano(optimizer_tparams, excluding_prefix='prior_')
+                        checkpoint_writer.save(params, optimizer_params, training_progress,
+                                               [saveto] if overwrite else [saveto, saveto_uidx])
+                    logging.info('Checkpoint took {0:.2f}s of training time (waiting for previous checkpoints: {1:.2f}s)'.format(
+                        time.time() - save_start, checkpoint_writer.blocked_time - blocked_time))
+
+
+                # generate some samples with the model and display them
+                if sampleFreq and numpy.mod(training_progress.uidx, sampleFreq) == 0:
+                    # FIXME: random selection?
+                    for jj in xrange(numpy.minimum(5, x.shape[2])):
+                        stochastic = True
+                        x_current = x[:, :, jj][:, :, None]
+
+                        # remove padding
+                        x_current = x_current[:,:x_mask.astype('int64')[:, jj].sum(),:]
+
+                        sample, score, sample_word_probs, alignment, hyp_graph = gen_sample([f_init], [f_next],
+                                                   x_current,
+                                                   model_options,
+                                                   trng=trng, k=1,
+                                                   maxlen=30,
+                                                   stochastic=stochastic,
+                                                   argmax=False,
+                                                   suppress_unk=False,
+                                                   return_hyp_graph=False)
+                        print 'Source ', jj, ': ',
+                        for pos in range(x.shape[1]):
+                            if x[0, pos, jj] == 0:
+                                break
+                            for factor in range(factors):
+                                vv = x[factor, pos, jj]
+                                if vv in worddicts_r[factor]:
+                                    sys.stdout.write(worddicts_r[factor][vv])
+                                else:
+                                    sys.stdout.write('UNK')
+                                if factor+1 < factors:
+                                    sys.stdout.write('|')
+                                else:
+                                    sys.stdout.write(' ')
+                        print
+                        print 'Truth ', jj, ' : ',
+                        for vv in y[:, jj]:
+                            if vv == 0:
+                                break
+                            if vv in worddicts_r[-1]:
+                                print worddicts_r[-1][vv],
+                            else:
+                                print 'UNK',
+                        print
+                        print 'Sample ', jj, ': ',
+                        if stochastic:
+                            ss = sample[0]
+                        else:
+                            score = score / numpy.array([len(s) for s in sample])
+                            ss = sample[score.argmin()]
+                        for vv in ss:
+                            if vv == 0:
+                                break
+                            if vv in worddicts_r[-1]:
+                                print worddicts_r[-1][vv],
+                            else:
+                                print 'UNK',
+                        print
 
-                    # create k samples
+                # validate model on validation set and early stop if necessary
+                if valid is not None and validFreq and numpy.mod(training_progress.uidx, validFreq) == 0:
                     use_noise.set_value(0.)
-                    samples, _ = f_sampler(x, model_options['mrt_samples'], maxlen)
-                    use_noise.set_value(1.)
-
-                    samples = [numpy.trim_zeros(item) for item in zip(*samples)]
-
-                    # remove duplicate samples
-                    samples.sort()
-                    samples = [s for s, _ in itertools.groupby(samples)]
-
-                    # add gold translation [always in first position]
-                    if model_options['mrt_reference'] or model_options['mrt_ml_mix']:
-                        samples = [y_s] + [s for s in samples if s != y_s]
-
-                    # create mini-batch with masking
-                    x, x_mask, y, y_mask = prepare_data([x_s for _ in xrange(len(samples))], samples,
-                                                                    maxlen=None,
-                                                                    n_factors=factors,
-                                                                    n_words_src=n_words_src,
-                                                                    n_words=n_words)
-
-                    cost_batches += 1
-                    last_disp_samples += xlen
-                    last_words += (numpy.sum(x_mask) + numpy.sum(y_mask))/2.0
-
-                    # map integers to words (for character-level metrics)
-                    samples = [seqs2words(sample, worddicts_r[-1]) for sample in samples]
-                    y_s = seqs2words(y_s, worddicts_r[-1])
-
-                    #scorers expect tokenized hypotheses/references
-                    y_s = y_s.split(" ")
-                    samples = [sample.split(" ") for sample in samples]
-
-                    # get negative smoothed BLEU for samples
-                    scorer = ScorerProvider().get(model_options['mrt_loss'])
-                    scorer.set_reference(y_s)
-                    loss = mean_loss - numpy.array(scorer.score_matrix(samples), dtype=floatX)
-
-                    # compute cost, grads and update parameters
-                    cost = f_update(lrate, x, x_mask, y, y_mask, loss)
-                    cost_sum += cost
+                    valid_errs, alignment = pred_probs(f_log_probs, prepare_data,
+                                            model_options, valid)
+                    valid_err = valid_errs.mean()
+                    training_progress.history_errs.append(float(valid_err))
+
+                    if training_progress.uidx == 0 or valid_err <= numpy.array(training_progress.history_errs).min():
+                        best_p = unzip_from_theano(tparams, excluding_prefix='prior_')
+                        best_opt_p = unzip_from_theano(optimizer_tparams, excluding_prefix='prior_')
+                        best_p_saved = False
+                        training_progress.bad_counter = 0
+                    if valid_err >= numpy.array(training_progress.history_errs).min():
+                        training_progress.bad_counter += 1
+                        if training_progress.bad_counter > patience:
+
+                            # change mix of in-domain and out-of-domain data
+                            if use_domain_interpolation and (training_progress.domain_interpolation_cur < domain_interpolation_max):
+                                training_progress.domain_interpolation_cur = min(training_progress.domain_interpolation_cur + domain_interpolation_inc, domain_interpolation_max)
+                                logging.info('No progress on the validation set, increasing domain interpolation rate to %s and resuming from best params' % training_progress.domain_interpolation_cur)
+                                train.adjust_domain_interpolation_rate(training_progress.domain_interpolation_cur)
+                                if best_p is not None:
+                                    zip_to_theano(best_p, tparams)
+                                    zip_to_theano(best_opt_p, optimizer_tparams)
+                                training_progress.bad_counter = 0
+
+                            # anneal learning rate and reset optimizer parameters
+                            elif training_progress.anneal_restarts_done < anneal_restarts:
+                                logging.info('No progress on the validation set, annealing learning rate and resuming from best params.')
+                                lrate *= anneal_decay
+                                training_progress.anneal_restarts_done += 1
+                                training_progress.bad_counter = 0
+
+                                # reload best parameters
+                                if best_p is not None:
+                                    zip_to_theano(best_p, tparams)
+
+                                # reset optimizer parameters
+                                for item in optimizer_tparams.values():
+                                    item.set_value(numpy.array(item.get_value()) * 0.)
+
+                            # stop
+                            else:
+                                logging.info('Valid {}'.format(valid_err))
+                                logging.info('Early Stop!')
+                                training_progress.estop = True
+                                break
 
-            # check for bad numbers, usually we remove non-finite elements
-            # and continue training - but not done here
-            if numpy.isnan(cost) or numpy.isinf(cost):
-                logging.warning('NaN detected')
-                return 1., 1., 1.
-
-            # verbose
-            if numpy.mod(training_progress.uidx, dispFreq) == 0:
-                ud = time.time() - ud_start
-                sps = last_disp_samples / float(ud)
-                wps = last_words / float(ud)
-                cost_avg = cost_sum / float(cost_batches)
-                logging.info(
-                    'Epoch {epoch} Update {update} Cost {cost} UD {ud} {sps} {wps}'.format(
-                        epoch=training_progress.eidx,
-                        update=training_progress.uidx,
-                        cost=cost_avg,
-                        ud=ud,
-                        sps="{0:.2f} sents/s".format(sps),
-                        wps="{0:.2f} words/s".format(wps)
-                    )
-                )
-                ud_start = time.time()
-                cost_batches = 0
-                last_disp_samples = 0
-                last_words = 0
-                cost_sum = 0
-
-            # save the best model so far, in addition, save the latest model
-            # into a separate file with the iteration number for external eval
-            if numpy.mod(training_progress.uidx, saveFreq) == 0:
-                logging.info('Saving the best model...')
-                if best_p is not None:
-                    params = best_p
-                    optimizer_params = best_opt_p
-                else:
-                    params = unzip_from_theano(tparams, excluding_prefix='prior_')
-                    optimizer_params = unzip_from_theano(optimizer_tparams, excluding_prefix='prior_')
+                    logging.info('Valid {}'.format(valid_err))
 
-                save(params, optimizer_params, training_progress, saveto)
-                logging.info('Done')
+                    if bleu:
+                        if bleu_validator is not None:
+                            bleu_validator.validate(training_progress.uidx)
+                        else:
+                            validate_bleu(*bleu_args, uidx=training_progress.uidx)
+
+                    if external_validation_script:
+                        logging.info("Calling external validation script")
+                        if p_validation is not None and p_validation.poll() is None:
+                            logging.info("Waiting for previous validation run to finish")
+                            logging.info("If this takes too long, consider increasing validation interval, reducing validation set size, or speeding up validation by using multiple processes")
+                            valid_wait_start = time.time()
+                            p_validation.wait()
+                            logging.info("Waited for {0:.1f} seconds".format(time.time()-valid_wait_start))
+                        logging.info('Saving  model...')
+                        params = unzip_from_theano(tparams, excluding_prefix='prior_')
+                        optimizer_params = unzip_from_theano(optimizer_tparams, excluding_prefix='prior_')
+                        checkpoint_writer.save(params, optimizer_params, training_progress, [saveto+'.dev'])
+                        json.dump(model_options, open('%s.dev.npz.json' % saveto, 'wb'), indent=2)
+                        # the script reads the model
+                        checkpoint_writer.wait()
+                        logging.info('Done')
+                        p_validation = Popen([external_validation_script])
+
+                # finish after this many updates
+                if training_progress.uidx >= finish_after:
+                    logging.info('Finishing after %d iterations!' % training_progress.uidx)
+                    training_progress.estop = True
+                    break
 
-                # save with uidx
-                if not overwrite:
-                    logging.info('Saving the model at iteration {}...'.format(training_progress.uidx))
-                    saveto_uidx = '{}.iter{}.npz'.format(
-                        os.path.splitext(saveto)[0], training_progress.uidx)
+            logging.info('Seen %d samples' % n_samples)
 
-                    params = unzip_from_theano(tparams, excluding_prefix='prior_')
-                    optimizer_params = unzip_from_theano(optimizer_tparams, excluding_prefix='prior_')
-                    save(params, optimizer_params, training_progress, saveto_uidx)
-                    logging.info('Done')
-
-
-            # generate some samples with the model and display them
-            if sampleFreq and numpy.mod(training_progress.uidx, sampleFreq) == 0:
-                # FIXME: random selection?
-                for jj in xrange(numpy.minimum(5, x.shape[2])):
-                    stochastic = True
-                    x_current = x[:, :, jj][:, :, None]
-
-                    # remove padding
-                    x_current = x_current[:,:x_mask.astype('int64')[:, jj].sum(),:]
-
-                    sample, score, sample_word_probs, alignment, hyp_graph = gen_sample([f_init], [f_next],
-                                               x_current,
-                                               model_options,
-                                               trng=trng, k=1,
-                                               maxlen=30,
-                                               stochastic=stochastic,
-                                               argmax=False,
-                                               suppress_unk=False,
-                                               return_hyp_graph=False)
-                    print 'Source ', jj, ': ',
-                    for pos in range(x.shape[1]):
-                        if x[0, pos, jj] == 0:
-                            break
-                        for factor in range(factors):
-                            vv = x[factor, pos, jj]
-                            if vv in worddicts_r[factor]:
-                                sys.stdout.write(worddicts_r[factor][vv])
-                            else:
-                                sys.stdout.write('UNK')
-                            if factor+1 < factors:
-                                sys.stdout.write('|')
-                            else:
-                                sys.stdout.write(' ')
-                    print
-                    print 'Truth ', jj, ' : ',
-                    for vv in y[:, jj]:
-                        if vv == 0:
-                            break
-                        if vv in worddicts_r[-1]:
-                            print worddicts_r[-1][vv],
-                        else:
-                            print 'UNK',
-                    print
-                    print 'Sample ', jj, ': ',
-                    if stochastic:
-                        ss = sample[0]
-                    else:
-                        score = score / numpy.array([len(s) for s in sample])
-                        ss = sample[score.argmin()]
-                    for vv in ss:
-                        if vv == 0:
-                            break
-                        if vv in worddicts_r[-1]:
-                            print worddicts_r[-1][vv],
-                        else:
-                            print 'UNK',
-                    print
-
-            # validate model on validation set and early stop if necessary
-            if valid is not None and validFreq and numpy.mod(training_progress.uidx, validFreq) == 0:
-                use_noise.set_value(0.)
-                valid_errs, alignment = pred_probs(f_log_probs, prepare_data,
-                                        model_options, valid)
-                valid_err = valid_errs.mean()
-                training_progress.history_errs.append(float(valid_err))
-
-                if training_progress.uidx == 0 or valid_err <= numpy.array(training_progress.history_errs).min():
-                    best_p = unzip_from_theano(tparams, excluding_prefix='prior_')
-                    best_opt_p = unzip_from_theano(optimizer_tparams, excluding_prefix='prior_')
-                    training_progress.bad_counter = 0
-                if valid_err >= numpy.array(training_progress.history_errs).min():
-                    training_progress.bad_counter += 1
-                    if training_progress.bad_counter > patience:
-
-                        # change mix of in-domain and out-of-domain data
-                        if use_domain_interpolation and (training_progress.domain_interpolation_cur < domain_interpolation_max):
-                            training_progress.domain_interpolation_cur = min(training_progress.domain_interpolation_cur + domain_interpolation_inc, domain_interpolation_max)
-                            logging.info('No progress on the validation set, increasing domain interpolation rate to %s and resuming from best params' % training_progress.domain_interpolation_cur)
-                            train.adjust_domain_interpolation_rate(training_progress.domain_interpolation_cur)
-                            if best_p is not None:
-                                zip_to_theano(best_p, tparams)
-                                zip_to_theano(best_opt_p, optimizer_tparams)
-                            training_progress.bad_counter = 0
-
-                        # anneal learning rate and reset optimizer parameters
-                        elif training_progress.anneal_restarts_done < anneal_restarts:
-                            logging.info('No progress on the validation set, annealing learning rate and resuming from best params.')
-                            lrate *= anneal_decay
-                            training_progress.anneal_restarts_done += 1
-                            training_progress.bad_counter = 0
-
-                            # reload best parameters
-                            if best_p is not None:
-                                zip_to_theano(best_p, tparams)
-
-                            # reset optimizer parameters
-                            for item in optimizer_tparams.values():
-                                item.set_value(numpy.array(item.get_value()) * 0.)
-
-                        # stop
-                        else:
-                            logging.info('Valid {}'.format(valid_err))
-                            logging.info('Early Stop!')
-                            training_progress.estop = True
-                            break
-
-                logging.info('Valid {}'.format(valid_err))
-
-                if bleu:
-                    translations = get_translation(f_init, f_next, model_options, valid_datasets, valid.source_dicts, trng)
-                    translations = [seqs2words(t, worddicts_r[-1]) for t in translations]
-
-                    output_file = saveto + '.trans'
-                    valid_output = open(output_file, 'w')
-                    if postprocess == 'bpe':
-                        for i, t in enumerate(translations):
-                            t = t.replace('@@ ', '')
-                            print >> valid_output, t
-                    else:
-                        for i, t in enumerate(translations):
-                            print >> valid_output, t
-                    valid_output.close()
-                    valid_refs = util.get_ref_files(valid_ref)
-                    bleu = 100 * util.bleu_file(output_file, valid_refs)
-                    logging.info('Valid bleu {}\n'.format(bleu))
-
-                if external_validation_script:
-                    logging.info("Calling external validation script")
-                    if p_validation is not None and p_validation.poll() is None:
-                        logging.info("Waiting for previous validation run to finish")
-                        logging.info("If this takes too long, consider increasing validation interval, reducing validation set size, or speeding up validation by using multiple processes")
-                        valid_wait_start = time.time()
-                        p_validation.wait()
-                        logging.info("Waited for {0:.1f} seconds".format(time.time()-valid_wait_start))
-                    logging.info('Saving  model...')
-                    params = unzip_from_theano(tparams, excluding_prefix='prior_')
-                    optimizer_params = unzip_from_theano(optimizer_tparams, excluding_prefix='prior_')
-                    save(params, optimizer_params, training_progress, saveto+'.dev')
-                    json.dump(model_options, open('%s.dev.npz.json' % saveto, 'wb'), indent=2)
-                    logging.info('Done')
-                    p_validation = Popen([external_validation_script])
-
-            # finish after this many updates
-            if training_progress.uidx >= finish_after:
-                logging.info('Finishing after %d iterations!' % training_progress.uidx)
-                training_progress.estop = True
+            if training_progress.estop:
                 break
+    finally:
+        # also if training stops early (e.g. on NaN) or with an error
+        if prefetch:
+            train.close()
 
-        logging.info('Seen %d samples' % n_samples)
+        if trainer is not None:
+            trainer.close()
 
-        if training_progress.estop:
-            break
+        if bleu_validator is not None:
+            bleu_validator.close()
+
+        checkpoint_writer.close()
+        logging.info('Time spent writing checkpoints: {0:.1f}s (training blocked for {1:.1f}s)'.format(
+            checkpoint_writer.write_time, checkpoint_writer.blocked_time))
 
     if best_p is not None:
         zip_to_theano(best_p, tparams)
@@ -2014,6 +2451,8 @@ if __name__ == '__main__':
     data = parser.add_argument_group('data sets; model loading and saving')
     data.add_argument('--datasets', type=str, required=True, metavar='PATH', nargs=2,
                          help="parallel training corpus (source and target)")
+    data.add_argument('--binarized_datasets', action='store_true',
+                         help="training corpus has been binarized with binarize.py; '--datasets' gives the prefixes of the binarized source and target files")
     data.add_argument('--dictionaries', type=str, required=True, metavar='PATH', nargs="+",
                          help="network vocabularies (one per source factor, plus target vocabulary)")
     data.add_argument('--model', type=str, default='model.npz', metavar='PATH', dest='saveto',
@@ -2098,6 +2537,18 @@ if __name__ == '__main__':
                          help="optimizer (default: %(default)s)")
     training.add_argument('--batch_size', type=int, default=80, metavar='INT',
                          help="minibatch size (default: %(default)s)")
+    training.add_argument('--token_batch_size', type=int, default=0, metavar='INT',
+                         help="minibatch size (expressed in number of source or target tokens, including padding). Sentence-level minibatch size will be dynamic. If this is enabled, batch_size only affects sorting by length. (default: %(default)s)")
+    training.add_argument('--update_every', type=int, default=1, metavar='INT',
+                         help="accumulate the gradients of INT minibatches for each update, to train with larger effective batches (default: %(default)s)")
+    training.add_argument('--update_normalization', type=str, default='sentence', choices=['sentence', 'token'],
+                         help="with --update_every, average the accumulated gradients per sentence (as for a single large minibatch), or per target token (default: %(default)s)")
+    training.add_argument('--workers', type=int, default=1, metavar='INT',
+                         help="number of training processes (data parallelism on a single CPU host); each update is computed from update_every minibatches per worker. Set OMP_NUM_THREADS so that workers * threads does not exceed the number of cores (default: %(default)s)")
+    training.add_argument('--worker_sync', type=str, default='gradients', choices=['gradients', 'parameters'],
+                         help="with --workers, sum the gradients of all workers for each update, or let each worker update its own parameters, and average them every --average_every updates (default: %(default)s)")
+    training.add_argument('--average_every', type=int, default=10, metavar='INT',
+                         help="with --worker_sync parameters, average the parameters of the workers every INT updates (default: %(default)s)")
     training.add_argument('--max_epochs', type=int, default=5000, metavar='INT',
                          help="maximum number of epochs (default: %(default)s)")
     training.add_argument('--finish_after', type=int, default=10000000, metavar='INT',
@@ -2114,10 +2565,14 @@ if __name__ == '__main__':
                          help="learning rate (default: %(default)s)")
     training.add_argument('--no_shuffle', action="store_false", dest="shuffle_each_epoch",
                          help="disable shuffling of training data (for each epoch)")
+    training.add_argument('--shuffle_seed', type=int, default=None, metavar='INT',
+                         help="seed for shuffling the training data; the order of each epoch is reproduced if training is resumed (default: random)")
     training.add_argument('--no_sort_by_length', action="store_false", dest="sort_by_length",
                          help='do not sort sentences in maxibatch by length')
     training.add_argument('--maxibatch_size', type=int, default=20, metavar='INT',
                          help='size of maxibatch (number of minibatches that are sorted by length) (default: %(default)s)')
+    training.add_argument('--prefetch', type=int, default=0, metavar='INT',
+                         help='prepare up to INT minibatches in a background process while the model is updated; 0 disables prefetching (not supported with MRT or domain interpolation) (default: %(default)s)')
     training.add_argument('--objective', choices=['CE', 'MRT', 'RAML'], default='CE',
                          help='training objective. CE: cross-entropy minimization (default); MRT: Minimum Risk Training (https://www.aclweb.org/anthology/P/P16/P16-1159.pdf) \
                                RAML: Reward Augmented Maximum Likelihood (https://papers.nips.cc/paper/6547-reward-augmented-maximum-likelihood-for-neural-structured-prediction.pdf)')
@@ -2131,6 +2586,10 @@ if __name__ == '__main__':
                          help="parallel validation corpus (source and target) (default: %(default)s)")
     validation.add_argument('--valid_batch_size', type=int, default=80, metavar='INT',
                          help="validation minibatch size (default: %(default)s)")
+    validation.add_argument('--valid_token_batch_size', type=int, default=0, metavar='INT',
+                         help="validation minibatch size (expressed in number of source or target tokens, including padding). Sentence-level minibatch size will be dynamic. If this is enabled, valid_batch_size only affects sorting by length. (default: %(default)s)")
+    validation.add_argument('--cache_valid_batches', action="store_true",
+                         help="prepare the validation minibatches once (sorted by length over the whole validation set), and keep them in memory (not supported with --multi_src)")
     validation.add_argument('--validFreq', type=int, default=10000, metavar='INT',
                          help="validation frequency (default: %(default)s)")
     validation.add_argument('--patience', type=int, default=10, metavar='INT',
@@ -2183,7 +2642,14 @@ if __name__ == '__main__':
                          help="indomain parallel training corpus (source and target)")
 
     decode = parser.add_argument_group('decoding')
-    decode.add_argument('--bleu', action="store_true")
+    decode.add_argument('--bleu', action="store_true",
+                         help="compute the BLEU score of the validation set (translated with beam search) at each validation")
+    decode.add_argument('--bleu_beam_size', type=int, default=12, metavar='INT',
+                         help="beam size for validation BLEU (default: %(default)s)")
+    decode.add_argument('--bleu_maxlen', type=int, default=50, metavar='INT',
+                         help="maximum length of validation translations (default: %(default)s)")
+    decode.add_argument('--bleu_background', action="store_true",
+                         help="compute validation BLEU in a separate process (on a snapshot of the parameters), so that training continues (CPU only)")
     decode.add_argument('--valid_ref', type=str, help="reference for bleu")
     decode.add_argument('--postprocess', type=str, help="post process: (bpe)")
 
@@ -31,6 +31,7 @@ import subprocess
 profile = False
 
 from data_iterator import TextIterator, MultiSrcTextIterator
+from batch_util import BatchBuffers, prepare_batch
 from training_progress import TrainingProgress
 from util import *
 from theano_util import *
@@ -46,114 +47,39 @@ from domain_interpolation_data_iterator import DomainInterpolatorTextIterator
 
 # batch preparation
 def prepare_data_multi_src(seqs_x1, seqs_x2, seqs_y, weights=None, maxlen=None, n_words_src=30000,
-                 n_words=30000, n_factors=1):
+                 n_words=30000, n_factors=1, buffers=None):
     # x: a list of sentences
-    lengths_x1 = [len(s) for s in seqs_x1]
-    lengths_x2 = [len(s) for s in seqs_x2]
-    lengths_y = [len(s) for s in seqs_y]
-
-    if maxlen is not None:
-        new_seqs_x1 = []
-        new_seqs_x2 = []
-        new_seqs_y = []
-        new_lengths_x1 = []
-        new_lengths_x2 = []
-        new_lengths_y = []
-        new_weights = []
-        if weights is None:
-            weights = [None] * len(seqs_y) # to make the zip easier
-        for l_x1, s_x1, l_x2, s_x2, l_y, s_y, w in zip(lengths_x1, seqs_x1, lengths_x2, seqs_x2, lengths_y, seqs_y, weights):
-            if l_x1 < maxlen and l_y < maxlen and l_x2 < maxlen:
-                new_seqs_x1.append(s_x1)
-                new_seqs_x2.append(s_x2)
-                new_lengths_x1.append(l_x1)
-                new_lengths_x2.append(l_x2)
-                new_seqs_y.append(s_y)
-                new_lengths_y.append(l_y)
-                new_weights.append(w)
-        lengths_x1 = new_lengths_x1
-        seqs_x1 = new_seqs_x1
-        lengths_x2 = new_lengths_x2
-        seqs_x2 = new_seqs_x2
-        lengths_y = new_lengths_y
-        seqs_y = new_seqs_y
-        weights = new_weights
-
-        if len(lengths_x1) < 1 or len(lengths_x2) < 1 or len(lengths_y) < 1:
-            if weights is not None:
-                return None, None, None, None, None
-            else:
-                return None, None, None, None
-
-    n_samples = len(seqs_x1)
-    maxlen_x1 = numpy.max(lengths_x1) + 1
-    maxlen_x2 = numpy.max(lengths_x2) + 1
-    maxlen_y = numpy.max(lengths_y) + 1
-
-    x1 = numpy.zeros((n_factors, maxlen_x1, n_samples)).astype('int64')
-    x2 = numpy.zeros((n_factors, maxlen_x2, n_samples)).astype('int64')
-    y = numpy.zeros((maxlen_y, n_samples)).astype('int64')
-    x1_mask = numpy.zeros((maxlen_x1, n_samples)).astype(floatX)
-    x2_mask = numpy.zeros((maxlen_x2, n_samples)).astype(floatX)
-    y_mask = numpy.zeros((maxlen_y, n_samples)).astype(floatX)
-    for idx, [s_x1, s_x2, s_y] in enumerate(zip(seqs_x1, seqs_x2, seqs_y)):
-        x1[:, :lengths_x1[idx], idx] = zip(*s_x1)
-        x1_mask[:lengths_x1[idx]+1, idx] = 1.
-        x2[:, :lengths_x2[idx], idx] = zip(*s_x2)
-        x2_mask[:lengths_x2[idx]+1, idx] = 1.
-        y[:lengths_y[idx], idx] = s_y
-        y_mask[:lengths_y[idx]+1, idx] = 1.
+    if maxlen is not None and weights is None:
+        weights = [None] * len(seqs_y) # to keep the number of return values
+    batch = prepare_batch([seqs_x1, seqs_x2], seqs_y, weights=weights, maxlen=maxlen,
+                          n_factors=n_factors, mask_dtype=floatX, buffers=buffers)
+    if batch is None:
+        if weights is not None:
+            return None, None, None, None, None
+        else:
+            return None, None, None, None
+
+    [(x1, x1_mask), (x2, x2_mask)], (y, y_mask), weights, lengths = batch
+    lengths_x1, lengths_x2 = [l.tolist() for l in lengths]
     if weights is not None:
-        return x1, x1_mask, x2, x2_mask, y, y_mask, weights, lengths_x1, lengths_x2 
+        return x1, x1_mask, x2, x2_mask, y, y_mask, weights, lengths_x1, lengths_x2
     else:
         return x1, x1_mask, x2, x2_mask, y, y_mask, lengths_x1, lengths_x2
 
 def prepare_data(seqs_x, seqs_y, weights=None, maxlen=None, n_words_src=30000,
-                 n_words=30000, n_factors=1):
+                 n_words=30000, n_factors=1, buffers=None):
     # x: a list of sentences
-    lengths_x = [len(s) for s in seqs_x]
-    lengths_y = [len(s) for s in seqs_y]
-
-    if maxlen is not None:
-        new_seqs_x = []
-        new_seqs_y = []
-        new_lengths_x = []
-        new_lengths_y = []
-        new_weights = []
-        if weights is None:
-            weights = [None] * len(seqs_y) # to make the zip easier
-        for l_x, s_x, l_y, s_y, w in zip(lengths_x, seqs_x, lengths_y, seqs_y, weights):
-            if l_x < maxlen and l_y < maxlen:
-                new_seqs_x.append(s_x)
-                new_lengths_x.append(l_x)
-                new_seqs_y.append(s_y)
-                new_lengths_y.append(l_y)
-                new_weights.append(w)
-        lengths_x = new_lengths_x
-        seqs_x = new_seqs_x
-        lengths_y = new_lengths_y
-        seqs_y = new_seqs_y
-        weights = new_weights
-
-        if len(lengths_x) < 1 or len(lengths_y) < 1:
-            if weights is not None:
-                return None, None, None, None, None
-            else:
-                return None, None, None, None
-
-    n_samples = len(seqs_x)
-    maxlen_x = numpy.max(lengths_x) + 1
-    maxlen_y = numpy.max(lengths_y) + 1
-
-    x = numpy.zeros((n_factors, maxlen_x, n_samples)).astype('int64')
-    y = numpy.zeros((maxlen_y, n_samples)).astype('int64')
-    x_mask = numpy.zeros((maxlen_x, n_samples)).astype(floatX)
-    y_mask = numpy.zeros((maxlen_y, n_samples)).astype(floatX)
-    for idx, [s_x, s_y] in enumerate(zip(seqs_x, seqs_y)):
-        x[:, :lengths_x[idx], idx] = zip(*s_x)
-        x_mask[:lengths_x[idx]+1, idx] = 1.
-        y[:lengths_y[idx], idx] = s_y
-        y_mask[:lengths_y[idx]+1, idx] = 1.
+    if maxlen is not None and weights is None:
+        weights = [None] * len(seqs_y) # to keep the number of return values
+    batch = prepare_batch([seqs_x], seqs_y, weights=weights, maxlen=maxlen,
+                          n_factors=n_factors, mask_dtype=floatX, buffers=buffers)
+    if batch is None:
+        if weights is not None:
+            return None, None, None, None, None
+        else:
+            return None, None, None, None
+
+    [(x, x_mask)], (y, y_mask), weights, _ = batch
     if weights is not None:
         return x, x_mask, y, y_mask, weights
     else:
@@ -1173,6 +1099,7 @@ def pred_probs(f_log_probs, prepare_data_multi_src, options, iterator, verbose=T
 
     alignments1_json = []
     alignments2_json = []
+    buffers = BatchBuffers()
 
     for x, y, a1, a2 in iterator:
         #ensure consistency in number of factors
@@ -1185,7 +1112,8 @@ def pred_probs(f_log_probs, prepare_data_multi_src, options, iterator, verbose=T
         x1, x1_mask, x2, x2_mask, y, y_mask, a1, a2 = prepare_data_multi_src(x[0], x[1], y,
                                             n_words_src=options['n_words_src'],
                                             n_words=options['n_words'],
-                                            n_factors=options['factors'])
+                                            n_factors=options['factors'],
+                                            buffers=buffers)
         if options['align']:
             a1_matrix = get_align_matrix(y.shape[1], x1.shape[1], x2.shape[1], lengths_x1, lengths_x2,  a1)
             if options['cov']:
@@ -16,6 +16,32 @@ from theano_util import *
 # f_update = name(hyperp, tparams, grads, inputs (list), cost)
 # with profile as an optional argument
 
+def accumulate_gradients(tparams, grads, inp, cost, weight, norm, profile=False):
+    """
+    Gradient accumulation over several minibatches. Compiles
+    f_grad(*inp), which adds the gradients grads of a minibatch (multiplied
+    by weight) to shared buffers, and norm to a shared normalizer, and
+    returns cost; and f_reset(), which clears the buffers. Returns f_grad,
+    f_reset, the averaged gradients (the buffers divided by the normalizer)
+    and the buffers (the normalizer last); an optimizer called with the
+    averaged gradients and no inputs applies the accumulated update.
+    """
+    updates = []
+    accumulators = []
+
+    for p, g in zip(tparams.values(), grads):
+        acc = theano.shared(p.get_value() * 0., 'grad_' + p.name)
+        accumulators.append(acc)
+        updates.append((acc, acc + weight * g))
+    total_norm = theano.shared(numpy_floatX(0.), 'grad_norm')
+    updates.append((total_norm, total_norm + norm))
+
+    f_grad = theano.function(inp, cost, updates=updates, profile=profile)
+    f_reset = theano.function([], [], updates=[(v, tensor.zeros_like(v)) for v in accumulators + [total_norm]],
+                              profile=profile)
+
+    return f_grad, f_reset, [acc / total_norm for acc in accumulators], accumulators + [total_norm]
+
 def adam(lr, tparams, grads, inp, cost, beta1=0.9, beta2=0.999, e=1e-8, optimizer_params={}, profile=False):
     PREFIX='adam_'
 
@@ -0,0 +1,235 @@
+'''
+Data-parallel training on a single (CPU) host.
+
+The master process, which reads the training data and does checkpoints and
+validation, forks worker processes once the training functions are
+compiled, and distributes the minibatches of each update over the workers:
+
+- with gradient synchronization, each worker accumulates the gradients of
+  its minibatches (see `optimizers.accumulate_gradients`); the master sums
+  the gradients of all workers, applies the update once, and the workers
+  load the new parameters before the next update.
+- with parameter averaging, each worker updates its own copy of the model
+  (and of the optimizer state) with its minibatches, and the master
+  averages the parameters and optimizer state of the workers every few
+  updates.
+
+Parameters and gradients are exchanged through arrays in shared memory;
+minibatches and costs are passed through queues.
+'''
+
+import time
+import ctypes
+import logging
+import traceback
+import Queue
+
+from multiprocessing import Process, Queue as ProcessQueue
+from multiprocessing.sharedctypes import RawArray
+
+import numpy
+
+
+def _shared_array(value):
+    """
+    Returns a zero-filled array in shared memory with the shape and dtype
+    of @param value.
+    """
+    value = numpy.asarray(value)
+    buf = RawArray(ctypes.c_char, max(value.nbytes, 1))
+    return numpy.frombuffer(buf, dtype=value.dtype, count=value.size).reshape(value.shape)
+
+
+def _sum(arrays):
+    total = arrays[0].copy()
+    for array in arrays[1:]:
+        total += array
+    return total
+
+
+def _worker(worker_id, tasks, results, load_variables, shared_values,
+            out_variables, slot_values, f_grad, f_reset_grads, f_update):
+    """
+    Worker process of DataParallelTrainer: runs the tasks of the master
+    until it receives None.
+    """
+    try:
+        costs = []
+        busy_time = 0.
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            kind = task[0]
+            if kind == 'load':
+                for variable, value in zip(load_variables, shared_values):
+                    variable.set_value(value)
+            elif kind == 'grad':
+                start_time = time.time()
+                costs.append(f_grad(*task[2]))
+                busy_time += time.time() - start_time
+            elif kind == 'train':
+                start_time = time.time()
+                costs.append(f_update(task[1], *task[2]))
+                busy_time += time.time() - start_time
+            elif kind == 'flush':
+                if task[1]:
+                    for variable, value in zip(out_variables, slot_values):
+                        value[...] = variable.get_value(borrow=True)
+                if f_reset_grads is not None:
+                    f_reset_grads()
+                results.put(('done', worker_id, costs, busy_time))
+                costs = []
+                busy_time = 0.
+    except Exception:
+        results.put(('error', worker_id, traceback.format_exc()))
+
+
+class DataParallelTrainer(object):
+    """
+    Trains on minibatches in worker processes. Minibatches are passed to
+    `submit` (and distributed round robin over the workers); once
+    `batches_per_update` minibatches are submitted, `update` completes the
+    update (of the parameters of the master) and returns their costs.
+
+    The workers load the parameters of the master (and, with parameter
+    averaging, the optimizer state) at the first update, and after each
+    update in which the master's parameters changed, so changes of the
+    master's parameters between updates (e.g. when training is restarted
+    from the best parameters) are passed on to the workers.
+    """
+    def __init__(self, workers, sync, params, optimizer_params, f_grad=None, f_reset_grads=None,
+                 grad_buffers=None, f_update=None, update_every=1):
+        """
+        @param params: shared variables of the trained parameters
+        @param optimizer_params: shared variables of the optimizer state
+        @param sync: 'gradients': workers run f_grad (and f_reset_grads),
+                     which accumulate the gradients of update_every
+                     minibatches in grad_buffers, and the master runs
+                     f_update(lrate) on the sums of these buffers.
+                     'parameters': workers run f_update(lrate, *inputs)
+                     on one minibatch per update.
+        """
+        self.workers = workers
+        self.sync = sync
+        self._f_update = f_update
+        if sync == 'gradients':
+            self.batches_per_update = workers * update_every
+            self._load_variables = list(params)
+            self._out_variables = list(grad_buffers)
+        else:
+            self.batches_per_update = workers
+            self._load_variables = list(params) + list(optimizer_params)
+            self._out_variables = self._load_variables
+            f_grad = f_reset_grads = None
+
+        # shared memory, allocated before the workers are forked
+        self._shared_values = [_shared_array(v.get_value(borrow=True)) for v in self._load_variables]
+        self._slot_values = [[_shared_array(v.get_value(borrow=True)) for v in self._out_variables]
+                             for _ in xrange(workers)]
+
+        self._push = True
+        self._averaged = True
+        self._next_worker = 0
+        self._words = numpy.zeros(workers)
+        self._busy_time = numpy.zeros(workers)
+
+        self._results = ProcessQueue()
+        self._tasks = []
+        self._processes = []
+        for i in xrange(workers):
+            tasks = ProcessQueue()
+            process = Process(target=_worker,
+                              args=(i, tasks, self._results, self._load_variables, self._shared_values,
+                                    self._out_variables, self._slot_values[i], f_grad, f_reset_grads,
+                                    f_update))
+            process.daemon = True
+            process.start()
+            self._tasks.append(tasks)
+            self._processes.append(process)
+        logging.info('Started {0} training worker processes ({1} synchronization)'.format(workers, sync))
+
+    def submit(self, inputs, lrate, words):
+        """
+        Trains on the minibatch @param inputs (with @param words tokens) in
+        the next worker. The inputs are copied: the queue pickles them later
+        (in a background thread), and the caller may reuse their arrays for
+        the next minibatch (see `batch_util.BatchBuffers`).
+        """
+        if self._push:
+            for variable, value in zip(self._load_variables, self._shared_values):
+                value[...] = variable.get_value(borrow=True)
+            for tasks in self._tasks:
+                tasks.put(('load',))
+            self._push = False
+        worker = self._next_worker
+        self._next_worker = (worker + 1) % self.workers
+        inputs = [numpy.array(value) for value in inputs]
+        self._tasks[worker].put(('grad' if self.sync == 'gradients' else 'train', lrate, inputs))
+        self._words[worker] += words
+
+    def update(self, lrate, average=True):
+        """
+        Waits for the workers to finish their minibatches, and updates the
+        parameters of the master: with gradient synchronization, applies
+        the summed gradients; with parameter averaging, averages the
+        parameters of the workers if @param average. Returns the costs of
+        the minibatches.
+        """
+        write = self.sync == 'gradients' or average
+        for tasks in self._tasks:
+            tasks.put(('flush', write))
+        costs = []
+        for _ in xrange(self.workers):
+            worker, worker_costs, busy_time = self._get_result()
+            costs.extend(worker_costs)
+            self._busy_time[worker] += busy_time
+
+        if write:
+            for i, variable in enumerate(self._out_variables):
+                total = _sum([values[i] for values in self._slot_values])
+                if self.sync == 'parameters':
+                    total /= self.workers
+                variable.set_value(total)
+            if self.sync == 'gradients':
+                self._f_update(lrate)
+            self._push = True
+        self._averaged = write
+        return costs
+
+    def throughput(self):
+        """
+        Returns the words per second of each worker (while it was busy)
+        since the last call.
+        """
+        words_per_second = self._words / numpy.maximum(self._busy_time, 1e-6)
+        self._words[:] = 0.
+        self._busy_time[:] = 0.
+        return words_per_second
+
+    def close(self):
+        """
+        Stops the workers; with parameter averaging, the master gets the
+        average of their last parameters (unless a worker has died, e.g.
+        if training is stopped by its error).
+        """
+        if not self._averaged and all(process.is_alive() for process in self._processes):
+            self.update(None, average=True)
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join()
+
+    def _get_result(self):
+        while True:
+            try:
+                result = self._results.get(timeout=1)
+            except Queue.Empty:
+                for i, process in enumerate(self._processes):
+                    if not process.is_alive():
+                        raise RuntimeError('Training worker process {0} died (exit code {1})'.format(
+                            i, process.exitcode))
+                continue
+            if result[0] == 'error':
+                raise RuntimeError('Error in training worker process {0}:\n{1}'.format(result[1], result[2]))
+            return result[1:]
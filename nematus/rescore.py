@@ -17,7 +17,7 @@ from compat import fill_options
 
 from theano_util import (floatX, numpy_floatX, load_params, init_theano_params)
 from nmt import (pred_probs, build_model, prepare_data)
-from score import load_scorer
+from score import score_models
 from settings import RescorerSettings
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
@@ -29,15 +29,11 @@ def rescore_model(source_file, nbest_file, output_file, rescorer_settings, optio
 
     def _score(pairs, alignweights=False):
         # sample given an input sequence and obtain scores
-        scores = []
-        alignments = []
-        for i, model in enumerate(rescorer_settings.models):
-            f_log_probs = load_scorer(model, options[i], alignweights=alignweights)
-            score, alignment = pred_probs(f_log_probs, prepare_data, options[i], pairs, normalization_alpha=rescorer_settings.normalization_alpha, alignweights = alignweights)
-            scores.append(score)
-            alignments.append(alignment)
-
-        return scores, alignments
+        return score_models(rescorer_settings.models, options, pairs,
+                            normalization_alpha=rescorer_settings.normalization_alpha,
+                            alignweights=alignweights,
+                            shared_graph=rescorer_settings.shared_graph,
+                            function_cache=rescorer_settings.function_cache)
 
     lines = source_file.readlines()
     nbest_lines = nbest_file.readlines()
@@ -62,9 +58,11 @@ def rescore_model(source_file, nbest_file, output_file, rescorer_settings, optio
                              n_words_source=options[0]['n_words_src'],
                              n_words_target=options[0]['n_words'],
                              batch_size=rescorer_settings.b,
+                             token_batch_size=rescorer_settings.batch_tokens,
+                             maxibatch_size=rescorer_settings.maxibatch_size,
                              maxlen=float('inf'),
                              use_factor=(options[0]['factors'] > 1),
-                             sort_by_length=False) #TODO: sorting by length could be more efficient, but we'd have to synchronize scores with n-best list after
+                             return_indices=True) # sorted by length within maxibatches; pred_probs restores the original order
 
 
         scores, alignments = _score(pairs, rescorer_settings.alignweights)
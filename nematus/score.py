@@ -16,21 +16,30 @@ from data_iterator import TextIterator
 from util import load_config
 from alignment_util import combine_source_target_text_1to1
 from compat import fill_options
+import mmap_model
+from function_cache import cached_functions
 
-from theano_util import (floatX, numpy_floatX, load_params, init_theano_params)
-from nmt import (pred_probs, build_model, prepare_data)
+from batch_util import BatchBuffers
+from theano_util import (floatX, numpy_floatX, load_params, init_theano_params, zip_to_theano)
+from nmt import (pred_probs, build_model, prepare_data, prepare_batches, score_batches)
 from settings import ScorerSettings
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 import theano
 
-def load_scorer(model, option, alignweights=None):
-
-    # load model parameters and set theano shared variables
-    param_list = numpy.load(model).files
+def load_scorer_params(model):
+    # load model parameters (without optimizer parameters)
+    param_list = mmap_model.load(model).files
     param_list = dict.fromkeys([key for key in param_list if not key.startswith('adam_')], 0)
-    params = load_params(model, param_list)
-    tparams = init_theano_params(params)
+    return load_params(model, param_list)
+
+def build_scorer(tparams, option, alignweights=None, function_cache=None):
+    f_log_probs, = cached_functions(function_cache, 'scorer', option, tparams,
+                                    lambda: (_build_scorer(tparams, option, alignweights),),
+                                    alignweights=bool(alignweights))
+    return f_log_probs
+
+def _build_scorer(tparams, option, alignweights=None):
 
     trng, use_noise, \
         x, x_mask, y, y_mask, \
@@ -49,21 +58,70 @@ def load_scorer(model, option, alignweights=None):
 
     return f_log_probs
 
+def load_scorer(model, option, alignweights=None, function_cache=None):
+
+    # load model parameters and set theano shared variables
+    params = load_scorer_params(model)
+    tparams = init_theano_params(params)
+
+    return build_scorer(tparams, option, alignweights=alignweights, function_cache=function_cache)
+
+def swap_params(model, tparams):
+    """
+    Loads the parameters of a model into the shared variables of another
+    model with the same architecture.
+    """
+    params = load_scorer_params(model)
+    if set(params) != set(tparams) or \
+            any(numpy.shape(params[key]) != tparams[key].get_value(borrow=True).shape for key in params):
+        logging.error('{0} does not have the same parameters as the first model; models cannot share a graph.\n'.format(model))
+        sys.exit(1)
+    zip_to_theano(params, tparams)
+
+def score_models(models, options, pairs, normalization_alpha=0.0, alignweights=False, shared_graph=False,
+                 function_cache=None):
+    """
+    Scores the sentence pairs of an iterator with each model. With several
+    models, minibatches are prepared once and scored by all of them. With
+    shared_graph, the scoring function is compiled only once, and the
+    parameters of each model are loaded into it in turn.
+    """
+    if len(models) > 1:
+        batches = list(prepare_batches(prepare_data, options[0], pairs))
+    else:
+        batches = prepare_batches(prepare_data, options[0], pairs, buffers=BatchBuffers())
+
+    scores = []
+    alignments = []
+    tparams = None
+    for i, model in enumerate(models):
+        if options[i]['factors'] != options[0]['factors']:
+            logging.error('Mismatch between number of factors of {0} ({1}) and of the first model ({2})\n'.format(model, options[i]['factors'], options[0]['factors']))
+            sys.exit(1)
+        if shared_graph and tparams is not None:
+            logging.info('Loading parameters of {0}'.format(model))
+            swap_params(model, tparams)
+        else:
+            tparams = init_theano_params(load_scorer_params(model))
+            f_log_probs = build_scorer(tparams, options[i], alignweights=alignweights,
+                                       function_cache=function_cache)
+        score, alignment = score_batches(f_log_probs, batches, normalization_alpha=normalization_alpha, alignweights=alignweights)
+        scores.append(score)
+        alignments.append(alignment)
+
+    return scores, alignments
+
 def rescore_model(source_file, target_file, output_file, scorer_settings, options):
 
     trng = RandomStreams(1234)
 
     def _score(pairs, alignweights=False):
         # sample given an input sequence and obtain scores
-        scores = []
-        alignments = []
-        for i, model in enumerate(scorer_settings.models):
-            f_log_probs = load_scorer(model, options[i], alignweights=alignweights)
-            score, alignment = pred_probs(f_log_probs, prepare_data, options[i], pairs, normalization_alpha=scorer_settings.normalization_alpha, alignweights =alignweights)
-            scores.append(score)
-            alignments.append(alignment)
-
-        return scores, alignments
+        return score_models(scorer_settings.models, options, pairs,
+                            normalization_alpha=scorer_settings.normalization_alpha,
+                            alignweights=alignweights,
+                            shared_graph=scorer_settings.shared_graph,
+                            function_cache=scorer_settings.function_cache)
 
     pairs = TextIterator(source_file.name,
                          target_file.name,
@@ -72,9 +130,11 @@ def rescore_model(source_file, target_file, output_file, scorer_settings, option
                          n_words_source=options[0]['n_words_src'],
                          n_words_target=options[0]['n_words'],
                          batch_size=scorer_settings.b,
+                         token_batch_size=scorer_settings.batch_tokens,
+                         maxibatch_size=scorer_settings.maxibatch_size,
                          maxlen=float('inf'),
                          use_factor=(options[0]['factors'] > 1),
-                         sort_by_length=False) #TODO: sorting by length could be more efficient, but we'd want to resort after
+                         return_indices=True) # sorted by length within maxibatches; pred_probs restores the original order
 
     scores, alignments = _score(pairs, scorer_settings.alignweights)
 
@@ -6,16 +6,27 @@ Runs Nematus as a Web Server.
 """
 
 import json
+import time
 import pkg_resources
 import logging
 
 from bottle import Bottle, request, response
 from bottle_log import LoggingPlugin
 
+from server.request import InvalidRequest
 from server.response import TranslationResponse
 from server.api.provider import request_provider, response_provider
 from settings import ServerSettings
-from translate import Translator
+from translate import Translator, DeadlineExceeded
+
+class JSONRequest(object):
+    """
+    Provides the body of a request (of the asynchronous server) in the same
+    way as bottle, for the request parsers in `server/api`.
+    """
+    def __init__(self, body):
+        self.json = json.loads(body) if body else None
+
 
 class NematusServer(object):
     """
@@ -48,33 +59,50 @@ class NematusServer(object):
         logging.info("Starting Nematus Server")
         # start translation workers
         logging.info("Loading translation models")
-        self._translator = Translator(server_settings)
+        self._translator = Translator(server_settings, collect_stats=True)
+        # a single thread collects the results of all requests
+        self._translator.start_dispatcher()
+        self._asynchronous = server_settings.asynchronous
         self._status = self.STATUS_OK
 
-    def status(self):
-        """
-        Reports on the status of this translation server.
-        """
+    def _get_status(self):
         response_data = {
             'status': self._status,
             'models': self._models,
             'version': pkg_resources.require("nematus")[0].version,
             'service': 'nematus',
         }
-        response.content_type = "application/json"
+        cache_stats = self._translator.get_cache_stats()
+        if cache_stats is not None:
+            response_data['cache'] = cache_stats
         return json.dumps(response_data)
 
-    def translate(self):
+    def status(self):
         """
-        Processes a translation request.
+        Reports on the status of this translation server.
         """
-        translation_request = request_provider(self._style, request)
-        logging.debug("REQUEST - " + repr(translation_request))
+        response.content_type = "application/json"
+        return self._get_status()
 
-        translations = self._translator.translate(
-            translation_request.segments,
-            translation_request.settings
-        )
+    def _get_metrics(self):
+        input_size, output_size = self._translator.get_queue_sizes()
+        gauges = []
+        if input_size is not None:
+            gauges.append(('nematus_input_queue_size', 'Number of sentences waiting for a worker.', input_size))
+            gauges.append(('nematus_output_queue_size', 'Number of translations waiting for the dispatcher.', output_size))
+        return self._translator.metrics.format(gauges)
+
+    def metrics(self):
+        """
+        Reports metrics in the text format of Prometheus.
+        """
+        response.content_type = "text/plain; version=0.0.4"
+        return self._get_metrics()
+
+    def _format_translations(self, translation_request, translations):
+        """
+        Formats the response to a translation request.
+        """
         response_data = {
             'status': TranslationResponse.STATUS_OK,
             'segments': [translation.target_words for translation in translations],
@@ -83,18 +111,144 @@ class NematusServer(object):
         }
         translation_response = response_provider(self._style, **response_data)
         logging.debug("RESPONSE - " + repr(translation_response))
+        return translation_response
+
+    def _format_error(self):
+        """
+        Formats the response to a translation request that failed.
+        """
+        return response_provider(self._style, status=TranslationResponse.STATUS_ERROR, segments=[])
+
+    def translate(self):
+        """
+        Processes a translation request.
+        """
+        start_time = time.time()
+        try:
+            translation_request = request_provider(self._style, request)
+            logging.debug("REQUEST - " + repr(translation_request))
 
+            translations = self._translator.translate(
+                translation_request.segments,
+                translation_request.settings
+            )
+            translation_response = self._format_translations(translation_request, translations)
+        except DeadlineExceeded:
+            self._translator.metrics.add_request('expired', time.time() - start_time)
+            translation_response = self._format_error()
+            response.status = 504
+        except InvalidRequest as e:
+            logging.warning("Invalid request: {0}".format(e))
+            self._translator.metrics.add_request('invalid', time.time() - start_time)
+            translation_response = self._format_error()
+            response.status = 400
+        except:
+            self._translator.metrics.add_request('error', time.time() - start_time)
+            raise
+        else:
+            self._translator.metrics.add_request('ok', time.time() - start_time)
         response.content_type = translation_response.get_content_type()
         return repr(translation_response)
 
+    def translate_async(self, translation_request):
+        """
+        Sends a translation request to the translator without blocking;
+        returns a tornado Future of the formatted response.
+        """
+        from tornado.concurrent import Future
+        from tornado.ioloop import IOLoop
+
+        future = Future()
+        loop = IOLoop.current()
+
+        def callback(translations, error):
+            # called from the dispatcher thread
+            if error is not None:
+                loop.add_callback(future.set_exception, error)
+                return
+            try:
+                translation_response = self._format_translations(translation_request, translations)
+            except Exception as e:
+                loop.add_callback(future.set_exception, e)
+            else:
+                loop.add_callback(future.set_result, translation_response)
+
+        logging.debug("REQUEST - " + repr(translation_request))
+        self._translator.translate_async(
+            translation_request.segments,
+            translation_request.settings,
+            callback
+        )
+        return future
+
     def start(self):
         """
         Starts the webserver.
         """
-        self._route()
-        self._server.run(host=self._host, port=self._port, debug=self._debug, server='tornado', threads=self._threads)
+        if self._asynchronous:
+            self._start_async()
+        else:
+            self._route()
+            self._server.run(host=self._host, port=self._port, debug=self._debug, server='tornado', threads=self._threads)
         self._cleanup()
 
+    def _start_async(self):
+        """
+        Starts an asynchronous webserver (tornado) with a single thread. Request
+        handlers wait for their translations without blocking the thread, so
+        the number of concurrent requests is not limited by `--threads`.
+        """
+        from tornado import gen, web
+        from tornado.ioloop import IOLoop
+
+        nematus_server = self
+
+        class StatusHandler(web.RequestHandler):
+            def get(self):
+                self.set_header('Content-Type', 'application/json')
+                self.write(nematus_server._get_status())
+
+        class MetricsHandler(web.RequestHandler):
+            def get(self):
+                self.set_header('Content-Type', 'text/plain; version=0.0.4')
+                self.write(nematus_server._get_metrics())
+
+        class TranslationHandler(web.RequestHandler):
+            @gen.coroutine
+            def post(self):
+                start_time = time.time()
+                try:
+                    translation_request = request_provider(nematus_server._style, JSONRequest(self.request.body))
+                    translation_response = yield nematus_server.translate_async(translation_request)
+                except DeadlineExceeded:
+                    nematus_server._translator.metrics.add_request('expired', time.time() - start_time)
+                    translation_response = nematus_server._format_error()
+                    self.set_status(504)
+                except InvalidRequest as e:
+                    logging.warning("Invalid request: {0}".format(e))
+                    nematus_server._translator.metrics.add_request('invalid', time.time() - start_time)
+                    translation_response = nematus_server._format_error()
+                    self.set_status(400)
+                except:
+                    nematus_server._translator.metrics.add_request('error', time.time() - start_time)
+                    raise
+                else:
+                    nematus_server._translator.metrics.add_request('ok', time.time() - start_time)
+                self.set_header('Content-Type', translation_response.get_content_type())
+                self.write(repr(translation_response))
+
+        application = web.Application([
+            (r'/status', StatusHandler),
+            (r'/metrics', MetricsHandler),
+            (r'/translate', TranslationHandler),
+        ], debug=self._debug)
+        application.listen(self._port, address=self._host)
+        logging.info("Listening on {0}:{1} (asynchronous)".format(self._host, self._port))
+        try:
+            IOLoop.current().start()
+        except KeyboardInterrupt:
+            pass
+
     def _cleanup(self):
         """
         Graceful exit for components.
@@ -106,6 +260,7 @@ class NematusServer(object):
         Routes webserver paths to functions.
         """
         self._server.route('/status', method="GET", callback=self.status)
+        self._server.route('/metrics', method="GET", callback=self.metrics)
         self._server.route('/translate', method="POST", callback=self.translate)
 
 
@@ -6,8 +6,9 @@ Defines the Nematus API for translation requests and responses.
 """
 
 import json
-from ..request import TranslationRequest
+from ..request import TranslationRequest, InvalidRequest
 from ..response import TranslationResponse
+from settings import PRIORITIES
 
 class TranslationRequestNematus(TranslationRequest):
     def _parse(self):
@@ -29,6 +30,18 @@ class TranslationRequestNematus(TranslationRequest):
             self.settings.get_alignment = request['return_word_alignment']
         if 'return_word_probabilities' in request:
             self.settings.get_word_probs = request['return_word_probabilities']
+        if 'priority' in request:
+            if request['priority'] not in PRIORITIES:
+                raise InvalidRequest("priority must be one of {0}, not {1!r}".format(', '.join(PRIORITIES), request['priority']))
+            self.settings.priority = request['priority']
+        if 'deadline' in request:
+            try:
+                deadline = float(request['deadline'])
+            except (TypeError, ValueError):
+                raise InvalidRequest("deadline must be a number of seconds, not {0!r}".format(request['deadline']))
+            if not deadline >= 0:
+                raise InvalidRequest("deadline must be a non-negative number of seconds, not {0!r}".format(request['deadline']))
+            self.settings.deadline = deadline
 
     def _format(self):
         request = {
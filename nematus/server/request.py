@@ -9,6 +9,13 @@ from abc import ABCMeta, abstractmethod
 
 from settings import TranslationSettings
 
+class InvalidRequest(ValueError):
+    """
+    Raised by request parsers if a request has invalid settings; the
+    server answers it with HTTP status 400.
+    """
+    pass
+
 class TranslationRequest(object):
     """
     Abstract translation request base class.
@@ -0,0 +1,181 @@
+'''
+Metrics of the translation server, in the text format of Prometheus
+(https://prometheus.io/docs/instrumenting/exposition_formats/).
+
+Worker processes report the time they spend on each batch (see
+`Translator._start_worker`); the server adds the latency of each request.
+'''
+
+import time
+import bisect
+import threading
+
+from collections import defaultdict, deque
+
+from settings import PRIORITIES
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+TOKEN_TIME_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5]
+BEAM_STEP_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets with the given upper bounds.
+    """
+    def __init__(self, name, description, buckets, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        self.labels = ''.join('{0}="{1}",'.format(key, value) for key, value in labels)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def format(self, header=True):
+        lines = []
+        if header:
+            lines.append('# HELP {0} {1}'.format(self.name, self.description))
+            lines.append('# TYPE {0} histogram'.format(self.name))
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += count
+            le = bound if bound == '+Inf' else _format_value(bound)
+            lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(self.name, self.labels, le, cumulative))
+        labels = '{' + self.labels.rstrip(',') + '}' if self.labels else ''
+        lines.append('{0}_sum{1} {2}'.format(self.name, labels, _format_value(self.sum)))
+        lines.append('{0}_count{1} {2}'.format(self.name, labels, self.count))
+        return lines
+
+
+def _format_metric(name, metric_type, description, samples):
+    """
+    Formats a counter or gauge; @param samples is a list of (labels, value).
+    """
+    lines = ['# HELP {0} {1}'.format(name, description),
+             '# TYPE {0} {1}'.format(name, metric_type)]
+    for labels, value in samples:
+        label_string = ','.join('{0}="{1}"'.format(key, val) for key, val in labels)
+        if label_string:
+            label_string = '{' + label_string + '}'
+        lines.append('{0}{1} {2}'.format(name, label_string, _format_value(value)))
+    return lines
+
+
+class TranslationMetrics(object):
+    """
+    Collects the metrics of a translator and its worker processes. Safe to
+    use from several threads.
+    """
+    def __init__(self, num_processes, rate_window=60):
+        """
+        @param rate_window: sentences/s and tokens/s are measured over this
+                            many seconds
+        """
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._rate_window = rate_window
+        self._recent = deque() # (time, sentences, tokens) of recent batches
+        self.requests = defaultdict(int)
+        self.sentences = 0
+        self.tokens = 0
+        self.batches = 0
+        self.busy_time = [0.0] * num_processes
+        self.latency = Histogram('nematus_request_latency_seconds',
+                                 'End-to-end latency of translation requests.',
+                                 LATENCY_BUCKETS)
+        # by priority class
+        self.queue_wait = [Histogram('nematus_queue_wait_seconds',
+                                     'Time from sending a sentence to the workers until its decoding starts.',
+                                     LATENCY_BUCKETS, labels=[('priority', priority)])
+                           for priority in PRIORITIES]
+        self.sentence_time = Histogram('nematus_decode_seconds_per_sentence',
+                                       'Decoding time of a batch divided by its number of sentences.',
+                                       LATENCY_BUCKETS)
+        self.token_time = Histogram('nematus_decode_seconds_per_token',
+                                    'Decoding time of a batch divided by its number of source tokens.',
+                                    TOKEN_TIME_BUCKETS)
+        self.beam_steps = Histogram('nematus_beam_steps_per_sentence',
+                                    'Number of beam search steps per sentence (length of the longest hypothesis).',
+                                    BEAM_STEP_BUCKETS)
+
+    def add_request(self, status, latency):
+        with self._lock:
+            self.requests[status] += 1
+            self.latency.observe(latency)
+
+    def add_batch(self, process_id, busy_time, queue_waits, source_lengths, beam_steps, priorities):
+        """
+        Records a batch decoded by a worker process.
+        """
+        n_sentences = len(source_lengths)
+        n_tokens = sum(source_lengths)
+        now = time.time()
+        with self._lock:
+            self.batches += 1
+            self.sentences += n_sentences
+            self.tokens += n_tokens
+            self.busy_time[process_id] += busy_time
+            for wait, priority in zip(queue_waits, priorities):
+                self.queue_wait[PRIORITIES.index(priority)].observe(wait)
+            for steps in beam_steps:
+                self.sentence_time.observe(busy_time / n_sentences)
+                self.beam_steps.observe(steps)
+            self.token_time.observe(busy_time / max(n_tokens, 1))
+            self._recent.append((now, n_sentences, n_tokens))
+            while self._recent[0][0] < now - self._rate_window:
+                self._recent.popleft()
+
+    def _get_rates(self):
+        # caller holds the lock
+        now = time.time()
+        while self._recent and self._recent[0][0] < now - self._rate_window:
+            self._recent.popleft()
+        window = min(self._rate_window, now - self._start_time) or 1.0
+        sentences = sum(n for _, n, _ in self._recent)
+        tokens = sum(n for _, _, n in self._recent)
+        return sentences / window, tokens / window
+
+    def format(self, gauges=()):
+        """
+        Returns all metrics in the Prometheus text format. @param gauges is
+        a list of additional (name, description, value) gauges.
+        """
+        with self._lock:
+            sentence_rate, token_rate = self._get_rates()
+            lines = []
+            lines += _format_metric('nematus_requests_total', 'counter',
+                                    'Number of translation requests.',
+                                    [((('status', status),), n) for status, n in sorted(self.requests.items())])
+            lines += _format_metric('nematus_sentences_total', 'counter',
+                                    'Number of decoded sentences.', [((), self.sentences)])
+            lines += _format_metric('nematus_tokens_total', 'counter',
+                                    'Number of decoded source tokens.', [((), self.tokens)])
+            lines += _format_metric('nematus_batches_total', 'counter',
+                                    'Number of decoded batches.', [((), self.batches)])
+            lines += _format_metric('nematus_worker_busy_seconds_total', 'counter',
+                                    'Time that each worker process spent decoding.',
+                                    [((('worker', process_id),), busy) for process_id, busy in enumerate(self.busy_time)])
+            lines += _format_metric('nematus_sentences_per_second', 'gauge',
+                                    'Decoded sentences per second (over the last {0}s).'.format(self._rate_window),
+                                    [((), sentence_rate)])
+            lines += _format_metric('nematus_tokens_per_second', 'gauge',
+                                    'Decoded source tokens per second (over the last {0}s).'.format(self._rate_window),
+                                    [((), token_rate)])
+            for name, description, value in gauges:
+                lines += _format_metric(name, 'gauge', description, [((), value)])
+            for histogram in (self.latency, self.sentence_time,
+                              self.token_time, self.beam_steps):
+                lines += histogram.format()
+            for i, histogram in enumerate(self.queue_wait):
+                lines += histogram.format(header=(i == 0))
+        return '\n'.join(lines) + '\n'
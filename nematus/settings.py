@@ -8,6 +8,9 @@ import argparse
 import uuid
 from abc import ABCMeta
 
+# priority classes of translation jobs, from highest to lowest
+PRIORITIES = ['high', 'normal', 'low']
+
 class BaseSettings(object):
     """
     All modes (abstract base class)
@@ -32,6 +35,10 @@ class BaseSettings(object):
         self._parser.add_argument('--device-list', '-dl', type=str, nargs='*', required=False, metavar="DEVICE",
                                   help="User specified device list for multi-thread decoding (default: [])")
         self._parser.add_argument('-v', dest='verbose', action="store_true", help="verbose mode.")
+        self._parser.add_argument('--batch-tokens', dest='batch_tokens', type=int, default=0,
+                                  help="Maximum number of tokens (including padding) that are processed at once: source tokens when translating, source or target tokens when scoring; 0 for no limit (default: %(default)s)")
+        self._parser.add_argument('--function-cache', dest='function_cache', type=str, default=None, metavar='DIR',
+                                  help="Directory in which compiled Theano functions are cached, so that later processes with the same model configuration do not need to build them again (default: no cache)")
 
     def _set_console_arguments(self):
         """
@@ -57,7 +64,34 @@ class BaseSettings(object):
         pass # override in subclass
 
 
-class TranslationSettings(BaseSettings):
+class DecoderBaseSettings(BaseSettings):
+    """
+    Base class for translation and server settings: options of the
+    translation processes
+    """
+    __metaclass__ = ABCMeta
+
+    def _add_console_arguments(self):
+        super(DecoderBaseSettings, self)._add_console_arguments()
+        self._parser.add_argument('-b', dest='batch_size', type=int, default=1,
+                                  help="Maximum number of sentences that a process decodes at once (default: %(default)s)")
+        self._parser.add_argument('--batch-timeout', dest='batch_timeout', type=float, default=0.0, metavar='SECONDS',
+                                  help="Time that a process waits for further sentences to fill a batch (default: %(default)s)")
+        self._parser.add_argument('--shortlist', type=str, default=None, metavar='PATH',
+                                  help="Lexical table (see `data/build_lexical_table.py`) used to restrict the target vocabulary of each batch to likely translations of its source words")
+        self._parser.add_argument('--shortlist-translations', dest='shortlist_translations', type=int, default=50,
+                                  help="Number of translations per source word that are added to the shortlist (default: %(default)s)")
+        self._parser.add_argument('--shortlist-frequent', dest='shortlist_frequent', type=int, default=1000,
+                                  help="Number of most frequent target words that are always in the shortlist (default: %(default)s)")
+        self._parser.add_argument('--cache-entries', dest='cache_entries', type=int, default=0, metavar='INT',
+                                  help="Maximum number of translations kept in an in-memory cache, so that repeated segments are only decoded once; 0 to disable (default: %(default)s)")
+        self._parser.add_argument('--cache-mb', dest='cache_mb', type=int, default=0, metavar='MB',
+                                  help="Maximum size of the in-memory translation cache in megabytes; 0 for no limit (default: %(default)s)")
+        self._parser.add_argument('--cache-dir', dest='cache_dir', type=str, default=None, metavar='DIR',
+                                  help="Directory in which translations are cached on disk (default: no disk cache)")
+
+
+class TranslationSettings(DecoderBaseSettings):
     """
     Console interface for file translation mode
     """
@@ -75,10 +109,12 @@ class TranslationSettings(BaseSettings):
             self._parser.add_argument('--input', '-i', type=argparse.FileType('r'),
                                       default=sys.stdin, metavar='PATH',
                                       help="Input file (default: standard input)")
-            self._parser.add_argument('--output', '-o', type=argparse.FileType('w'),
-                                      default=sys.stdout, metavar='PATH',
+            # output files are opened in `_set_additional_vars`, so that they
+            # are not truncated when a translation is resumed
+            self._parser.add_argument('--output', '-o', type=str,
+                                      default=None, metavar='PATH',
                                       help="Output file (default: standard output)")
-            self._parser.add_argument('--output_alignment', '-a', type=argparse.FileType('w'),
+            self._parser.add_argument('--output_alignment', '-a', type=str,
                                       default=None, metavar='PATH',
                                       help="Output file for alignment weights (default: standard output)")
 
@@ -94,16 +130,37 @@ class TranslationSettings(BaseSettings):
                                   help="Output file for search graph visualisation. File format is determined by file name, e.g., PDF for `search_graph.pdf`")
         self._parser.add_argument("--max-ratio", "-mr", default=0.0, type=float,
                                   help="If non-zero, target should be no longer than this ratio of source (default: %(default)s).")
+        self._parser.add_argument('--priority', type=str, default='normal', choices=PRIORITIES,
+                                  help="Priority of the translation jobs; jobs of a higher priority are decoded first (default: %(default)s)")
+        self._parser.add_argument('--deadline', type=float, default=0.0, metavar='SECONDS',
+                                  help="Fail segments whose decoding has not started within this time; 0 for no deadline (default: %(default)s)")
+        self._parser.add_argument('--stream', action="store_true",
+                                  help="Read the input incrementally and write each translation as soon as all previous ones are complete, so that memory use does not grow with the input size")
+        self._parser.add_argument('--stream-window', dest='stream_window', type=int, default=1000, metavar='INT',
+                                  help="In streaming mode, maximum number of sentences that are read but not yet written (default: %(default)s)")
+        self._parser.add_argument('--resume', action="store_true",
+                                  help="Continue an interrupted streaming translation after the last sentence recorded in <output>.progress.json (implies --stream)")
 
     def _set_additional_vars(self):
         self.request_id = uuid.uuid4()
+        if self.resume:
+            self.stream = True
         self.get_alignment = False
-        if self._from_console_arguments and self.output_alignment:
-            self.get_alignment = True
+        if self._from_console_arguments:
+            mode = 'a' if self.resume else 'w'
+            if self.output is None:
+                if self.resume:
+                    self._parser.error('--resume requires an output file (--output)')
+                self.output = sys.stdout
+            else:
+                self.output = open(self.output, mode)
+            if self.output_alignment:
+                self.output_alignment = open(self.output_alignment, mode)
+                self.get_alignment = True
         self.get_search_graph = True if self.search_graph_filename else False
 
 
-class ServerSettings(BaseSettings):
+class ServerSettings(DecoderBaseSettings):
     """
     Console interface for server mode
 
@@ -121,6 +178,8 @@ class ServerSettings(BaseSettings):
                                   help='Host port (default: 8080)')
         self._parser.add_argument('--threads', type=int, default=4,
                                   help='Number of threads (default: 4)')
+        self._parser.add_argument('--async', dest='asynchronous', action='store_true',
+                                  help='Serve requests asynchronously from a single thread, so that the number of concurrent requests is not limited by the number of threads')
 
 
 class ScorerBaseSettings(BaseSettings):
@@ -133,6 +192,10 @@ class ScorerBaseSettings(BaseSettings):
         super(ScorerBaseSettings, self)._add_console_arguments()
         self._parser.add_argument('-b', type=int, default=80,
                                   help="Minibatch size (default: %(default)s))")
+        self._parser.add_argument('--maxibatch-size', dest='maxibatch_size', type=int, default=20,
+                                  help="Number of minibatches that are sorted by length; scores are written in the original order (default: %(default)s)")
+        self._parser.add_argument('--shared-graph', dest='shared_graph', action="store_true",
+                                  help="Models have the same architecture: compile the scoring function once, and load the parameters of each model into it in turn")
         self._parser.add_argument('-n', dest='normalization_alpha', type=float, default=0.0, nargs="?", const=1.0, metavar="ALPHA",
                                   help="Normalize scores by sentence length (with argument, exponentiate lengths by ALPHA)")
         self._parser.add_argument('--walign', '-w', dest='alignweights', required = False, action="store_true",
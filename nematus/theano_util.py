@@ -13,6 +13,9 @@ import theano
 import theano.tensor as tensor
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
+import mmap_model
+from util import write_atomic
+
 floatX = theano.config.floatX
 numpy_floatX = numpy.typeDict[floatX]
 
@@ -52,19 +55,18 @@ def pp(pp, name):
     return '%s_%s' % (pp, name)
 
 # initialize Theano shared variables according to the initial parameters
-def init_theano_params(params):
+# (with borrow=True, the shared variables use the given arrays without copying
+# them, if the device allows it)
+def init_theano_params(params, borrow=False):
     tparams = OrderedDict()
     for kk, pp in params.iteritems():
-        tparams[kk] = theano.shared(params[kk], name=kk)
+        tparams[kk] = theano.shared(params[kk], name=kk, borrow=borrow)
     return tparams
 
 # load language model parameters and options (deep fusion)
 def load_params_lm(options, params, with_prefix='lm_'):
     path = options['deep_fusion_lm']
-    try:
-       pp = numpy.load(path)
-    except IOError:
-       pp = numpy.load(path + '.npz')
+    pp = mmap_model.load(path)
        
     new_params = OrderedDict()
     drop = ['zipped_params',
@@ -85,10 +87,7 @@ def load_params_lm(options, params, with_prefix='lm_'):
 
 # load parameters
 def load_params(path, params, with_prefix='', pretrained=False):
-    try:
-        pp = numpy.load(path)
-    except IOError:
-        pp = numpy.load(path + '.npz')
+    pp = mmap_model.load(path)
     new_params = OrderedDict()
     for kk, vv in params.iteritems():
         if kk not in pp:
@@ -107,27 +106,32 @@ def load_params(path, params, with_prefix='', pretrained=False):
 # load parameters of the optimizer
 def load_optimizer_params(path, optimizer_name):
     params = {}
-    try:
-        pp = numpy.load(path)
-    except IOError:
-        pp = numpy.load(path + '.npz')
+    pp = mmap_model.load(path)
     for kk in pp:
         if kk.startswith(optimizer_name):
             params[kk] = pp[kk].astype(floatX, copy=False)
     return params
 
+# name of the file written by numpy.savez
+def npz_filename(filename):
+    return filename if filename.endswith('.npz') else filename + '.npz'
+
+# convert parameters to the floating point type of model files
+def to_file_float_type(params, file_float_type='float32'):
+    if file_float_type == floatX:
+        return params
+    new_params = {}
+    for kk, vv in params.iteritems():
+        new_params[kk] = vv.astype(file_float_type)
+    return new_params
+
 # save model parameters, optimizer parameters and progress
 def save(model_params, optimizer_params, training_progress, base_filename, file_float_type='float32'):
-    if file_float_type != floatX:
-        new_model_params, new_optimizer_params = {}, {}
-        for kk, vv in model_params.iteritems():
-            new_model_params[kk] = vv.astype(file_float_type)
-        for kk, vv in optimizer_params.iteritems():
-            new_optimizer_params[kk] = vv.astype(file_float_type)
-        model_params, optimizer_params = new_model_params, new_optimizer_params
-
-    numpy.savez(base_filename, **model_params)
-    numpy.savez(base_filename + '.gradinfo', **optimizer_params)
+    model_params = to_file_float_type(model_params, file_float_type)
+    optimizer_params = to_file_float_type(optimizer_params, file_float_type)
+
+    write_atomic(npz_filename(base_filename), lambda f: numpy.savez(f, **model_params))
+    write_atomic(npz_filename(base_filename + '.gradinfo'), lambda f: numpy.savez(f, **optimizer_params))
     training_progress.save_to_json(base_filename + '.progress.json')
 
 def tanh(x):
@@ -6,6 +6,7 @@ import sys
 import json
 
 import util
+from util import write_atomic
 
 class TrainingProgress(object):
     '''
@@ -16,4 +17,4 @@ class TrainingProgress(object):
         self.__dict__.update(util.unicode_to_utf8(json.load(open(file_name, 'rb'))))
 
     def save_to_json(self, file_name):
-        json.dump(self.__dict__, open(file_name, 'wb'), indent=2)
+        write_atomic(file_name, lambda f: json.dump(self.__dict__, f, indent=2))
@@ -7,16 +7,24 @@ import sys
 import numpy
 import json
 import os
+import time
+import heapq
 import logging
+import itertools
+import threading
 
 from multiprocessing import Process, Queue
-from collections import defaultdict
-from Queue import Empty
+from multiprocessing.sharedctypes import RawArray
+from collections import defaultdict, OrderedDict
+from Queue import Empty, Queue as ThreadQueue
 
 from util import load_dict, load_config, seqs2words
 from compat import fill_options
 from hypgraph import HypGraphRenderer
-from settings import TranslationSettings
+from settings import TranslationSettings, PRIORITIES
+from translation_cache import TranslationCache, model_id
+from server_metrics import TranslationMetrics
+import mmap_model
 
 class Translation(object):
     #TODO move to separate file?
@@ -106,6 +114,13 @@ class Translation(object):
         else:
             pass #TODO: Warning if no search graph has been constructed during decoding?
 
+class DeadlineExceeded(Exception):
+    """
+    Raised if segments of a request were not translated because their
+    deadline had passed.
+    """
+    pass
+
 class QueueItem(object):
     """
     Models items in a queue.
@@ -115,24 +130,68 @@ class QueueItem(object):
 
 class Translator(object):
 
-    def __init__(self, settings):
+    def __init__(self, settings, collect_stats=False):
         """
-        Loads translation models.
+        Loads translation models. If @param collect_stats is set, worker
+        processes report the time they spend on each batch (see `server_metrics.py`).
         """
         self._models = settings.models
         self._num_processes = settings.num_processes
+        self._batch_size = settings.batch_size
+        self._batch_tokens = settings.batch_tokens
+        self._batch_timeout = settings.batch_timeout
+        self._shortlist = settings.shortlist
+        self._shortlist_translations = settings.shortlist_translations
+        self._shortlist_frequent = settings.shortlist_frequent
+        self._function_cache = settings.function_cache
         self._device_list = settings.device_list
         self._verbose = settings.verbose
         self._retrieved_translations = defaultdict(dict)
+        self._dispatcher = None
+        self._collect_stats = collect_stats
 
+        # cache of translation results
+        self._init_cache(settings)
         # load model options
         self._load_model_options()
         # load and invert dictionaries
         self._build_dictionaries()
+        # load lexical table for vocabulary shortlists
+        self._load_shortlist()
+        # load model parameters into memory shared by all workers
+        self._load_shared_params()
         # set up queues
         self._init_queues()
         # init worker processes
         self._init_processes()
+        # send jobs to the workers by priority
+        self._init_scheduler()
+        # collect the statistics of the workers
+        self._init_metrics()
+
+    def _init_cache(self, settings):
+        """
+        Sets up the cache of translation results (if enabled).
+        """
+        # settings of the translator that affect all results
+        self._cache_id = (model_id(self._models), self._shortlist,
+                          self._shortlist_translations, self._shortlist_frequent)
+        if settings.cache_entries <= 0 and not settings.cache_dir:
+            self._cache = None
+            return
+        self._cache = TranslationCache(settings.cache_entries,
+                                       settings.cache_mb * 1024 * 1024,
+                                       settings.cache_dir)
+        self._cache_on_disk = bool(settings.cache_dir)
+
+    def get_cache_stats(self):
+        """
+        Returns the counters of the translation cache, or None if there is
+        no cache.
+        """
+        if self._cache is None:
+            return None
+        return self._cache.stats()
 
     def _load_model_options(self):
         """
@@ -187,14 +246,157 @@ class Translator(object):
         word_idict_trg[0] = '<eos>'
         word_idict_trg[1] = 'UNK'
 
+        self._word_dict_trg = word_dict_trg
         self._word_idict_trg = word_idict_trg
 
+    def _load_shortlist(self):
+        """
+        Loads the lexical table for target vocabulary shortlists, and maps
+        it to the vocabulary of the models. The table has one entry per line
+        (source word, target word, translation probability).
+        """
+        if not self._shortlist:
+            self._shortlist_table = None
+            return
+
+        n_words = self._options[0]['n_words']
+        translations = defaultdict(list)
+        with open(self._shortlist) as f:
+            for line in f:
+                source_word, target_word, prob = line.split()
+                source_id = self._word_dicts[0].get(source_word)
+                target_id = self._word_dict_trg.get(target_word)
+                if source_id is None or target_id is None or target_id >= n_words:
+                    continue
+                translations[source_id].append((float(prob), target_id))
+
+        self._shortlist_table = dict()
+        for source_id, candidates in translations.iteritems():
+            candidates.sort(reverse=True)
+            self._shortlist_table[source_id] = numpy.array(
+                [target_id for _, target_id in candidates[:self._shortlist_translations]], dtype='int64')
+        # eos and UNK are always in the shortlist, followed by the most frequent words
+        self._shortlist_base = numpy.arange(max(2, min(self._shortlist_frequent, n_words)), dtype='int64')
+
+        logging.info('Loaded lexical shortlist table for {0} source words'.format(len(self._shortlist_table)))
+
+    def _get_shortlist(self, source_ids):
+        """
+        Returns the sorted target vocabulary shortlist for a set of source
+        word ids.
+        """
+        candidates = [self._shortlist_base]
+        for source_id in set(source_ids):
+            if source_id in self._shortlist_table:
+                candidates.append(self._shortlist_table[source_id])
+        return numpy.unique(numpy.concatenate(candidates))
+
+    def _load_shared_params(self):
+        """
+        Loads the parameters of each model once, into shared memory that is
+        inherited by the worker processes. Workers use these arrays without
+        copying them (unless they are moved to a GPU), so that memory use
+        does not grow with the number of processes. Models in the
+        memory-mapped format (see `mmap_model.py`) are not copied, since
+        their pages are already shared.
+        """
+        shared_params = []
+        for model in self._models:
+            params = OrderedDict()
+            archive = mmap_model.load(model)
+            for key in archive.files:
+                # optimizer parameters are not needed for translation
+                if key.startswith('adam_') or key == 'zipped_params':
+                    continue
+                value = archive[key]
+                if isinstance(archive, mmap_model.MmapModel):
+                    params[key] = value
+                    continue
+                buf = RawArray('b', max(value.nbytes, 1))
+                params[key] = numpy.frombuffer(buf, dtype=value.dtype, count=value.size).reshape(value.shape)
+                params[key][...] = value
+            archive.close()
+            shared_params.append(params)
+
+        self._shared_params = shared_params
+
     def _init_queues(self):
         """
         Sets up shared queues for inter-process communication.
         """
         self._input_queue = Queue()
         self._output_queue = Queue()
+        self._stats_queue = Queue() if self._collect_stats else None
+
+    def _init_metrics(self):
+        """
+        Starts a thread that reads the statistics sent by the workers.
+        """
+        if not self._collect_stats:
+            self.metrics = None
+            return
+        self.metrics = TranslationMetrics(self._num_processes)
+        collector = threading.Thread(target=self._collect_metrics)
+        collector.daemon = True
+        collector.start()
+
+    def _collect_metrics(self):
+        while True:
+            self.metrics.add_batch(*self._stats_queue.get())
+
+    def get_queue_sizes(self):
+        """
+        Returns the approximate number of items in the input and output
+        queues (None if not supported on this platform).
+        """
+        sizes = []
+        for queue in (self._input_queue, self._output_queue):
+            try:
+                sizes.append(queue.qsize())
+            except NotImplementedError:
+                sizes.append(None)
+        return sizes
+
+    def _init_scheduler(self, queued_batches=2):
+        """
+        Starts a thread that moves jobs from a priority queue (by priority,
+        then first in, first out) to the input queue of the workers. The input
+        queue only holds a few batches per worker, so that jobs with a high
+        priority do not wait behind a large backlog of other jobs.
+        """
+        self._jobs = []
+        self._job_counter = itertools.count()
+        self._jobs_available = threading.Condition()
+        # a slot is taken by each job from the time it is moved to the input
+        # queue until its result is taken from the output queue
+        self._queue_slots = threading.Semaphore(queued_batches * self._num_processes * max(1, self._batch_size))
+        feeder = threading.Thread(target=self._feed_jobs)
+        feeder.daemon = True
+        feeder.start()
+
+    def _put_job(self, input_item):
+        """
+        Adds a job to the priority queue.
+        """
+        with self._jobs_available:
+            heapq.heappush(self._jobs, (input_item.priority, next(self._job_counter), input_item))
+            self._jobs_available.notify()
+
+    def _feed_jobs(self):
+        """
+        Executed by the scheduler thread. Jobs whose deadline has passed are
+        not sent to the workers; their result is None.
+        """
+        while True:
+            self._queue_slots.acquire()
+            with self._jobs_available:
+                while not self._jobs:
+                    self._jobs_available.wait()
+                _, _, input_item = heapq.heappop(self._jobs)
+            if input_item.deadline is not None and time.time() > input_item.deadline:
+                self._output_queue.put((input_item.request_id, input_item.idx, None))
+            else:
+                self._input_queue.put(input_item)
 
     def shutdown(self):
         """
@@ -208,6 +410,10 @@ class Translator(object):
         """
         Starts child (worker) processes.
         """
+        # time at which each worker has loaded its models, and time spent
+        # translating (written by the workers)
+        self._ready_time = RawArray('d', self._num_processes)
+        self._busy_time = RawArray('d', self._num_processes)
         processes = [None] * self._num_processes
         for process_id in xrange(self._num_processes):
             deviceid = ''
@@ -233,8 +439,9 @@ class Translator(object):
         from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
         from theano import shared
 
-        from nmt import (build_sampler, gen_sample)
-        from theano_util import (numpy_floatX, load_params, init_theano_params)
+        from nmt import (build_sampler, gen_sample_batch)
+        from theano_util import (floatX, numpy_floatX, init_theano_params)
+        from function_cache import cached_functions
 
         trng = RandomStreams(1234)
         use_noise = shared(numpy_floatX(0.))
@@ -242,21 +449,25 @@ class Translator(object):
         fs_init = []
         fs_next = []
 
-        for model, option in zip(self._models, self._options):
-            param_list = numpy.load(model).files
-            param_list = dict.fromkeys(
-                [key for key in param_list if not key.startswith('adam_')], 0)
-            params = load_params(model, param_list)
-            tparams = init_theano_params(params)
+        for shared_params, option in zip(self._shared_params, self._options):
+            # parameters are only copied if they are not stored in floatX
+            params = OrderedDict()
+            for key, value in shared_params.iteritems():
+                params[key] = value.astype(floatX, copy=False)
+            tparams = init_theano_params(params, borrow=True)
 
             # always return alignment at this point
-            f_init, f_next = build_sampler(
-                tparams, option, use_noise, trng, return_alignment=True)
+            shortlist = self._shortlist_table is not None
+            f_init, f_next = cached_functions(
+                self._function_cache, 'sampler', option, tparams,
+                lambda: build_sampler(tparams, option, use_noise, trng, return_alignment=True,
+                                      batched=True, shortlist=shortlist),
+                return_alignment=True, batched=True, shortlist=shortlist)
 
             fs_init.append(f_init)
             fs_next.append(f_next)
 
-        return trng, fs_init, fs_next, gen_sample
+        return trng, fs_init, fs_next, gen_sample_batch
 
     def _set_device(self, device_id):
         """
@@ -298,139 +509,346 @@ class Translator(object):
         """
         # load theano functionality
         trng, fs_init, fs_next, gen_sample = self._load_models(process_id, device_id)
+        self._ready_time[process_id] = time.time()
+
+        # listen to queue in while loop, translate items; items that have
+        # been taken from the queue but not yet translated are pending
+        running = True
+        pending = []
+        while running or pending:
+            if running:
+                running = self._fill_pending(pending)
+            if not pending:
+                break
 
-        # listen to queue in while loop, translate items
-        while True:
-            input_item = self._input_queue.get()
+            # items whose deadline has passed are not translated
+            now = time.time()
+            expired = [input_item for input_item in pending
+                       if input_item.deadline is not None and now > input_item.deadline]
+            if expired:
+                for input_item in expired:
+                    self._output_queue.put((input_item.request_id, input_item.idx, None))
+                pending = [input_item for input_item in pending if input_item not in expired]
+                continue
+
+            batch = self._select_batch(pending)
+            selected = set(id(input_item) for input_item in batch)
+            pending = [input_item for input_item in pending if id(input_item) not in selected]
+
+            start_time = time.time()
+            output_items, beam_steps = self._translate(process_id, batch, fs_init, fs_next, gen_sample)
+            for input_item, output_item in zip(batch, output_items):
+                self._output_queue.put((input_item.request_id, input_item.idx, output_item))
+            self._busy_time[process_id] += time.time() - start_time
+            if self._stats_queue is not None:
+                self._stats_queue.put((process_id, time.time() - start_time,
+                                       [start_time - input_item.submit_time for input_item in batch],
+                                       [len(input_item.seq) for input_item in batch],
+                                       beam_steps,
+                                       [PRIORITIES[input_item.priority] for input_item in batch]))
+
+        return
 
+    def _fill_pending(self, pending):
+        """
+        Takes items from the input queue until there are enough pending items
+        for a full batch (batch size or token budget), or until the batch
+        timeout has passed. Blocks if there are no pending items. Returns False
+        if the worker has been shut down.
+        """
+        if not pending:
+            input_item = self._input_queue.get()
             if input_item is None:
+                return False
+            pending.append(input_item)
+
+        deadline = time.time() + self._batch_timeout
+        num_tokens = sum(len(input_item.seq) for input_item in pending)
+        while len(pending) < self._batch_size and \
+              (not self._batch_tokens or num_tokens < self._batch_tokens):
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    input_item = self._input_queue.get(True, timeout)
+                else:
+                    input_item = self._input_queue.get_nowait()
+            except Empty:
                 break
-            idx = input_item.idx
-            request_id = input_item.request_id
-
-            output_item = self._translate(process_id, input_item, trng, fs_init, fs_next, gen_sample)
-            self._output_queue.put((request_id, idx, output_item))
+            if input_item is None:
+                return False
+            pending.append(input_item)
+            num_tokens += len(input_item.seq)
+        return True
 
-        return
+    def _get_item_key(self, input_item):
+        """
+        Items with the same key share the decoding settings and can thus be
+        decoded together.
+        """
+        return (input_item.k, input_item.suppress_unk,
+                input_item.return_alignment, input_item.return_hyp_graph)
 
-    def _translate(self, process_id, input_item, trng, fs_init, fs_next, gen_sample):
+    def _select_batch(self, pending):
         """
-        Actual translation (model sampling).
+        Selects the next batch from the pending items (possibly from different
+        requests). The batch contains the oldest pending item of the highest
+        priority, and the items with the same decoding settings whose length
+        is closest to it, up to the batch size and the token budget
+        (including padding).
         """
+        first = min(pending, key=lambda input_item: input_item.priority)
+        key = self._get_item_key(first)
+        candidates = [input_item for input_item in pending if self._get_item_key(input_item) == key]
+        candidates.sort(key=lambda input_item: len(input_item.seq))
+        length = len(first.seq)
+
+        start = [idx for idx, input_item in enumerate(candidates) if input_item is first][0]
+        end = start + 1
+        while end - start < self._batch_size:
+            # extend the batch by the neighbour whose length is closest
+            if start > 0 and (end == len(candidates) or
+                              length - len(candidates[start-1].seq) <= len(candidates[end].seq) - length):
+                new_start, new_end = start - 1, end
+            elif end < len(candidates):
+                new_start, new_end = start, end + 1
+            else:
+                break
+            if self._batch_tokens and (new_end - new_start) * len(candidates[new_end-1].seq) > self._batch_tokens:
+                break
+            start, end = new_start, new_end
+
+        return candidates[start:end]
 
-        # unpack input item attributes
-        normalization_alpha = input_item.normalization_alpha
-        nbest = input_item.nbest
-        idx = input_item.idx
+    def _translate(self, process_id, input_items, fs_init, fs_next, gen_sample):
+        """
+        Actual translation (model sampling) of a batch of queue items.
+        Returns the output items and the number of beam search steps for
+        each item.
+        """
 
         # logging
-        logging.debug('{0} - {1}\n'.format(process_id, idx))
+        logging.debug('{0} - {1}\n'.format(process_id, [input_item.idx for input_item in input_items]))
 
-        # sample given an input sequence and obtain scores
-        sample, score, word_probs, alignment, hyp_graph = self._sample(input_item, trng, fs_init, fs_next, gen_sample)
+        # sample given the input sequences and obtain scores
+        samples = self._sample(input_items, fs_init, fs_next, gen_sample)
 
-        # normalize scores according to sequence lengths
-        if normalization_alpha:
-            adjusted_lengths = numpy.array([len(s) ** normalization_alpha for s in sample])
-            score = score / adjusted_lengths
-        if nbest is True:
-            output_item = sample, score, word_probs, alignment, hyp_graph
-        else:
-            # return translation with lowest score only
-            sidx = numpy.argmin(score)
-            output_item = sample[sidx], score[sidx], word_probs[
-                sidx], alignment[sidx], hyp_graph
+        output_items = []
+        beam_steps = []
+        for input_item, (sample, score, word_probs, alignment, hyp_graph) in zip(input_items, samples):
+            beam_steps.append(max(len(s) for s in sample) if sample else 0)
+
+            # unpack input item attributes
+            normalization_alpha = input_item.normalization_alpha
+            nbest = input_item.nbest
+
+            # normalize scores according to sequence lengths
+            score = numpy.array(score)
+            if normalization_alpha:
+                adjusted_lengths = numpy.array([len(s) ** normalization_alpha for s in sample])
+                score = score / adjusted_lengths
+            if nbest is True:
+                output_item = sample, score, word_probs, alignment, hyp_graph
+            else:
+                # return translation with lowest score only
+                sidx = numpy.argmin(score)
+                output_item = sample[sidx], score[sidx], word_probs[
+                    sidx], alignment[sidx], hyp_graph
+            output_items.append(output_item)
 
-        return output_item
+        return output_items, beam_steps
 
-    def _sample(self, input_item, trng, fs_init, fs_next, gen_sample):
+    def _sample(self, input_items, fs_init, fs_next, gen_sample):
         """
-        Sample from model.
+        Sample from model (batched beam search over all items).
         """
-
-        # unpack input item attributes
-        return_hyp_graph = input_item.return_hyp_graph
-        return_alignment = input_item.return_alignment
-        suppress_unk = input_item.suppress_unk
-        k = input_item.k
-        seq = input_item.seq
-        max_ratio = input_item.max_ratio
-
-        maxlen = 200 #TODO: should be configurable
-        if max_ratio:
-          maxlen = int(max_ratio * len(seq))
-
-        return gen_sample(fs_init, fs_next,
-                          numpy.array(seq).T.reshape(
-                              [len(seq[0]), len(seq), 1]),
+        from theano_util import floatX
+
+        # decoding settings are shared by all items (see `_select_batch`)
+        return_hyp_graph = input_items[0].return_hyp_graph
+        return_alignment = input_items[0].return_alignment
+        suppress_unk = input_items[0].suppress_unk
+        k = input_items[0].k
+
+        n_samples = len(input_items)
+        n_factors = len(input_items[0].seq[0])
+        lengths = [len(input_item.seq) for input_item in input_items]
+
+        # pad input sequences (including EOS) with zeros
+        x = numpy.zeros((n_factors, max(lengths), n_samples)).astype('int64')
+        x_mask = numpy.zeros((max(lengths), n_samples)).astype(floatX)
+        maxlen = numpy.zeros(n_samples).astype('int64')
+        for idx, input_item in enumerate(input_items):
+            x[:, :lengths[idx], idx] = numpy.array(input_item.seq).T
+            x_mask[:lengths[idx], idx] = 1.
+            maxlen[idx] = 200 #TODO: should be configurable
+            if input_item.max_ratio:
+                maxlen[idx] = int(input_item.max_ratio * lengths[idx])
+
+        # restrict the target vocabulary to the candidates of all source words in the batch
+        shortlist = None
+        if self._shortlist_table is not None:
+            shortlist = self._get_shortlist(x[0][x_mask > 0].tolist())
+
+        return gen_sample(fs_init, fs_next, x, x_mask,
                           self._options[0],
-                          trng=trng, k=k, maxlen=maxlen,
-                          stochastic=False, argmax=False,
+                          k=k, maxlen=maxlen,
                           return_alignment=return_alignment,
                           suppress_unk=suppress_unk,
-                          return_hyp_graph=return_hyp_graph)
+                          return_hyp_graph=return_hyp_graph,
+                          shortlist=shortlist)
 
 
     ### WRITING TO AND READING FROM QUEUES ###
 
-    def _send_jobs(self, input_, translation_settings):
+    def _make_queue_item(self, line, idx, translation_settings):
+        """
+        Maps a line of input to word ids; returns the queue item and the
+        source words.
+        """
+        if translation_settings.char_level:
+            words = list(line.decode('utf-8').strip())
+        else:
+            words = line.strip().split()
+
+        x = []
+        for w in words:
+            w = [self._word_dicts[i][f] if f in self._word_dicts[i] else 1 for (i,f) in enumerate(w.split('|'))]
+            if len(w) != self._options[0]['factors']:
+                logging.warning('Expected {0} factors, but input word has {1}\n'.format(self._options[0]['factors'], len(w)))
+                for midx in xrange(self._num_processes):
+                    self._processes[midx].terminate()
+                sys.exit(1)
+            x.append(w)
+
+        x += [[0]*self._options[0]['factors']]
+
+        input_item = QueueItem(verbose=self._verbose,
+                               return_hyp_graph=translation_settings.get_search_graph,
+                               return_alignment=translation_settings.get_alignment,
+                               k=translation_settings.beam_width,
+                               suppress_unk=translation_settings.suppress_unk,
+                               normalization_alpha=translation_settings.normalization_alpha,
+                               nbest=translation_settings.n_best,
+                               max_ratio=translation_settings.max_ratio,
+                               seq=x,
+                               idx=idx,
+                               request_id=translation_settings.request_id,
+                               priority=PRIORITIES.index(translation_settings.priority),
+                               submit_time=time.time(),
+                               deadline=None)
+        if translation_settings.deadline:
+            input_item.deadline = input_item.submit_time + translation_settings.deadline
+        return input_item, words
+
+    def _prepare_request(self, source_segments, translation_settings):
         """
+        Prepares the jobs (queue items) for the segments of a request.
+        Segments that occur more than once are only decoded once; if the
+        translation cache is enabled, results are also taken from the cache
+        where possible. Returns a QueueItem that describes the request; `jobs`
+        are to be sent to the workers, and `job_keys` are their keys.
         """
+        # hypothesis graphs are not cached
+        cacheable = self._cache is not None and not translation_settings.get_search_graph
         source_sentences = []
-        for idx, line in enumerate(input_):
-            if translation_settings.char_level:
-                words = list(line.decode('utf-8').strip())
-            else:
-                words = line.strip().split()
-
-            x = []
-            for w in words:
-                w = [self._word_dicts[i][f] if f in self._word_dicts[i] else 1 for (i,f) in enumerate(w.split('|'))]
-                if len(w) != self._options[0]['factors']:
-                    logging.warning('Expected {0} factors, but input word has {1}\n'.format(self._options[0]['factors'], len(w)))
-                    for midx in xrange(self._num_processes):
-                        self._processes[midx].terminate()
-                    sys.exit(1)
-                x.append(w)
-
-            x += [[0]*self._options[0]['factors']]
-
-            input_item = QueueItem(verbose=self._verbose,
-                                   return_hyp_graph=translation_settings.get_search_graph,
-                                   return_alignment=translation_settings.get_alignment,
-                                   k=translation_settings.beam_width,
-                                   suppress_unk=translation_settings.suppress_unk,
-                                   normalization_alpha=translation_settings.normalization_alpha,
-                                   nbest=translation_settings.n_best,
-                                   max_ratio=translation_settings.max_ratio,
-                                   seq=x,
-                                   idx=idx,
-                                   request_id=translation_settings.request_id)
-
-            self._input_queue.put(input_item)
+        keys = []
+        results = {}
+        jobs = []
+        job_keys = []
+        for idx, line in enumerate(source_segments):
+            input_item, words = self._make_queue_item(line, idx, translation_settings)
             source_sentences.append(words)
-        return idx+1, source_sentences
+            key = self._get_cache_key(input_item)
+            keys.append(key)
+            if key in results:
+                if self._cache is not None:
+                    self._cache.add_duplicates(1)
+                continue
+            results[key] = self._cache.get(key) if cacheable else None
+            if results[key] is None:
+                input_item.idx = len(jobs)
+                jobs.append(input_item)
+                job_keys.append(key)
+
+        return QueueItem(settings=translation_settings,
+                         source_sentences=source_sentences,
+                         keys=keys,
+                         results=results,
+                         jobs=jobs,
+                         job_keys=job_keys,
+                         cacheable=cacheable)
+
+    def _send_request(self, request):
+        """
+        Sends the jobs of a request to the workers, longest first. Since
+        workers take jobs from a shared queue whenever they are idle, the
+        shortest jobs are left for the end of the request, where they fill
+        the gaps between workers; and consecutive jobs, which end up in the
+        same batch, are of similar length.
+        """
+        for input_item in sorted(request.jobs, key=lambda input_item: -len(input_item.seq)):
+            self._put_job(input_item)
+        request.jobs = None
+
+    def _finish_request(self, request, job_results):
+        """
+        Returns the translations of a request (see `_send_request`), given
+        the worker results of its jobs.
+        """
+        for key, result in zip(request.job_keys, job_results):
+            request.results[key] = result
+            if request.cacheable and result is not None:
+                self._cache.put(key, result)
+
+        translations = []
+        for i, key in enumerate(request.keys):
+            translations.append(self._make_translation(i, request.results[key],
+                                                       request.source_sentences[i],
+                                                       request.settings))
+        if self._cache is not None:
+            logging.debug('Translation cache: {0}'.format(self._cache.stats()))
+        return translations
+
+    def _find_crashed_worker(self):
+        """
+        Returns a worker process that has crashed, or None.
+        """
+        for process in self._processes:
+            if not process.is_alive() and process.exitcode != 0:
+                return process
+        return None
+
+    def _terminate_workers(self):
+        self._input_queue.cancel_join_thread()
+        self._output_queue.cancel_join_thread()
+        for process in self._processes:
+            process.terminate()
+
+    def _get_response(self, timeout=5):
+        """
+        Returns the next (request_id, idx, output_item) from the output queue;
+        exits if a worker process has crashed.
+        """
+        resp = None
+        while resp is None:
+            try:
+                resp = self._output_queue.get(True, timeout)
+                self._queue_slots.release()
+            # if queue is empty after 5s, check if processes are still alive
+            except Empty:
+                process = self._find_crashed_worker()
+                if process is not None:
+                    # kill all other processes and raise exception if one dies
+                    self._terminate_workers()
+                    logging.error("Translate worker process {0} crashed with exitcode {1}".format(process.pid, process.exitcode))
+                    sys.exit(1)
+        return resp
 
     def _retrieve_jobs(self, num_samples, request_id, timeout=5):
         """
         """
         while len(self._retrieved_translations[request_id]) < num_samples:
-            resp = None
-            while resp is None:
-                try:
-                    resp = self._output_queue.get(True, timeout)
-                # if queue is empty after 5s, check if processes are still alive
-                except Empty:
-                    for midx in xrange(self._num_processes):
-                        if not self._processes[midx].is_alive() and self._processes[midx].exitcode != 0:
-                            # kill all other processes and raise exception if one dies
-                            self._input_queue.cancel_join_thread()
-                            self._output_queue.cancel_join_thread()
-                            for idx in xrange(self._num_processes):
-                                self._processes[idx].terminate()
-                            logging.error("Translate worker process {0} crashed with exitcode {1}".format(self._processes[midx].pid, self._processes[midx].exitcode))
-                            sys.exit(1)
-            request_id, idx, output_item = resp
+            request_id, idx, output_item = self._get_response(timeout)
             self._retrieved_translations[request_id][idx] = output_item
             #print self._retrieved_translations
 
@@ -440,53 +858,305 @@ class Translator(object):
         # then remove all entries with this request ID from the dictionary
         del self._retrieved_translations[request_id]
 
+    ### DISPATCHING RESULTS OF CONCURRENT REQUESTS ###
+
+    def start_dispatcher(self):
+        """
+        Starts a thread that reads all results from the output queue and
+        completes the requests sent with `translate_async`. Once the
+        dispatcher runs, `translate` can be called from several threads.
+        """
+        self._async_requests = {}
+        self._async_lock = threading.Lock()
+        self._dispatcher_error = None
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+        # with a cache on disk, requests are prepared by another thread, so
+        # that translate_async (e.g. on the event loop of the server) does
+        # not wait for cache lookups on disk
+        self._submit_queue = None
+        if self._cache is not None and self._cache_on_disk:
+            self._submit_queue = ThreadQueue()
+            submitter = threading.Thread(target=self._submit_requests)
+            submitter.daemon = True
+            submitter.start()
+
+    def _dispatch(self, timeout=5):
+        """
+        Executed by the dispatcher thread.
+        """
+        while True:
+            try:
+                resp = self._output_queue.get(True, timeout)
+                self._queue_slots.release()
+            except (EOFError, IOError):
+                # the queue has been closed (at exit)
+                return
+            except Empty:
+                process = self._find_crashed_worker()
+                if process is None:
+                    continue
+                self._terminate_workers()
+                message = "Translate worker process {0} crashed with exitcode {1}".format(process.pid, process.exitcode)
+                logging.error(message)
+                with self._async_lock:
+                    self._dispatcher_error = RuntimeError(message)
+                    requests = self._async_requests.values()
+                    self._async_requests = {}
+                for request in requests:
+                    request.callback(None, self._dispatcher_error)
+                return
+
+            request_id, idx, output_item = resp
+            with self._async_lock:
+                request = self._async_requests.get(request_id)
+                if request is None:
+                    logging.warning('Discarding result of unknown request {0}'.format(request_id))
+                    continue
+                request.job_results[idx] = output_item
+                request.num_pending -= 1
+                if request.num_pending > 0:
+                    continue
+                del self._async_requests[request_id]
+            self._complete_async(request)
+
+    def _complete_async(self, request):
+        try:
+            translations = self._finish_request(request, request.job_results)
+        except DeadlineExceeded as e:
+            request.callback(None, e)
+        except Exception as e:
+            logging.exception('Could not complete request {0}'.format(request.settings.request_id))
+            request.callback(None, e)
+        else:
+            request.callback(translations, None)
+
+    def _submit_requests(self):
+        """
+        Executed by the submitter thread (see `start_dispatcher`).
+        """
+        while True:
+            self._submit_async(*self._submit_queue.get())
+
+    def _submit_async(self, source_segments, translation_settings, callback):
+        """
+        Prepares a request (see `translate_async`) and sends its jobs to the
+        workers.
+        """
+        try:
+            request = self._prepare_request(source_segments, translation_settings)
+        except Exception as e:
+            logging.exception('Could not prepare request {0}'.format(translation_settings.request_id))
+            callback(None, e)
+            return
+        request.callback = callback
+        request.job_results = [None] * len(request.jobs)
+        request.num_pending = len(request.jobs)
+        if request.num_pending == 0:
+            # all results are cached
+            self._complete_async(request)
+            return
+        # register the request before sending its jobs, so that the
+        # dispatcher knows it when the first result arrives
+        with self._async_lock:
+            self._async_requests[translation_settings.request_id] = request
+        self._send_request(request)
+
+    def translate_async(self, source_segments, translation_settings, callback):
+        """
+        Sends @param source_segments to the workers and returns immediately.
+        Once all segments are translated, the dispatcher thread (see
+        `start_dispatcher`) calls @param callback with the translations and
+        None, or with None and an exception if translation failed.
+        """
+        logging.info('Translating {0} segments...\n'.format(len(source_segments)))
+        if self._dispatcher_error is not None:
+            callback(None, self._dispatcher_error)
+            return
+        if self._submit_queue is not None:
+            self._submit_queue.put((source_segments, translation_settings, callback))
+        else:
+            self._submit_async(source_segments, translation_settings, callback)
+
+    def _make_translation(self, sentence_id, trans, source_words, translation_settings):
+        """
+        Builds the Translation (or the n-best list of Translations) of a
+        sentence from the output of a worker.
+        """
+        if trans is None:
+            raise DeadlineExceeded('Deadline of sentence {0} exceeded'.format(sentence_id))
+        samples, scores, word_probs, alignment, hyp_graph = trans
+        # n-best list
+        if translation_settings.n_best is True:
+            order = numpy.argsort(scores)
+            n_best_list = []
+            for j in order:
+                current_alignment = None if not translation_settings.get_alignment else alignment[j]
+                translation = Translation(sentence_id=sentence_id,
+                                          source_words=source_words,
+                                          target_words=seqs2words(samples[j], self._word_idict_trg, join=False),
+                                          score=scores[j],
+                                          alignment=current_alignment,
+                                          target_probs=word_probs[j],
+                                          hyp_graph=hyp_graph,
+                                          hypothesis_id=j)
+                n_best_list.append(translation)
+            return n_best_list
+        # single-best translation
+        else:
+            current_alignment = None if not translation_settings.get_alignment else alignment
+            translation = Translation(sentence_id=sentence_id,
+                                      source_words=source_words,
+                                      target_words=seqs2words(samples, self._word_idict_trg, join=False),
+                                      score=scores,
+                                      alignment=current_alignment,
+                                      target_probs=word_probs,
+                                      hyp_graph=hyp_graph)
+            return translation
+
+    def _get_cache_key(self, input_item):
+        """
+        Returns the key of the result of an item: items of a request with the
+        same key have the same result, and the key identifies the result in
+        the translation cache.
+        """
+        settings = (input_item.k, input_item.normalization_alpha,
+                    input_item.suppress_unk, input_item.max_ratio,
+                    input_item.nbest, input_item.return_alignment,
+                    self._cache_id)
+        return TranslationCache.key(input_item.seq, settings)
+
     ### EXPOSED TRANSLATION FUNCTIONS ###
 
     def translate(self, source_segments, translation_settings):
         """
         Returns the translation of @param source_segments.
         """
+        if self._dispatcher is not None:
+            # results are collected by the dispatcher thread
+            done = threading.Event()
+            response = []
+            def callback(translations, error):
+                response.append((translations, error))
+                done.set()
+            self.translate_async(source_segments, translation_settings, callback)
+            while not done.wait(1):
+                pass
+            translations, error = response[0]
+            if error is not None:
+                raise error
+            return translations
+
         logging.info('Translating {0} segments...\n'.format(len(source_segments)))
-        n_samples, source_sentences = self._send_jobs(source_segments, translation_settings)
+        request = self._prepare_request(source_segments, translation_settings)
+        self._send_request(request)
+        job_results = list(self._retrieve_jobs(len(request.job_keys), translation_settings.request_id))
+        return self._finish_request(request, job_results)
 
-        translations = []
-        for i, trans in enumerate(self._retrieve_jobs(n_samples, translation_settings.request_id)):
-
-            samples, scores, word_probs, alignment, hyp_graph = trans
-            # n-best list
-            if translation_settings.n_best is True:
-                order = numpy.argsort(scores)
-                n_best_list = []
-                for j in order:
-                    current_alignment = None if not translation_settings.get_alignment else alignment[j]
-                    translation = Translation(sentence_id=i,
-                                              source_words=source_sentences[i],
-                                              target_words=seqs2words(samples[j], self._word_idict_trg, join=False),
-                                              score=scores[j],
-                                              alignment=current_alignment,
-                                              target_probs=word_probs[j],
-                                              hyp_graph=hyp_graph,
-                                              hypothesis_id=j)
-                    n_best_list.append(translation)
-                translations.append(n_best_list)
-            # single-best translation
-            else:
-                current_alignment = None if not translation_settings.get_alignment else alignment
-                translation = Translation(sentence_id=i,
-                                          source_words=source_sentences[i],
-                                          target_words=seqs2words(samples, self._word_idict_trg, join=False),
-                                          score=scores,
-                                          alignment=current_alignment,
-                                          target_probs=word_probs,
-                                          hyp_graph=hyp_graph)
-                translations.append(translation)
-        return translations
+    def translate_stream(self, input_object, output_file, translation_settings,
+                         start=0, checkpoint=None, report_interval=10):
+        """
+        Translates @param input_object line by line, and writes each
+        translation to @param output_file as soon as all previous ones are
+        complete. At most `translation_settings.stream_window` sentences are
+        read but not yet written, so memory use does not depend on the
+        size of the input. The first @param start lines are skipped; after
+        output has been written, @param checkpoint (if given) is called with
+        the number of lines that are done. Returns this number.
+        """
+        window = max(1, translation_settings.stream_window)
+        busy_time = self.get_busy_time()
+
+        for _ in xrange(start):
+            if not input_object.readline():
+                break
+
+        source_sentences = {}
+        results = {}
+        n_read = start      # lines read (and sent to the workers)
+        n_written = start   # lines whose translations have been written
+        end_of_input = False
+        start_time = last_report = time.time()
+        while True:
+            # readline instead of iteration: reading ahead would block on
+            # interactive input
+            while not end_of_input and n_read - n_written < window:
+                line = input_object.readline()
+                if not line:
+                    end_of_input = True
+                    break
+                input_item, words = self._make_queue_item(line, n_read, translation_settings)
+                self._put_job(input_item)
+                source_sentences[n_read] = words
+                n_read += 1
+            if n_written == n_read:
+                break
+
+            _, idx, output_item = self._get_response()
+            results[idx] = output_item
+            if idx != n_written:
+                continue
+            while n_written in results:
+                translation = self._make_translation(n_written, results.pop(n_written),
+                                                     source_sentences.pop(n_written),
+                                                     translation_settings)
+                self.write_translations(output_file, [translation], translation_settings)
+                n_written += 1
+            output_file.flush()
+            if translation_settings.get_alignment:
+                translation_settings.output_alignment.flush()
+            if checkpoint is not None:
+                checkpoint(n_written)
+
+            now = time.time()
+            if now - last_report >= report_interval:
+                logging.info('Translated {0} sentences ({1:.2f} sentences/s)'.format(
+                    n_written, (n_written - start) / (now - start_time)))
+                last_report = now
+
+        elapsed = time.time() - start_time
+        logging.info('Translated {0} sentences in {1:.1f}s ({2:.2f} sentences/s)'.format(
+            n_written - start, elapsed, (n_written - start) / max(elapsed, 1e-6)))
+        self._log_utilization(start_time, busy_time)
+        return n_written
+
+    def get_worker_utilization(self, start_time, busy_time):
+        """
+        Returns the fraction of time that each worker spent translating since
+        @param start_time (or since it had loaded its models), given its
+        @param busy_time at that point (see `get_busy_time`).
+        """
+        now = time.time()
+        utilization = []
+        for process_id in xrange(self._num_processes):
+            ready_time = self._ready_time[process_id] or now
+            elapsed = now - max(start_time, ready_time)
+            busy = self._busy_time[process_id] - busy_time[process_id]
+            utilization.append(busy / elapsed if elapsed > 0 else 0.0)
+        return utilization
+
+    def get_busy_time(self):
+        """
+        Returns the time that each worker has spent translating.
+        """
+        return list(self._busy_time)
+
+    def _log_utilization(self, start_time, busy_time):
+        utilization = self.get_worker_utilization(start_time, busy_time)
+        logging.info('Worker utilization: {0} (mean {1:.1%})'.format(
+            ', '.join('{0}: {1:.1%}'.format(process_id, u) for process_id, u in enumerate(utilization)),
+            sum(utilization) / len(utilization)))
 
     def translate_file(self, input_object, translation_settings):
         """
         """
         source_segments = input_object.readlines()
-        return self.translate(source_segments, translation_settings)
+        start_time = time.time()
+        busy_time = self.get_busy_time()
+        translations = self.translate(source_segments, translation_settings)
+        self._log_utilization(start_time, busy_time)
+        return translations
 
 
     def translate_string(self, segment, translation_settings):
@@ -568,14 +1238,79 @@ class Translator(object):
             for translation in translations:
                 self.write_translation(output_file, translation, translation_settings)
 
+class StreamProgress(object):
+    """
+    Records how many sentences of a streaming translation have been
+    written, and the size of the output files at that point, in
+    <output>.progress.json. An interrupted translation is resumed by
+    truncating the output files to these sizes and skipping the
+    translated sentences.
+    """
+    def __init__(self, output_file, alignment_file=None, interval=1.0):
+        self.path = output_file.name + '.progress.json'
+        self._files = [('output', output_file)]
+        if alignment_file is not None:
+            self._files.append(('output_alignment', alignment_file))
+        self._interval = interval
+        self._last_save = 0
+
+    def resume(self):
+        """
+        Truncates the output files to the recorded position; returns the
+        number of sentences to skip.
+        """
+        if not os.path.exists(self.path):
+            for _, f in self._files:
+                if os.path.getsize(f.name) > 0:
+                    logging.error('Cannot resume: {0} is not empty, but there is no {1}'.format(f.name, self.path))
+                    sys.exit(1)
+            return 0
+        with open(self.path, 'rb') as f:
+            progress = json.load(f)
+        for key, f in self._files:
+            if key not in progress:
+                logging.error('Cannot resume: {0} does not record the position of {1}'.format(self.path, f.name))
+                sys.exit(1)
+            f.truncate(progress[key])
+            f.seek(0, os.SEEK_END)
+        logging.info('Resuming after sentence {0}'.format(progress['sentences']))
+        return progress['sentences']
+
+    def __call__(self, sentences, force=False):
+        now = time.time()
+        if not force and now - self._last_save < self._interval:
+            return
+        progress = {'sentences': sentences}
+        for key, f in self._files:
+            progress[key] = f.tell()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(progress, f)
+        os.rename(tmp_path, self.path)
+        self._last_save = now
+
+
 def main(input_file, output_file, translation_settings):
     """
     Translates a source language file (or STDIN) into a target language file
     (or STDOUT).
     """
     translator = Translator(translation_settings)
-    translations = translator.translate_file(input_file, translation_settings)
-    translator.write_translations(output_file, translations, translation_settings)
+    if translation_settings.stream:
+        progress = None
+        start = 0
+        if output_file is not sys.stdout:
+            alignment_file = translation_settings.output_alignment if translation_settings.get_alignment else None
+            progress = StreamProgress(output_file, alignment_file)
+            if translation_settings.resume:
+                start = progress.resume()
+        n_written = translator.translate_stream(input_file, output_file, translation_settings,
+                                                start=start, checkpoint=progress)
+        if progress is not None:
+            progress(n_written, force=True)
+    else:
+        translations = translator.translate_file(input_file, translation_settings)
+        translator.write_translations(output_file, translations, translation_settings)
 
     logging.info('Done')
     translator.shutdown()
@@ -587,6 +1322,12 @@ if __name__ == "__main__":
     input_file = translation_settings.input
     output_file = translation_settings.output
     # start logging
-    level = logging.DEBUG if translation_settings.verbose else logging.WARNING
+    if translation_settings.verbose:
+        level = logging.DEBUG
+    elif translation_settings.stream:
+        # report progress
+        level = logging.INFO
+    else:
+        level = logging.WARNING
     logging.basicConfig(level=level, format='%(levelname)s: %(message)s')
     main(input_file, output_file, translation_settings)
@@ -0,0 +1,167 @@
+'''
+Cache of translation results, so that repeated segments (within a request
+or across requests) are only decoded once.
+
+Entries are keyed by the word ids of a segment (so that segments that only
+differ in whitespace, or in unknown words, share an entry), the decoding
+settings that affect the output and the identity of the models. The
+in-memory cache evicts the least recently used entries if it exceeds a
+maximum number of entries or a maximum size (of the pickled results).
+Optionally, entries are also stored in a directory, which is not limited in
+size and can be shared by several processes.
+'''
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import cPickle as pkl
+
+from collections import OrderedDict
+
+
+def model_id(models):
+    """
+    Identifies a set of model files by their paths, sizes and modification
+    times.
+    """
+    model_stats = []
+    for model in models:
+        for path in (model, model + '.npz'):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                model_stats.append((os.path.abspath(path), stat.st_size, int(stat.st_mtime)))
+                break
+        else:
+            model_stats.append((model, None, None))
+    return model_stats
+
+
+class TranslationCache(object):
+    """
+    LRU cache of translation results (as returned by the worker processes).
+    Safe to use from several threads.
+    """
+    def __init__(self, max_entries, max_bytes=0, directory=None):
+        """
+        @param max_entries: maximum number of entries in memory (0 for no
+                            in-memory cache)
+        @param max_bytes: maximum total size of the entries in memory (0 for
+                          no limit)
+        @param directory: directory in which entries are stored on disk
+                          (optional)
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._directory = directory
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.duplicates = 0
+        self.evictions = 0
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(seq, settings):
+        """
+        Returns the key of the word ids @param seq, decoded with
+        @param settings (anything that can be represented with repr).
+        """
+        return hashlib.sha1(repr((seq, settings))).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key[:2], key + '.pkl')
+
+    def _add(self, key, value, size):
+        # caller holds the lock
+        if self._max_entries <= 0 or (self._max_bytes and size > self._max_bytes):
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while len(self._entries) > self._max_entries or \
+              (self._max_bytes and self._bytes > self._max_bytes):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Returns the cached result for @param key, or None.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # move to the end (most recently used)
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+
+        if self._directory is not None:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+                value = pkl.loads(data)
+            except (IOError, EOFError, pkl.UnpicklingError):
+                pass
+            else:
+                with self._lock:
+                    self._add(key, value, len(data))
+                    self.disk_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Stores @param value for @param key.
+        """
+        data = pkl.dumps(value, protocol=pkl.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._add(key, value, len(data))
+
+        if self._directory is not None:
+            path = self._path(key)
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    try:
+                        os.makedirs(os.path.dirname(path))
+                    except OSError:
+                        # created by another thread or process
+                        pass
+                # write to a temporary file first, so that concurrent
+                # readers never see an incomplete entry
+                handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+                with os.fdopen(handle, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp_path, path)
+            except (IOError, OSError) as e:
+                logging.warning('Could not write translation cache entry {0} ({1})'.format(path, e))
+
+    def add_duplicates(self, n):
+        """
+        Counts segments that were not decoded because they occur earlier in
+        the same request.
+        """
+        with self._lock:
+            self.duplicates += n
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'duplicates': self.duplicates,
+                    'evictions': self.evictions,
+                    'hit_rate': float(self.hits + self.disk_hits) / lookups if lookups else 0.0}
@@ -8,8 +8,7 @@ import cPickle as pkl
 import numpy
 import os
 import math
-import theano
-import theano.tensor as tensor
+import tempfile
 
 def align_dot(align, att):
     '''
@@ -17,6 +16,10 @@ def align_dot(align, att):
     align: (batch_size, len1, len2)
     att: (len2, batch_size)
     '''
+    # imported here, so that modules that only need the file utilities
+    # (e.g. training_progress) do not load Theano
+    import theano
+    import theano.tensor as tensor
     scan_func = lambda x, y: tensor.dot(x, y)
     out, update = theano.scan(scan_func,
                     sequences = [align, att.dimshuffle(1, 0)],
@@ -65,6 +68,40 @@ def load_dict(filename):
             return pkl.load(f)
 
 
+# umask of the process, which is only needed for the permissions of new
+# files; Linux reports it in /proc, otherwise os.umask is the only way to
+# read it, but it sets the umask (for all threads) as it reads it, so that
+# is only done once, when this module is imported at start-up
+def _read_umask():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (IOError, ValueError, IndexError):
+        pass
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+_umask = _read_umask()
+
+# write to a temporary file in the same directory, then rename it, so that
+# the file is never left incomplete (e.g. if training is killed); the file
+# gets the permissions of a file created with open() (mkstemp creates 0600)
+def write_atomic(filename, write):
+    handle, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                            prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            write(f)
+        os.chmod(tmp_filename, 0666 & ~_umask)
+        os.rename(tmp_filename, filename)
+    except:
+        os.remove(tmp_filename)
+        raise
+
+
 def load_config(basename):
     try:
         with open('%s.json' % basename, 'rb') as f:
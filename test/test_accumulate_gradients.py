@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import unittest
+from collections import OrderedDict
+
+import numpy
+import theano
+import theano.tensor as tensor
+
+sys.path.append(os.path.abspath('../nematus'))
+from optimizers import accumulate_gradients, sgd
+from theano_util import floatX
+
+# per-token loss 0.5 * sum_k (w_k - c_k * y)^2 of a quadratic "model"
+C = numpy.array([1., 2.], dtype=floatX)
+
+
+def random_batch(rng, n_sentences, max_length=6):
+    lengths = rng.randint(1, max_length + 1, size=n_sentences)
+    y = numpy.zeros((max_length, n_sentences), dtype=floatX)
+    y_mask = numpy.zeros((max_length, n_sentences), dtype=floatX)
+    for i, length in enumerate(lengths):
+        y[:length, i] = rng.randn(length)
+        y_mask[:length, i] = 1.
+    return y, y_mask
+
+
+class TestAccumulateGradients(unittest.TestCase):
+    """
+    Gradient accumulation (as in nmt.train with update_every) on a
+    quadratic objective: the mean over sentences of the summed per-token
+    loss
+    """
+
+    def setUp(self):
+        self.w_init = numpy.array([0.5, -1.], dtype=floatX)
+        self.w = theano.shared(self.w_init.copy(), name='w')
+        self.tparams = OrderedDict([('w', self.w)])
+        self.y = tensor.matrix('y', dtype=floatX)
+        self.y_mask = tensor.matrix('y_mask', dtype=floatX)
+        token_loss = 0.5 * ((self.w[None, None, :] - self.y[:, :, None] * C[None, None, :]) ** 2).sum(2)
+        self.cost = (token_loss * self.y_mask).sum(0).mean()
+        self.lr = tensor.scalar(name='lr')
+        self.batches = [random_batch(numpy.random.RandomState(seed), n) for seed, n in ((1, 3), (2, 5), (3, 1))]
+
+    def accumulated_update(self, normalization, lrate=0.1):
+        n_sentences = tensor.cast(self.y_mask.shape[1], floatX)
+        norm = self.y_mask.sum() if normalization == 'token' else n_sentences
+        f_grad, f_reset, grads, _ = accumulate_gradients(self.tparams, tensor.grad(self.cost, wrt=[self.w]),
+                                                         [self.y, self.y_mask], self.cost, n_sentences, norm)
+        f_update, _ = sgd(self.lr, self.tparams, grads, [], None)
+        # the buffers are cleared after each update
+        for _ in xrange(2):
+            self.w.set_value(self.w_init.copy())
+            for y, y_mask in self.batches:
+                f_grad(y, y_mask)
+            f_update(lrate)
+            f_reset()
+        return self.w.get_value()
+
+    def test_sentence_normalization(self):
+        # one update on the concatenation of the minibatches
+        f_update, _ = sgd(self.lr, self.tparams, tensor.grad(self.cost, wrt=[self.w]), [self.y, self.y_mask], self.cost)
+        f_update(0.1, numpy.concatenate([y for y, _ in self.batches], axis=1),
+                 numpy.concatenate([y_mask for _, y_mask in self.batches], axis=1))
+        expected = self.w.get_value()
+        self.assertFalse(numpy.allclose(expected, self.w_init))
+        numpy.testing.assert_allclose(self.accumulated_update('sentence'), expected, rtol=1e-5)
+
+    def test_token_normalization(self):
+        # gradient of the per-token loss, averaged over all target tokens
+        ys = numpy.concatenate([y[y_mask > 0] for y, y_mask in self.batches])
+        gradient = (self.w_init[None, :] - ys[:, None] * C[None, :]).mean(0)
+        expected = self.w_init - 0.1 * gradient
+        numpy.testing.assert_allclose(self.accumulated_update('token'), expected, rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
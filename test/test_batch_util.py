@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from batch_util import BatchBuffers, prepare_batch
+
+
+def prepare_batch_loop(sources, target, weights=None, maxlen=None, n_factors=1, mask_dtype='float32'):
+    """
+    Reference implementation: the loop of the former nmt.prepare_data, for
+    one or more source sides (the second source side is read from its own
+    sentences, and all sides are length-filtered); the placeholder weights
+    of prepare_data are added by its wrapper, not by prepare_batch
+    """
+    lengths_x = [[len(s) for s in seqs_x] for seqs_x in sources]
+    lengths_y = [len(s) for s in target]
+
+    if maxlen is not None:
+        keep = [i for i in xrange(len(target))
+                if lengths_y[i] < maxlen and all(lengths[i] < maxlen for lengths in lengths_x)]
+        if not keep:
+            return None
+        sources = [[seqs_x[i] for i in keep] for seqs_x in sources]
+        lengths_x = [[lengths[i] for i in keep] for lengths in lengths_x]
+        target = [target[i] for i in keep]
+        lengths_y = [lengths_y[i] for i in keep]
+        if weights is not None:
+            weights = [weights[i] for i in keep]
+
+    n_samples = len(target)
+    xs = []
+    for seqs_x, lengths in zip(sources, lengths_x):
+        maxlen_x = numpy.max(lengths) + 1
+        x = numpy.zeros((n_factors, maxlen_x, n_samples)).astype('int64')
+        x_mask = numpy.zeros((maxlen_x, n_samples)).astype(mask_dtype)
+        for idx, s_x in enumerate(seqs_x):
+            if lengths[idx]:
+                x[:, :lengths[idx], idx] = zip(*s_x)
+            x_mask[:lengths[idx]+1, idx] = 1.
+        xs.append((x, x_mask))
+    maxlen_y = numpy.max(lengths_y) + 1
+    y = numpy.zeros((maxlen_y, n_samples)).astype('int64')
+    y_mask = numpy.zeros((maxlen_y, n_samples)).astype(mask_dtype)
+    for idx, s_y in enumerate(target):
+        y[:lengths_y[idx], idx] = s_y
+        y_mask[:lengths_y[idx]+1, idx] = 1.
+    return xs, (y, y_mask), weights
+
+
+def random_batch(rng, n_samples, n_sources=1, n_factors=1, max_length=12):
+    sources = [[[list(rng.randint(1, 50, size=n_factors)) for _ in xrange(rng.randint(0, max_length))]
+                for _ in xrange(n_samples)]
+               for _ in xrange(n_sources)]
+    target = [list(rng.randint(1, 50, size=rng.randint(0, max_length))) for _ in xrange(n_samples)]
+    weights = list(rng.rand(n_samples))
+    return sources, target, weights
+
+
+class TestPrepareBatch(unittest.TestCase):
+    """
+    The vectorized prepare_batch must give the same minibatches as the
+    former loop implementation
+    """
+
+    def assertSameBatch(self, sources, target, weights=None, maxlen=None, n_factors=1, buffers=None):
+        expected = prepare_batch_loop(sources, target, weights, maxlen, n_factors)
+        batch = prepare_batch(sources, target, weights=weights, maxlen=maxlen,
+                              n_factors=n_factors, buffers=buffers)
+        if expected is None:
+            self.assertIsNone(batch)
+            return
+        xs, (y, y_mask), batch_weights, source_lengths = batch
+        expected_xs, (expected_y, expected_y_mask), expected_weights = expected
+        self.assertEqual(len(xs), len(expected_xs))
+        for (x, x_mask), (expected_x, expected_x_mask), lengths in zip(xs, expected_xs, source_lengths):
+            numpy.testing.assert_array_equal(x, expected_x)
+            numpy.testing.assert_array_equal(x_mask, expected_x_mask)
+            self.assertEqual(x_mask.dtype, expected_x_mask.dtype)
+            numpy.testing.assert_array_equal(lengths, expected_x_mask.sum(0) - 1)
+        numpy.testing.assert_array_equal(y, expected_y)
+        numpy.testing.assert_array_equal(y_mask, expected_y_mask)
+        self.assertEqual(batch_weights, expected_weights)
+
+    def test_single_source(self):
+        rng = numpy.random.RandomState(1)
+        for _ in xrange(20):
+            sources, target, _ = random_batch(rng, rng.randint(1, 20))
+            self.assertSameBatch(sources, target)
+
+    def test_factors(self):
+        rng = numpy.random.RandomState(2)
+        for _ in xrange(20):
+            sources, target, _ = random_batch(rng, rng.randint(1, 20), n_factors=3)
+            self.assertSameBatch(sources, target, n_factors=3)
+
+    def test_maxlen_and_weights(self):
+        rng = numpy.random.RandomState(3)
+        for _ in xrange(20):
+            sources, target, weights = random_batch(rng, rng.randint(1, 20), n_factors=2)
+            self.assertSameBatch(sources, target, weights=weights, maxlen=6, n_factors=2)
+            self.assertSameBatch(sources, target, maxlen=6, n_factors=2)
+
+    def test_maxlen_removes_all(self):
+        sources = [[[[1]] * 5, [[2]] * 7]]
+        target = [[3] * 5, [4] * 2]
+        self.assertIsNone(prepare_batch(sources, target, maxlen=4))
+        self.assertSameBatch(sources, target, maxlen=4)
+
+    def test_multiple_sources(self):
+        rng = numpy.random.RandomState(4)
+        for _ in xrange(20):
+            sources, target, weights = random_batch(rng, rng.randint(1, 20), n_sources=2)
+            self.assertSameBatch(sources, target)
+            self.assertSameBatch(sources, target, weights=weights, maxlen=6)
+
+    def test_buffers(self):
+        rng = numpy.random.RandomState(5)
+        buffers = BatchBuffers()
+        for _ in xrange(10):
+            sources, target, weights = random_batch(rng, rng.randint(1, 20), n_factors=2)
+            self.assertSameBatch(sources, target, weights=weights, maxlen=8, n_factors=2, buffers=buffers)
+
+    def test_buffers_are_reused(self):
+        """
+        with BatchBuffers, the arrays of a minibatch are overwritten by the
+        next one (and without, they are not)
+        """
+        rng = numpy.random.RandomState(6)
+        first = random_batch(rng, 10, max_length=8)[:2]
+        second = random_batch(rng, 10, max_length=8)[:2]
+
+        buffers = BatchBuffers()
+        [(x, x_mask)], (y, y_mask), _, _ = prepare_batch(*first, buffers=buffers)
+        x_copy = x.copy()
+        [(x2, _)], _, _, _ = prepare_batch(*second, buffers=buffers)
+        self.assertTrue(numpy.may_share_memory(x, x2))
+        self.assertFalse(numpy.array_equal(x, x_copy))
+
+        [(x, x_mask)], (y, y_mask), _, _ = prepare_batch(*first)
+        x_copy = x.copy()
+        [(x2, _)], _, _, _ = prepare_batch(*second)
+        self.assertFalse(numpy.may_share_memory(x, x2))
+        numpy.testing.assert_array_equal(x, x_copy)
+
+
+if __name__ == '__main__':
+    unittest.main()
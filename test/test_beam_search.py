@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import copy
+import unittest
+
+import numpy
+import theano
+
+sys.path.append(os.path.abspath('../nematus'))
+from nmt import build_sampler, gen_sample, gen_sample_batch
+from theano_util import floatX, numpy_floatX
+from hypgraph import HypGraph
+from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+
+from tiny_model import tiny_model
+
+
+def gen_sample_loop(f_init, f_next, x, model_options, k=1, maxlen=30, return_alignment=False,
+                    suppress_unk=False, return_hyp_graph=False):
+    """
+    Reference implementation: beam search of the former gen_sample (list
+    based, one sentence at a time), without the deep fusion LM
+    """
+    sample = []
+    sample_score = []
+    sample_word_probs = []
+    alignment = []
+    hyp_graph = HypGraph() if return_hyp_graph else None
+    live_k = 1
+    dead_k = 0
+
+    hyp_samples = [[] for i in xrange(live_k)]
+    word_probs = [[] for i in xrange(live_k)]
+    hyp_scores = numpy.zeros(live_k).astype(floatX)
+    hyp_alignment = [[] for _ in xrange(live_k)]
+
+    num_models = len(f_init)
+    next_state = [None]*num_models
+    ctx0 = [None]*num_models
+    next_p = [None]*num_models
+    dec_alphas = [None]*num_models
+    for i in xrange(num_models):
+        ret = f_init[i](x)
+        # (layers, batch_size, dim) to (batch_size, layers, dim)
+        ret[0] = numpy.transpose(ret[0], (1,0,2))
+        next_state[i] = numpy.tile(ret[0], (live_k, 1, 1))
+        ctx0[i] = ret[1]
+
+    next_w = -1 * numpy.ones((live_k,)).astype('int64')  # bos indicator
+
+    for ii in xrange(maxlen):
+        for i in xrange(num_models):
+            ctx = numpy.tile(ctx0[i], [live_k, 1])
+            next_state[i] = numpy.transpose(next_state[i], (1,0,2))
+            ret = f_next[i](next_w, ctx, next_state[i])
+            next_p[i], next_state[i] = ret[0], ret[2]
+            if return_alignment:
+                dec_alphas[i] = ret[3]
+            next_state[i] = numpy.transpose(next_state[i], (1,0,2))
+            if suppress_unk:
+                next_p[i][:,1] = -numpy.inf
+
+        cand_scores = hyp_scores[:, None] - sum(numpy.log(next_p))
+        probs = sum(next_p)/num_models
+        cand_flat = cand_scores.flatten()
+        probs_flat = probs.flatten()
+        ranks_flat = cand_flat.argpartition(k-dead_k-1)[:(k-dead_k)]
+
+        if return_alignment:
+            mean_alignment = sum(dec_alphas)/num_models
+
+        voc_size = next_p[0].shape[1]
+        trans_indices = ranks_flat / voc_size
+        word_indices = ranks_flat % voc_size
+        costs = cand_flat[ranks_flat]
+
+        new_hyp_samples = []
+        new_hyp_scores = numpy.zeros(k-dead_k).astype(floatX)
+        new_word_probs = []
+        new_hyp_states = []
+        new_hyp_alignment = [[] for _ in xrange(k-dead_k)]
+
+        for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
+            new_hyp_samples.append(hyp_samples[ti]+[wi])
+            new_word_probs.append(word_probs[ti] + [probs_flat[ranks_flat[idx]].tolist()])
+            new_hyp_scores[idx] = copy.copy(costs[idx])
+            new_hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)])
+            if return_alignment:
+                new_hyp_alignment[idx] = copy.copy(hyp_alignment[ti])
+                new_hyp_alignment[idx].append(mean_alignment[ti])
+
+        new_live_k = 0
+        hyp_samples = []
+        hyp_scores = []
+        hyp_states = []
+        word_probs = []
+        hyp_alignment = []
+
+        for idx in xrange(len(new_hyp_samples)):
+            if return_hyp_graph:
+                word, history = new_hyp_samples[idx][-1], new_hyp_samples[idx][:-1]
+                hyp_graph.add(word, history, word_prob=new_word_probs[idx][-1], cost=new_hyp_scores[idx])
+            if new_hyp_samples[idx][-1] == 0:
+                sample.append(copy.copy(new_hyp_samples[idx]))
+                sample_score.append(new_hyp_scores[idx])
+                sample_word_probs.append(new_word_probs[idx])
+                alignment.append(new_hyp_alignment[idx])
+                dead_k += 1
+            else:
+                new_live_k += 1
+                hyp_samples.append(copy.copy(new_hyp_samples[idx]))
+                hyp_scores.append(new_hyp_scores[idx])
+                hyp_states.append(copy.copy(new_hyp_states[idx]))
+                word_probs.append(new_word_probs[idx])
+                hyp_alignment.append(new_hyp_alignment[idx])
+        hyp_scores = numpy.array(hyp_scores)
+
+        live_k = new_live_k
+
+        if new_live_k < 1:
+            break
+        if dead_k >= k:
+            break
+
+        next_w = numpy.array([w[-1] for w in hyp_samples])
+        next_state = [numpy.array(state) for state in zip(*hyp_states)]
+
+    # dump every remaining one
+    if live_k > 0:
+        for idx in xrange(live_k):
+            sample.append(hyp_samples[idx])
+            sample_score.append(hyp_scores[idx])
+            sample_word_probs.append(word_probs[idx])
+            alignment.append(hyp_alignment[idx])
+
+    if not return_alignment:
+        alignment = [None for i in range(len(sample))]
+
+    return sample, sample_score, sample_word_probs, alignment, hyp_graph
+
+
+class TestBeamSearch(unittest.TestCase):
+    """
+    Beam search (gen_sample, which uses the batched gen_sample_batch, and
+    gen_sample_batch on a batch of sentences) must give the same results
+    as the former list-based beam search
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        trng = RandomStreams(1234)
+        use_noise = theano.shared(numpy_floatX(0.))
+        cls.samplers = []
+        cls.batch_samplers = []
+        for seed in (1234, 4321):
+            cls.options, tparams = tiny_model(seed=seed, scale=8.)
+            if seed == 4321:
+                # make UNK likely (for suppress_unk)
+                b = tparams['ff_logit_b'].get_value()
+                b[1] += 6.
+                tparams['ff_logit_b'].set_value(b)
+            cls.samplers.append(build_sampler(tparams, cls.options, use_noise, trng,
+                                              return_alignment=True))
+            cls.batch_samplers.append(build_sampler(tparams, cls.options, use_noise, trng,
+                                                    return_alignment=True, batched=True))
+        rng = numpy.random.RandomState(42)
+        # sentences of different lengths (without end-of-sentence)
+        cls.sentences = [list(rng.randint(2, cls.options['n_words_src'], size=length))
+                         for length in (5, 1, 9, 3, 7)]
+
+    def single_x(self, sentence):
+        return numpy.array(sentence + [0], dtype='int64').reshape((1, len(sentence) + 1, 1))
+
+    def decode_reference(self, models, sentence, **kwargs):
+        f_init, f_next = zip(*[self.samplers[m] for m in models])
+        return gen_sample_loop(f_init, f_next, self.single_x(sentence), self.options,
+                               return_alignment=True, **kwargs)
+
+    def decode_single(self, models, sentence, **kwargs):
+        f_init, f_next = zip(*[self.samplers[m] for m in models])
+        return gen_sample(f_init, f_next, self.single_x(sentence), self.options,
+                          stochastic=False, argmax=False, return_alignment=True, **kwargs)
+
+    def decode_batch(self, models, **kwargs):
+        f_init, f_next = zip(*[self.batch_samplers[m] for m in models])
+        maxlen_x = max(len(s) for s in self.sentences) + 1
+        x = numpy.zeros((1, maxlen_x, len(self.sentences)), dtype='int64')
+        x_mask = numpy.zeros((maxlen_x, len(self.sentences)), dtype=floatX)
+        for i, sentence in enumerate(self.sentences):
+            x[0, :len(sentence), i] = sentence
+            x_mask[:len(sentence) + 1, i] = 1.
+        return gen_sample_batch(f_init, f_next, x, x_mask, self.options, return_alignment=True, **kwargs)
+
+    def assertSameResults(self, reference, result):
+        """
+        compares the hypotheses (in any order, since the former beam search
+        did not sort hypotheses that end in the same step) and hypothesis
+        graphs
+        """
+        sample, score, word_probs, alignment, hyp_graph = reference
+        sample_r, score_r, word_probs_r, alignment_r, hyp_graph_r = result
+        self.assertEqual(sorted(sample), sorted(sample_r))
+        for i, s in enumerate(sample):
+            j = sample_r.index(s)
+            numpy.testing.assert_allclose(score[i], score_r[j], rtol=1e-3)
+            numpy.testing.assert_allclose(word_probs[i], word_probs_r[j], rtol=1e-3, atol=1e-5)
+            numpy.testing.assert_allclose(numpy.array(alignment[i]), numpy.array(alignment_r[j]),
+                                          rtol=1e-3, atol=1e-5)
+        if hyp_graph is None:
+            self.assertIsNone(hyp_graph_r)
+            return
+        self.assertEqual(dict(hyp_graph.nodes), dict(hyp_graph_r.nodes))
+        self.assertEqual(sorted(hyp_graph.edges), sorted(hyp_graph_r.edges))
+        self.assertEqual(sorted(hyp_graph.costs), sorted(hyp_graph_r.costs))
+        for node in hyp_graph.costs:
+            numpy.testing.assert_allclose(hyp_graph.costs[node], hyp_graph_r.costs[node], rtol=1e-3)
+            numpy.testing.assert_allclose(hyp_graph.word_probs[node], hyp_graph_r.word_probs[node],
+                                          rtol=1e-3, atol=1e-5)
+
+    def assertSameAsReference(self, models, **kwargs):
+        batched = self.decode_batch(models, **kwargs)
+        self.assertEqual(len(batched), len(self.sentences))
+        for sentence, result in zip(self.sentences, batched):
+            reference = self.decode_reference(models, sentence, **kwargs)
+            self.assertSameResults(reference, self.decode_single(models, sentence, **kwargs))
+            self.assertSameResults(reference, result)
+        return batched
+
+    def test_beam_search(self):
+        for k in (1, 5):
+            self.assertSameAsReference([0], k=k, maxlen=12)
+
+    def test_ensemble(self):
+        for k in (1, 5):
+            self.assertSameAsReference([0, 1], k=k, maxlen=12)
+
+    def test_suppress_unk(self):
+        for models in ([1], [0, 1]):
+            samples = [s for result in self.assertSameAsReference(models, k=5, maxlen=12) for s in result[0]]
+            self.assertTrue(any(1 in s for s in samples))
+            samples = [s for result in self.assertSameAsReference(models, k=5, maxlen=12, suppress_unk=True)
+                       for s in result[0]]
+            self.assertFalse(any(1 in s for s in samples))
+
+    def test_hyp_graph(self):
+        for models in ([0], [0, 1]):
+            self.assertSameAsReference(models, k=5, maxlen=12, return_hyp_graph=True)
+
+    def test_nbest_size(self):
+        for sample, score, _, _, _ in self.decode_batch([0], k=5, maxlen=12):
+            self.assertEqual(len(sample), 5)
+            self.assertEqual(len(score), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from data_iterator import TextIterator
+from nmt import CachedBatches, prepare_data, pred_probs
+
+from test_data_iterator import write_head
+from tiny_model import model_options
+
+
+def f_log_probs(x, x_mask, y, y_mask):
+    """
+    Stands in for the scoring function of a model: a score per sentence
+    pair that depends on all (unpadded) source and target words
+    """
+    return ((y * y_mask).sum(0) + 0.01 * (x[0] * x_mask).sum(0)).astype('float32')
+
+
+class TestCachedBatches(unittest.TestCase):
+    """
+    Scoring cached validation minibatches must give the same scores (in the
+    same order) as scoring the validation iterator
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.source = os.path.join(cls.tmpdir, 'corpus.en')
+        cls.target = os.path.join(cls.tmpdir, 'corpus.de')
+        write_head('data/corpus.en', cls.source, 200)
+        write_head('data/corpus.de', cls.target, 200)
+        cls.options = model_options(n_words_src=300, n_words=200)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def iterator(self, cached, maxlen=100):
+        # without caching, the corpus is read in its original order
+        return TextIterator(self.source, self.target, ['data/vocab.en.json'], 'data/vocab.de.json',
+                            n_words_source=300, n_words_target=200, batch_size=16, maxlen=maxlen,
+                            sort_by_length=cached, maxibatch_size=0 if cached else 20,
+                            return_indices=cached)
+
+    def test_scores(self):
+        for maxlen in (100, 20):
+            expected, _ = pred_probs(f_log_probs, prepare_data, self.options, self.iterator(False, maxlen))
+            cached = CachedBatches(prepare_data, self.options, self.iterator(True, maxlen))
+            self.assertEqual(cached.n_samples, len(expected))
+            # scored repeatedly
+            for _ in xrange(2):
+                scores, _ = pred_probs(f_log_probs, prepare_data, self.options, cached)
+                numpy.testing.assert_array_equal(scores, expected)
+
+    def test_source_dicts(self):
+        # needed for validation BLEU (--bleu with --cache_valid_batches)
+        iterator = self.iterator(True)
+        cached = CachedBatches(prepare_data, self.options, iterator)
+        self.assertEqual(cached.source_dicts, iterator.source_dicts)
+
+
+if __name__ == '__main__':
+    unittest.main()
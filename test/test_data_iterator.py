@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath('../nematus'))
+from data_iterator import TextIterator, BinaryTextIterator
+import binarize
+import shuffle
+
+
+def write_head(source, target, n_lines):
+    with open(source) as f:
+        lines = [line for _, line in zip(xrange(n_lines), f)]
+    with open(target, 'w') as f:
+        f.writelines(lines)
+
+
+class TestBinaryTextIterator(unittest.TestCase):
+    """
+    BinaryTextIterator must return the same minibatches as TextIterator
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.source = os.path.join(cls.tmpdir, 'corpus.en')
+        cls.target = os.path.join(cls.tmpdir, 'corpus.de')
+        write_head('data/corpus.en', cls.source, 500)
+        write_head('data/corpus.de', cls.target, 500)
+        cls.dictionaries = ['data/vocab.en.json', 'data/vocab.de.json']
+        logging.disable(logging.INFO)
+        binarize.main([cls.source, cls.target], cls.dictionaries, 1, None)
+        logging.disable(logging.NOTSET)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def assertSameBatches(self, epochs=2, **kwargs):
+        text = TextIterator(self.source, self.target, self.dictionaries[:1], self.dictionaries[1], **kwargs)
+        binary = BinaryTextIterator(self.source + '.bin', self.target + '.bin', **kwargs)
+        for _ in xrange(epochs):
+            text_batches = list(text)
+            binary_batches = list(binary)
+            self.assertTrue(len(text_batches) > 1)
+            self.assertEqual(len(text_batches), len(binary_batches))
+            for (x, y), (x_bin, y_bin) in zip(text_batches, binary_batches):
+                self.assertEqual(x, x_bin)
+                self.assertEqual(y, y_bin)
+
+    def test_default(self):
+        self.assertSameBatches(batch_size=16, maxibatch_size=4)
+
+    def test_unsorted(self):
+        self.assertSameBatches(batch_size=16, sort_by_length=False)
+
+    def test_maxlen_and_vocabulary(self):
+        self.assertSameBatches(batch_size=16, maxibatch_size=4, maxlen=15,
+                               n_words_source=300, n_words_target=200)
+
+    def test_token_batch_size(self):
+        self.assertSameBatches(batch_size=16, maxibatch_size=4, token_batch_size=300)
+
+
+class TestShuffle(unittest.TestCase):
+    """
+    Shuffling by permuting line offsets must be reproducible, so that
+    training can be resumed in the middle of an epoch
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.source = os.path.join(cls.tmpdir, 'corpus.en')
+        cls.target = os.path.join(cls.tmpdir, 'corpus.de')
+        write_head('data/corpus.en', cls.source, 300)
+        write_head('data/corpus.de', cls.target, 300)
+        cls.dictionaries = ['data/vocab.en.json', 'data/vocab.de.json']
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def read_epoch(self, shuffler, epoch):
+        return [list(f) for f in shuffler.open(epoch)]
+
+    def test_permutation(self):
+        self.assertEqual(list(shuffle.permutation(100, seed=7, epoch=3)),
+                         list(shuffle.permutation(100, seed=7, epoch=3)))
+        self.assertNotEqual(list(shuffle.permutation(100, seed=7, epoch=3)),
+                            list(shuffle.permutation(100, seed=7, epoch=4)))
+        self.assertNotEqual(list(shuffle.permutation(100, seed=7, epoch=3)),
+                            list(shuffle.permutation(100, seed=8, epoch=3)))
+
+    def test_shuffler(self):
+        shuffler = shuffle.Shuffler([self.source, self.target], seed=7)
+        source, target = self.read_epoch(shuffler, 1)
+        with open(self.source) as f:
+            original_source = f.readlines()
+        with open(self.target) as f:
+            original_target = f.readlines()
+        # all lines are read once, and stay parallel
+        self.assertEqual(sorted(source), sorted(original_source))
+        self.assertNotEqual(source, original_source)
+        self.assertEqual(sorted(zip(source, target)), sorted(zip(original_source, original_target)))
+        # same (seed, epoch), same order (also in a new Shuffler)
+        self.assertEqual([source, target], self.read_epoch(shuffle.Shuffler([self.source, self.target], seed=7), 1))
+        self.assertNotEqual(source, self.read_epoch(shuffler, 2)[0])
+
+    def test_shuffler_closes_files(self):
+        shuffler = shuffle.Shuffler([self.source, self.target], seed=7)
+        first = shuffler.open(0)
+        second = shuffler.open(1)
+        self.assertTrue(all(f._file.closed for f in first))
+        self.assertFalse(any(f._file.closed for f in second))
+        shuffler.close()
+        self.assertTrue(all(f._file.closed for f in second))
+
+    def iterator(self, epoch=0):
+        return TextIterator(self.source, self.target, self.dictionaries[:1], self.dictionaries[1],
+                            batch_size=16, maxibatch_size=4, shuffle_each_epoch=True,
+                            shuffle_seed=7, epoch=epoch)
+
+    def test_len_does_not_change_epoch(self):
+        reference = self.iterator()
+        counted = self.iterator()
+        self.assertEqual(len(counted), len(list(self.iterator())))
+        self.assertEqual(list(reference), list(counted))
+        self.assertEqual(list(reference), list(counted))
+
+    def test_resume(self):
+        iterator = self.iterator()
+        list(iterator)
+        second_epoch = list(iterator)
+        # a new iterator that starts at the second epoch (as when training
+        # is resumed) reads the same minibatches
+        self.assertEqual(second_epoch, list(self.iterator(epoch=1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from parallel_training import DataParallelTrainer
+
+
+class Variable(object):
+    """
+    Stands in for a Theano shared variable
+    """
+    def __init__(self, value):
+        self.value = numpy.array(value, dtype='float64')
+
+    def get_value(self, borrow=False):
+        return self.value if borrow else self.value.copy()
+
+    def set_value(self, value):
+        self.value = numpy.array(value, dtype='float64')
+
+
+class GradientModel(object):
+    """
+    Stand-ins for the functions of gradient accumulation (see
+    optimizers.accumulate_gradients): the "gradient" of a minibatch x is
+    x itself, and the cost depends on the current parameters
+    """
+    def __init__(self, param):
+        self.param = Variable(param)
+        self.grad = Variable(numpy.zeros_like(param))
+
+    def f_grad(self, x):
+        self.grad.value += x
+        return float((self.param.value * x).sum())
+
+    def f_reset_grads(self):
+        self.grad.value[...] = 0.
+
+    def f_update(self, lrate):
+        self.param.value -= lrate * self.grad.value
+
+
+class TestDataParallelTrainer(unittest.TestCase):
+    """
+    DataParallelTrainer with stub training functions (no Theano); the
+    workers are forked processes
+    """
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(1)
+        self.trainers = []
+
+    def tearDown(self):
+        for trainer in self.trainers:
+            trainer.close()
+
+    def gradient_trainer(self, model, workers=2, update_every=1, f_grad=None):
+        trainer = DataParallelTrainer(workers, 'gradients', [model.param], [],
+                                      f_grad=f_grad or model.f_grad, f_reset_grads=model.f_reset_grads,
+                                      grad_buffers=[model.grad], f_update=model.f_update,
+                                      update_every=update_every)
+        self.trainers.append(trainer)
+        return trainer
+
+    def test_gradient_sync(self):
+        param = numpy.array([1., -2., 3.])
+        model = GradientModel(param)
+        trainer = self.gradient_trainer(model, workers=2, update_every=2)
+        self.assertEqual(trainer.batches_per_update, 4)
+        for _ in xrange(2):
+            batches = [self.rng.randn(3) for _ in xrange(4)]
+            for x in batches:
+                trainer.submit([x], 0.1, 1)
+            costs = trainer.update(0.1)
+            # the workers used the parameters of the master, and the summed
+            # gradients are applied once
+            numpy.testing.assert_allclose(sorted(costs), sorted(float((param * x).sum()) for x in batches))
+            param = param - 0.1 * sum(batches)
+            numpy.testing.assert_allclose(model.param.value, param)
+
+    def test_parameter_averaging(self):
+        param = Variable([1., -2., 3.])
+        steps = Variable(0.)
+
+        def f_update(lrate, x):
+            param.value -= lrate * x
+            steps.value += 1.
+            return float(x.sum())
+
+        trainer = DataParallelTrainer(3, 'parameters', [param], [steps], f_update=f_update)
+        self.trainers.append(trainer)
+        self.assertEqual(trainer.batches_per_update, 3)
+        batches = [self.rng.randn(3) for _ in xrange(3)]
+        for x in batches:
+            trainer.submit([x], 0.1, 1)
+        costs = trainer.update(0.1, average=True)
+        self.assertEqual(sorted(costs), sorted(float(x.sum()) for x in batches))
+        numpy.testing.assert_allclose(param.value, numpy.array([1., -2., 3.]) - 0.1 * numpy.mean(batches, axis=0))
+        numpy.testing.assert_allclose(steps.value, 1.)
+
+    def test_reused_input_arrays(self):
+        # each worker gets its own minibatch, even if the caller overwrites
+        # the arrays (as with BatchBuffers) before the queue sends them
+        model = GradientModel(numpy.ones(1000))
+        trainer = self.gradient_trainer(model, workers=2)
+        buf = numpy.empty(1000)
+        expected = []
+        for i in xrange(2):
+            buf[...] = i + 1.
+            trainer.submit([buf], 0.1, 1)
+            expected.append(float(buf.sum()))
+        buf[...] = 0.
+        self.assertEqual(sorted(trainer.update(0.1)), expected)
+
+    def test_worker_error(self):
+        def f_grad(x):
+            raise ValueError('bad minibatch')
+        trainer = self.gradient_trainer(GradientModel(numpy.zeros(3)), f_grad=f_grad)
+        trainer.submit([numpy.zeros(3)], 0.1, 1)
+        trainer.submit([numpy.zeros(3)], 0.1, 1)
+        with self.assertRaisesRegexp(RuntimeError, 'bad minibatch'):
+            trainer.update(0.1)
+
+    def test_dead_worker(self):
+        def f_grad(x):
+            os._exit(3)
+        trainer = self.gradient_trainer(GradientModel(numpy.zeros(3)), f_grad=f_grad)
+        trainer.submit([numpy.zeros(3)], 0.1, 1)
+        trainer.submit([numpy.zeros(3)], 0.1, 1)
+        with self.assertRaisesRegexp(RuntimeError, 'died \(exit code 3\)'):
+            trainer.update(0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
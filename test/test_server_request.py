@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import unittest
+
+sys.path.append(os.path.abspath('../nematus'))
+from server.api.nematus_style import TranslationRequestNematus
+from server.request import InvalidRequest
+
+
+class Request(object):
+    """
+    A parsed JSON request body, as provided by bottle
+    """
+    def __init__(self, body):
+        self.json = body
+
+
+class TestNematusRequest(unittest.TestCase):
+    """
+    Invalid priorities and deadlines are rejected by the request parser
+    """
+
+    def parse(self, **kwargs):
+        body = {'segments': [['ein', 'Test']]}
+        body.update(kwargs)
+        return TranslationRequestNematus(Request(body))
+
+    def test_valid(self):
+        settings = self.parse(priority='low', deadline='2.5').settings
+        self.assertEqual(settings.priority, 'low')
+        self.assertEqual(settings.deadline, 2.5)
+        settings = self.parse(deadline=0).settings
+        self.assertEqual(settings.deadline, 0.)
+
+    def test_invalid_priority(self):
+        for priority in ('urgent', 0, None):
+            self.assertRaises(InvalidRequest, self.parse, priority=priority)
+
+    def test_invalid_deadline(self):
+        for deadline in ('soon', None, [1], -1, float('nan')):
+            self.assertRaises(InvalidRequest, self.parse, deadline=deadline)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+import cPickle as pkl
+
+sys.path.append(os.path.abspath('../nematus'))
+from translation_cache import TranslationCache
+
+
+def entry_size(value):
+    return len(pkl.dumps(value, protocol=pkl.HIGHEST_PROTOCOL))
+
+
+class TestTranslationCache(unittest.TestCase):
+    """
+    LRU eviction and the disk store of the translation cache
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_key(self):
+        key = TranslationCache.key([4, 5, 0], ('beam', 5))
+        self.assertEqual(key, TranslationCache.key([4, 5, 0], ('beam', 5)))
+        self.assertNotEqual(key, TranslationCache.key([4, 5, 0], ('beam', 6)))
+        self.assertNotEqual(key, TranslationCache.key([4, 6, 0], ('beam', 5)))
+
+    def test_evict_by_entries(self):
+        cache = TranslationCache(max_entries=2)
+        cache.put('a', 'translation a')
+        cache.put('b', 'translation b')
+        # 'a' is now the most recently used entry, so 'b' is evicted
+        self.assertEqual(cache.get('a'), 'translation a')
+        cache.put('c', 'translation c')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'translation a')
+        self.assertEqual(cache.get('c'), 'translation c')
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 1)
+        self.assertAlmostEqual(stats['hit_rate'], 0.75)
+
+    def test_evict_by_bytes(self):
+        value = 'x' * 100
+        size = entry_size(value)
+        cache = TranslationCache(max_entries=100, max_bytes=2 * size + size // 2)
+        cache.put('a', value)
+        cache.put('b', value)
+        self.assertEqual(cache.stats()['bytes'], 2 * size)
+        cache.put('c', value)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), value)
+        self.assertEqual(cache.get('c'), value)
+        self.assertEqual(cache.stats()['bytes'], 2 * size)
+        # entries larger than the cache are not stored
+        cache.put('d', 'x' * (3 * size))
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_replace_entry(self):
+        cache = TranslationCache(max_entries=2)
+        cache.put('a', 'short')
+        cache.put('a', 'a longer translation')
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['bytes'], entry_size('a longer translation'))
+
+    def test_no_memory_cache(self):
+        cache = TranslationCache(max_entries=0)
+        cache.put('a', 'translation a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_disk_store(self):
+        directory = os.path.join(self.tmpdir, 'cache')
+        value = [(['ein', 'Test'], -1.5, None)]
+        key = TranslationCache.key([4, 5, 0], 'settings')
+        cache = TranslationCache(max_entries=0, directory=directory)
+        cache.put(key, value)
+        self.assertEqual(cache.get(key), value)
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+
+        # another cache (e.g. in another process) reads the same entries
+        other = TranslationCache(max_entries=10, directory=directory)
+        self.assertEqual(other.get(key), value)
+        self.assertEqual(other.stats()['disk_hits'], 1)
+        # and keeps them in memory
+        self.assertEqual(other.get(key), value)
+        self.assertEqual(other.stats()['hits'], 1)
+        self.assertIsNone(other.get(TranslationCache.key([4, 6, 0], 'settings')))
+
+        # no temporary files are left behind
+        files = [f for _, _, filenames in os.walk(directory) for f in filenames]
+        self.assertEqual(files, [key + '.pkl'])
+
+    def test_corrupt_disk_entry(self):
+        directory = os.path.join(self.tmpdir, 'cache')
+        cache = TranslationCache(max_entries=0, directory=directory)
+        key = TranslationCache.key([1], 'settings')
+        cache.put(key, 'value')
+        with open(cache._path(key), 'wb') as f:
+            f.write('not a pickle')
+        self.assertIsNone(cache.get(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tiny, randomly initialized models for unit tests that do not need
+pre-trained WMT16 models.
+"""
+
+import sys
+import os
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+
+
+def model_options(**kwargs):
+    """
+    Options of a tiny model (overridden by kwargs).
+    """
+    options = {'dim_word': 8,
+               'dim': 12,
+               'n_words_src': 30,
+               'n_words': 25,
+               'factors': 1,
+               'dim_per_factor': [8],
+               'encoder': 'gru',
+               'decoder': 'gru_cond',
+               'decoder_deep': 'gru',
+               'enc_depth': 1,
+               'enc_depth_bidirectional': 1,
+               'enc_recurrence_transition_depth': 1,
+               'dec_depth': 1,
+               'dec_base_recurrence_transition_depth': 2,
+               'dec_high_recurrence_transition_depth': 1,
+               'dec_deep_context': False,
+               'decoder_truncate_gradient': -1,
+               'encoder_truncate_gradient': -1,
+               'layer_normalisation': False,
+               'weight_normalisation': False,
+               'tie_encoder_decoder_embeddings': False,
+               'tie_decoder_embeddings': False,
+               'use_dropout': False,
+               'dropout_embedding': 0.,
+               'dropout_hidden': 0.,
+               'dropout_source': 0.,
+               'dropout_target': 0.,
+               'deep_fusion_lm': None,
+               'concatenate_lm_decoder': False,
+               'multi_src': False,
+               'objective': 'CE',
+               'model_version': 0.1}
+    options.update(kwargs)
+    return options
+
+
+def tiny_model(seed=1234, scale=1., **kwargs):
+    """
+    Returns the options and (Theano) parameters of a randomly initialized
+    tiny model. With scale > 1, the parameters are scaled up so that the
+    output distributions are less uniform.
+    """
+    from nmt import init_params
+    from theano_util import init_theano_params
+    options = model_options(**kwargs)
+    numpy.random.seed(seed)
+    params = init_params(options)
+    for name in params:
+        params[name] *= scale
+    return options, init_theano_params(params)